@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Micro-benchmark of parsing the saved book pages in benchmarks/corpus/knihy
+with the per-field parse_* methods the Worker used to have, kept in
+legacy_extract.py, and with the precompiled query of extract_fields().
+Tree building is measured separately since both share it.
+
+	calibre-debug -e benchmarks/bench_extract.py -- [--json results.json]
+'''
+
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import QuietLog, best_of, corpus_pages, load_plugin, write_json
+from legacy_extract import LegacyExtractor
+
+
+def per_field(extractor, root):
+	fields = {}
+	fields['title'] = extractor.parse_title(root)
+	fields['authors'] = extractor.parse_authors(root)
+	try:
+		fields['series'], fields['series_index'] = extractor.parse_series(root)
+	except TypeError:
+		# parse_series returns None for a series without index
+		pass
+	fields['comments'] = extractor.parse_comments(root)
+	fields['cover_url'] = extractor.parse_cover(root)
+	fields['tags'] = extractor.parse_tags(root)
+	fields['publisher'] = extractor.parse_publisher(root)
+	fields['pubdate'] = extractor.parse_pubdate(root)
+	fields['rating'] = extractor.parse_rating(root)
+	fields['bid'] = root.xpath('//a[@id="bukinfo"]/@bid')[0]
+	return fields
+
+
+def main(args):
+	load_plugin()
+	import lxml.html as lh
+	from calibre_plugins.databazeknih import databazeknih
+	from calibre_plugins.databazeknih.extract import extract_fields
+
+	plugin = databazeknih(None)
+	extractor = LegacyExtractor(plugin.BASE_URL, QuietLog())
+	results = []
+	for path in corpus_pages('knihy'):
+		with open(path, 'rb') as f:
+			raw = f.read()
+		root = lh.fromstring(raw)
+		row = {
+			'page': os.path.basename(path),
+			'bytes': len(raw),
+			'tree': best_of(lambda: lh.fromstring(raw)),
+			'per_field': best_of(lambda: per_field(extractor, root)),
+			'extract_fields': best_of(lambda: extract_fields(root, plugin.BASE_URL)),
+		}
+		results.append(row)
+		print('%(page)-45s tree %(tree)8.5fs  per-field %(per_field)8.5fs'
+				'  extract_fields %(extract_fields)8.5fs'%row)
+	if '--json' in args:
+		write_json(args[args.index('--json') + 1], results)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
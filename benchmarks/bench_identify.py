@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+End-to-end benchmark of identify against the local stand-in server. The
+books of corpus/books.json are identified ``--rounds`` times by
+``--concurrency`` parallel callers, like calibre's bulk metadata download.
+
+	calibre-debug -e benchmarks/bench_identify.py -- --concurrency 1,2,4,8 \\
+		--latency 0.08 --jitter 0.03 --json results.json
+
+Reports identify latency, per-phase request timings as seen by the server,
+pages/s and peak RSS for each concurrency level. Compare two JSON files
+with benchmarks/compare.py.
+'''
+
+import argparse, json, os, platform, sys, threading, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import (CORPUS_DIR, QuietLog, load_plugin, override_options,
+		percentile, write_json)
+from server import StandInServer
+try:
+	from Queue import Queue, Empty
+except ImportError:
+	from queue import Queue, Empty
+
+
+def peak_rss_kb():
+	try:
+		import resource
+	except ImportError:
+		return None
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summary(values):
+	if not values:
+		return None
+	return {'mean': sum(values) / len(values), 'p50': percentile(values, 50),
+		'p95': percentile(values, 95), 'p99': percentile(values, 99),
+		'max': max(values)}
+
+
+def run_level(plugin, server, books, concurrency, rounds, timeout, covers):
+	jobs = Queue()
+	for i in range(rounds):
+		for book in books:
+			jobs.put(book)
+	latencies, cover_latencies, found = [], [], []
+	lock = threading.Lock()
+
+	def caller():
+		log, abort = QuietLog(), threading.Event()
+		while True:
+			try:
+				book = jobs.get_nowait()
+			except Empty:
+				return
+			rq = Queue()
+			start = time.time()
+			plugin.identify(log, rq, abort, title=book['title'],
+					authors=book['authors'], identifiers=dict(book['identifiers']),
+					timeout=timeout)
+			elapsed = time.time() - start
+			cover_elapsed = None
+			if covers:
+				start = time.time()
+				plugin.download_cover(log, Queue(), abort, title=book['title'],
+						authors=book['authors'], identifiers=dict(book['identifiers']),
+						timeout=timeout)
+				cover_elapsed = time.time() - start
+			with lock:
+				latencies.append(elapsed)
+				found.append(rq.qsize())
+				if cover_elapsed is not None:
+					cover_latencies.append(cover_elapsed)
+
+	server.take_log()
+	threads = [threading.Thread(target=caller) for i in range(concurrency)]
+	start = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	wall = time.time() - start
+	requests = server.take_log()
+
+	phases = {}
+	for kind in sorted(set(r['kind'] for r in requests)):
+		rows = [r for r in requests if r['kind'] == kind]
+		phases[kind] = {'requests': len(rows),
+			'bytes': sum(r['bytes'] for r in rows),
+			'errors': sum(1 for r in rows if r['status'] >= 400 or not r['status']),
+			'time': summary([r['end'] - r['start'] for r in rows])}
+	return {
+		'concurrency': concurrency,
+		'identify_calls': len(latencies),
+		'results': sum(found),
+		'wall': wall,
+		'identify': summary(latencies),
+		'download_cover': summary(cover_latencies),
+		'requests': len(requests),
+		'pages_per_s': len(requests) / wall if wall else None,
+		'identify_per_s': len(latencies) / wall if wall else None,
+		'phases': phases,
+		'peak_rss_kb': peak_rss_kb(),
+	}
+
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Benchmark identify against the corpus pages')
+	parser.add_argument('--concurrency', default='1,2,4,8',
+			help='comma separated numbers of parallel identify calls')
+	parser.add_argument('--rounds', type=int, default=4, help='how many times every book is identified')
+	parser.add_argument('--latency', type=float, default=0.05)
+	parser.add_argument('--jitter', type=float, default=0.02)
+	parser.add_argument('--capacity', type=int,
+			help='the server answers 503 above this many parallel requests')
+	parser.add_argument('--timeout', type=int, default=30)
+	parser.add_argument('--covers', action='store_true', help='also download covers')
+	parser.add_argument('--no-compress', action='store_true', help='the server never gzips pages')
+	parser.add_argument('--stragglers', type=float, default=0.0,
+			help='share of responses the server delays by --straggler-delay seconds')
+	parser.add_argument('--straggler-delay', type=float, default=2.0)
+	parser.add_argument('--drops', type=float, default=0.0,
+			help='share of requests the server never answers')
+	parser.add_argument('--option', action='append', default=[],
+			help='plugin option as key=json-value, e.g. streamingParse=true')
+	parser.add_argument('--json', help='write the results to this file')
+	opts = parser.parse_args(args)
+
+	load_plugin()
+	options = {'cacheTtlDays': 0, 'searchCacheTtlHours': 0}
+	for option in opts.option:
+		key, _, value = option.partition('=')
+		options[key] = json.loads(value)
+	override_options(**options)
+	from calibre_plugins.databazeknih import databazeknih
+
+	server = StandInServer(latency=opts.latency, jitter=opts.jitter,
+			capacity=opts.capacity, compress=not opts.no_compress,
+			stragglers=opts.stragglers, straggler_delay=opts.straggler_delay,
+			drops=opts.drops).start()
+	databazeknih.BASE_URL = server.base_url
+	plugin = databazeknih(None)
+	with open(os.path.join(CORPUS_DIR, 'books.json'), 'rb') as f:
+		books = json.loads(f.read().decode('utf-8'))
+
+	levels = []
+	try:
+		for concurrency in [int(x) for x in opts.concurrency.split(',')]:
+			level = run_level(plugin, server, books, concurrency, opts.rounds,
+					opts.timeout, opts.covers)
+			levels.append(level)
+			print('concurrency %2d: identify mean %.3fs p95 %.3fs p99 %.3fs, %.1f pages/s,'
+					' %d requests, %d results, peak RSS %s kB' % (concurrency,
+						level['identify']['mean'], level['identify']['p95'],
+						level['identify']['p99'],
+						level['pages_per_s'], level['requests'], level['results'],
+						level['peak_rss_kb']))
+			for kind, phase in sorted(level['phases'].items()):
+				print('    %-7s %4d requests, %d errors, mean %.3fs, %d bytes' % (kind,
+					phase['requests'], phase['errors'], phase['time']['mean'],
+					phase['bytes']))
+	finally:
+		plugin.session.close()
+		server.stop()
+
+	if opts.json:
+		write_json(opts.json, {
+			'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'plugin_version': '.'.join(map(str, databazeknih.version)),
+			'latency': opts.latency, 'jitter': opts.jitter, 'rounds': opts.rounds,
+			'capacity': opts.capacity, 'compress': not opts.no_compress,
+			'stragglers': opts.stragglers, 'straggler_delay': opts.straggler_delay,
+			'drops': opts.drops,
+			'books': len(books), 'options': options, 'levels': levels,
+		})
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
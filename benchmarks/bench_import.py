@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Cold start of the plugin. calibre imports every metadata source and
+creates its Source object at startup and for each metadata job, the
+import time is measured up to that point. The first identify loads the
+networking and parsing modules on top, its latency is reported next to
+a second identify of the same book. Every sample runs in a new process,
+caches are off so that both identify calls make the same requests.
+Needs Python 3.
+
+	calibre-debug -e benchmarks/bench_import.py -- --samples 10 \\
+		--json results.json
+'''
+
+import argparse, json, multiprocessing, os, platform, sys, threading, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import (CORPUS_DIR, QuietLog, load_plugin, override_options,
+		percentile, write_json)
+
+# Reported when loaded by the import, they belong to the first use
+HEAVY_MODULES = ('lxml.etree', 'lxml.html', 'PyQt5.Qt', 'PyQt4.Qt',
+		'calibre.gui2', 'dateutil', 'http.client', 'httplib', 'urllib.request',
+		'urllib2', 'ssl', 'sqlite3', 'tracemalloc', 'asyncio',
+		'concurrent.futures', 'calibre_plugins.databazeknih.worker',
+		'calibre_plugins.databazeknih.session')
+
+
+def sample(results, latency):
+	'''
+	One cold start in a new process, the timings are put in results
+	'''
+	before = set(sys.modules)
+	started = time.time()
+	load_plugin()
+	from calibre_plugins.databazeknih import databazeknih
+	plugin = databazeknih(None)
+	imported = time.time() - started
+	loaded = set(sys.modules) - before
+
+	override_options(cacheTtlDays=0, searchCacheTtlHours=0, coverCacheMb=0,
+			quietLog=True, maxRequestsPerSecond=0)
+	from server import StandInServer
+	server = StandInServer(latency=latency).start()
+	databazeknih.BASE_URL = server.base_url
+	with open(os.path.join(CORPUS_DIR, 'books.json'), 'rb') as f:
+		book = json.loads(f.read().decode('utf-8'))[0]
+	from queue import Queue
+	identify = []
+	try:
+		for i in range(2):
+			started = time.time()
+			plugin.identify(QuietLog(), Queue(), threading.Event(), book['title'],
+					book['authors'], {})
+			identify.append(time.time() - started)
+	finally:
+		server.stop()
+	results.put({
+		'import': imported,
+		'modules': len(loaded),
+		'heavy': sorted(name for name in HEAVY_MODULES if name in loaded),
+		'first_identify': identify[0],
+		'second_identify': identify[1],
+	})
+
+
+def summary(values):
+	return {'min': min(values), 'p50': percentile(values, 50), 'max': max(values)}
+
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Benchmark the cold import and the first identify')
+	parser.add_argument('--samples', type=int, default=10, help='new processes to measure')
+	parser.add_argument('--latency', type=float, default=0.0)
+	parser.add_argument('--json', help='write the results to this file')
+	opts = parser.parse_args(args)
+
+	context = multiprocessing.get_context('spawn')
+	samples = []
+	for i in range(opts.samples):
+		results = context.Queue()
+		process = context.Process(target=sample, args=(results, opts.latency))
+		process.start()
+		samples.append(results.get(timeout=120))
+		process.join()
+
+	metrics = {}
+	for name in ('import', 'first_identify', 'second_identify'):
+		metrics[name] = summary([s[name] for s in samples])
+		print('%-16s min %7.1f ms, p50 %7.1f ms, max %7.1f ms' % (name,
+			metrics[name]['min'] * 1000, metrics[name]['p50'] * 1000,
+			metrics[name]['max'] * 1000))
+	print('modules loaded by the import: %d' % samples[0]['modules'])
+	print('heavy modules loaded by the import: %s' % (
+		', '.join(samples[0]['heavy']) or 'none'))
+
+	if opts.json:
+		write_json(opts.json, {
+			'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'samples': opts.samples, 'latency': opts.latency,
+			'metrics': metrics, 'heavy': samples[0]['heavy'],
+			'modules': samples[0]['modules'],
+		})
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Throughput of downloading and parsing book pages against the number of
+worker threads, with the pages parsed by the worker threads and by
+``--processes`` parse processes. Every page of corpus/knihy is fetched
+``--copies`` times under different URLs, ISBN lookups and caches are off.
+The stand-in server runs in a process of its own so that it does not take
+the GIL from the workers. Needs Python 3.7 or newer.
+
+	calibre-debug -e benchmarks/bench_parse.py -- --workers 1,2,4,8 \\
+		--processes 4 --json results.json
+'''
+
+import argparse, multiprocessing, os, platform, socket, sys, threading, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import (CORPUS_DIR, QuietLog, load_plugin, override_options,
+		write_json)
+import server
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def start_server(latency):
+	'''
+	The stand-in server in a new process, once it accepts connections
+	'''
+	port = free_port()
+	process = multiprocessing.get_context('spawn').Process(target=server.main,
+			args=(['--port', str(port), '--latency', str(latency)],))
+	process.daemon = True
+	process.start()
+	for i in range(100):
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			break
+		except socket.error:
+			time.sleep(0.05)
+	return process, 'http://127.0.0.1:%d/' % port
+
+
+def use_parse_processes(processes):
+	'''
+	Replace the parse pool, 0 processes parse in the worker threads
+	'''
+	import calibre_plugins.databazeknih.config as cfg
+	import calibre_plugins.databazeknih.processes as p
+	if p._pool:
+		p._pool.close()
+	get_option = cfg.get_option
+	cfg.get_option = lambda key, default=None: processes \
+			if key == cfg.KEY_PARSE_PROCESSES else get_option(key, default)
+	p._pool = None
+
+
+def run_level(plugin, urls, workers):
+	from calibre_plugins.databazeknih.executor import (CancelToken, TaskGroup,
+			ThreadPool)
+	from calibre_plugins.databazeknih.instrument import Recorder
+	from calibre_plugins.databazeknih.worker import Worker
+	group = TaskGroup(ThreadPool(workers, 'bench'))
+	results, recorder, log = Queue(), Recorder('bench', memory=False), QuietLog()
+	start, cpu = time.time(), time.process_time()
+	for url in urls:
+		w = Worker(url, results, plugin.policy, log, 0, plugin, group=group,
+				cancel=CancelToken(), recorder=recorder)
+		group.submit(w.run)
+	group.wait(threading.Event())
+	wall = time.time() - start
+	summary = recorder.summary()
+	return {
+		'workers': workers,
+		'pages': len(urls),
+		'results': results.qsize(),
+		'wall': wall,
+		'pages_per_s': len(urls) / wall,
+		'cpu': time.process_time() - cpu,
+		'parse': summary['spans'].get('detail.parse', {}).get('total'),
+	}
+
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Benchmark parsing in threads and processes')
+	parser.add_argument('--workers', default='1,2,4,8',
+			help='comma separated numbers of worker threads')
+	parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+			help='parse processes of the process mode')
+	parser.add_argument('--copies', type=int, default=40, help='times every page is fetched')
+	parser.add_argument('--latency', type=float, default=0.0)
+	parser.add_argument('--json', help='write the results to this file')
+	opts = parser.parse_args(args)
+	levels = [int(x) for x in opts.workers.split(',')]
+
+	load_plugin()
+	options = {'cacheTtlDays': 0, 'searchCacheTtlHours': 0, 'isbnLookup': False,
+			'quietLog': True, 'maxRequestsPerSecond': 0, 'maxConnections': max(levels),
+			'maxParsedPages': 0, 'hedgePercentile': 0}
+	override_options(**options)
+	from calibre_plugins.databazeknih import databazeknih
+	from calibre_plugins.databazeknih.processes import shared_parse_pool
+
+	process, databazeknih.BASE_URL = start_server(opts.latency)
+	plugin = databazeknih(None)
+	pages = sorted(name[:-len('.html')] for name in os.listdir(os.path.join(CORPUS_DIR, 'knihy')))
+	urls = [databazeknih.BASE_URL + 'knihy/%s?copy=%d' % (page, i)
+			for i in range(opts.copies) for page in pages]
+
+	modes = []
+	try:
+		for mode, processes in (('threads', 0), ('processes', opts.processes)):
+			use_parse_processes(processes)
+			pool = shared_parse_pool(plugin)
+			if pool is not None:
+				# Start the processes before the clock does
+				with open(os.path.join(CORPUS_DIR, 'knihy', pages[0] + '.html'), 'rb') as f:
+					data = f.read()
+				for i in range(processes):
+					pool.parse(data)
+			results = []
+			for workers in levels:
+				level = run_level(plugin, urls, workers)
+				results.append(level)
+				print('%-9s %2d workers: %6.1f pages/s, %d of %d pages parsed, cpu %.2fs' % (
+					mode, workers, level['pages_per_s'], level['results'], level['pages'],
+					level['cpu']))
+			modes.append({'mode': mode, 'processes': processes, 'levels': results})
+	finally:
+		use_parse_processes(0)
+		plugin.session.close()
+		process.terminate()
+
+	if opts.json:
+		write_json(opts.json, {
+			'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'plugin_version': '.'.join(map(str, databazeknih.version)),
+			'cpus': multiprocessing.cpu_count(), 'copies': opts.copies,
+			'latency': opts.latency, 'options': options, 'modes': modes,
+		})
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Compare two result files of bench_identify.py, runs without calibre:
+
+	python benchmarks/compare.py before.json after.json
+'''
+
+import json, sys
+
+METRICS = (
+	('identify mean', lambda l: l['identify']['mean'], 's'),
+	('identify p95', lambda l: l['identify']['p95'], 's'),
+	('identify p99', lambda l: l['identify'].get('p99'), 's'),
+	('pages/s', lambda l: l['pages_per_s'], ''),
+	('requests', lambda l: l['requests'], ''),
+	('results', lambda l: l['results'], ''),
+	('peak RSS', lambda l: l['peak_rss_kb'], ' kB'),
+)
+
+
+def load(path):
+	with open(path, 'rb') as f:
+		data = json.loads(f.read().decode('utf-8'))
+	return dict((level['concurrency'], level) for level in data['levels'])
+
+
+def main(args):
+	before, after = load(args[0]), load(args[1])
+	for concurrency in sorted(set(before) & set(after)):
+		print('concurrency %d' % concurrency)
+		for name, get, unit in METRICS:
+			old, new = get(before[concurrency]), get(after[concurrency])
+			if old is None or new is None:
+				continue
+			change = (new - old) / old * 100 if old else 0
+			print('    %-14s %10.3f%s -> %10.3f%s  %+6.1f%%' % (name, old, unit, new, unit, change))
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
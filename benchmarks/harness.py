@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Helpers shared by the benchmarks. They need calibre, run them with
+``calibre-debug -e benchmarks/<script>.py -- <arguments>``.
+'''
+
+import glob, json, os, sys, tempfile, time, types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.join(os.path.dirname(HERE), 'databazeknih.cz')
+CORPUS_DIR = os.path.join(HERE, 'corpus')
+
+
+def load_plugin():
+	'''
+	Import the plugin from the source tree as calibre_plugins.databazeknih,
+	in place of an installed copy
+	'''
+	if 'calibre_plugins' not in sys.modules:
+		sys.modules['calibre_plugins'] = types.ModuleType(str('calibre_plugins'))
+	name = str('calibre_plugins.databazeknih')
+	try:
+		from importlib.util import module_from_spec, spec_from_file_location
+	except ImportError:
+		# Python 2, imp is gone from Python 3.12
+		import imp
+		package = imp.load_module(name, None, PLUGIN_DIR,
+				(str(''), str(''), imp.PKG_DIRECTORY))
+	else:
+		spec = spec_from_file_location(name, os.path.join(PLUGIN_DIR, '__init__.py'),
+				submodule_search_locations=[PLUGIN_DIR])
+		package = module_from_spec(spec)
+		sys.modules[name] = package
+		spec.loader.exec_module(package)
+	setattr(sys.modules['calibre_plugins'], str('databazeknih'), package)
+	return package
+
+
+def override_options(**options):
+	'''
+	Use these plugin options instead of the stored ones and keep caches in a
+	temporary directory, the user's calibre configuration is not touched
+	'''
+	import calibre_plugins.databazeknih.config as cfg
+	data_dir = tempfile.mkdtemp(prefix='databazeknih-bench-')
+	values = dict(cfg.DEFAULT_STORE_VALUES)
+	values.update(options)
+	cfg.get_option = values.get
+	cfg.plugin_data_dir = lambda: data_dir
+	return data_dir
+
+
+def percentile(values, p):
+	values = sorted(values)
+	if not values:
+		return None
+	return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class QuietLog(object):
+	'''
+	Log that drops everything, so that the benchmarks measure the plugin
+	and not the terminal
+	'''
+
+	def info(self, *args, **kwargs):
+		pass
+
+	debug = warn = warning = error = exception = info
+
+	def __call__(self, *args, **kwargs):
+		pass
+
+
+def corpus_pages(kind):
+	return sorted(glob.glob(os.path.join(CORPUS_DIR, kind, '*.html')))
+
+
+def best_of(fn, repeat=5, number=20):
+	'''
+	Fastest average time of one fn() call in seconds
+	'''
+	timings = []
+	for i in range(repeat):
+		start = time.time()
+		for j in range(number):
+			fn()
+		timings.append((time.time() - start) / number)
+	return min(timings)
+
+
+def write_json(path, data):
+	with open(path, 'wb') as f:
+		f.write(json.dumps(data, indent=2, sort_keys=True).encode('utf-8'))
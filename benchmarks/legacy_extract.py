@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__copyright__ = 'based od Pavel Skulil <pavelsku@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+The per-field parsing the Worker did before extract_fields(), kept only as
+the baseline of bench_extract.py. The plugin does not use it. The methods
+are unchanged, the cover URL still gets a double slash from BASE_URL.
+'''
+
+import re
+from datetime import datetime
+
+
+class LegacyExtractor(object):
+
+	def __init__(self, base_url, log, quiet=True):
+		self.base_url, self.log, self.quiet = base_url, log, quiet
+
+	def debug(self, msg, *args):
+		if not self.quiet:
+			self.log.info(msg%args if args else msg)
+
+	def parse_first(self, root, xpath, loginfo, convert=lambda x: x[0].strip()):
+		try:
+			nodes = root.xpath(xpath)
+			self.debug('Found %s: %s', loginfo, nodes)
+			return convert(nodes) if nodes else None
+		except Exception as e:
+			self.log.exception('Error parsing for %s with xpath: %s' % (loginfo, xpath))
+
+	def parse_title(self, root):
+		title_node = self.parse_first(root,'//h1[@itemprop="name"]/text()','title',lambda x: x[0].replace('&nbsp;','').strip())
+		if title_node:
+			return title_node
+		else: return None
+
+	def parse_series(self, root):
+		series_node = root.xpath('//h3/a/text()')
+		if series_node:
+			self.debug('series_node: %s', series_node)
+			series_index = root.xpath('//h3/em[@class="info"]/text()')
+			if series_index:
+				self.debug('index_text: %s', series_index)
+				index = re.search('\((\d*)\.\)', series_index[0]).groups(0)[0]
+				self.debug('index: %s', index)
+				try:
+					index = float(index)
+				except:
+					index = None
+				self.debug('index: %s', index)
+				return (series_node[0], index)
+		else: return (None, None)
+
+	def parse_authors(self, root):
+		author_nodes = root.xpath('//h2[@class="jmenaautoru"]/a/text()')
+		if author_nodes:
+			authors = []
+			self.debug('eee %s', author_nodes[0])
+			acko = u''.join(author_nodes[0])
+			authors.append(acko)
+			return authors
+		else: return None
+
+	def parse_tags(self, root):
+		ret_nodes = root.xpath('//h5[@itemprop="category"]/a/text()')
+		if ret_nodes:
+			tags = []
+			self.debug('ttt %s', ret_nodes[0])
+			for node in ret_nodes:
+				tcko = u''.join(node)
+				tags.append(tcko)
+			return tags
+		else: return None
+
+	def parse_pubdate(self, root):
+		txt_more = root.xpath('//span[@itemprop="datePublished"]/text()')
+		if txt_more:
+			year = int(txt_more[0])
+			month = 1
+			day = 1
+			from calibre.utils.date import utc_tz
+			pubdate = datetime(year, month, day, tzinfo=utc_tz)
+			return pubdate
+		else: return None
+
+	def parse_comments(self, root):
+		description_node = root.xpath('//p[@id="biall"]/text()')
+		self.debug('comm_node: %s', description_node)
+		if description_node:
+			return ''.join(description_node)
+		else:
+			description_node = root.xpath('//p[@itemprop="description"]/text()')
+			self.debug('comm_node: %s', description_node)
+			if description_node:
+				return ''.join(description_node)
+			else: return None
+
+	def parse_publisher(self, root):
+		publisher_nodes = root.xpath('//span[@itemprop="publisher"]/a/text()')
+		self.debug('Publisher %s', publisher_nodes[0])
+		if publisher_nodes:
+			self.debug('Publisher %s', publisher_nodes[0])
+			return publisher_nodes[0]
+		else: return None
+
+	def parse_rating(self, root):
+		rating_node = root.xpath('//a[@class="bpoints"]/text()')
+		self.debug('Rating_node: %s', rating_node)
+		if len(rating_node) > 0:
+			rating_node = rating_node[0].strip("%")
+		else: rating_node = '0'
+		rating_node = float(rating_node)
+		self.debug('Rating_num: %s', rating_node)
+		if rating_node:
+			if rating_node >= 90:
+				out_rating = 5
+			elif rating_node >= 70:
+				out_rating = 4
+			elif rating_node >= 50:
+				out_rating = 3
+			elif rating_node >= 30:
+				out_rating = 2
+			elif rating_node >= 10:
+				out_rating = 1
+			else:
+				out_rating = 0
+			return out_rating
+		else: return None
+
+	def parse_cover(self, root):
+		book_cover = root.xpath('//img[@class="kniha_img"]/@src')
+		imgcol_node = book_cover
+		self.debug('Cover: %s', imgcol_node)
+		if imgcol_node:
+			adr_img = imgcol_node[0]
+			imgcol_node_big=imgcol_node[0].replace("mid_","big_",1);
+			if adr_img[:7] != 'http://':
+				imgcol_node_big = self.base_url+imgcol_node_big
+			return imgcol_node_big
+		else: return None
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Record pages of www.databazeknih.cz into benchmarks/corpus so that the
+stand-in server can serve them. Runs without calibre:
+
+	python benchmarks/record.py --search "Saturnin" --book saturnin-228710 --bid 1450
+
+--pages records the following pages of search results as well.
+'''
+
+import argparse, os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from server import CORPUS_DIR, slug
+try:
+	from urllib import quote
+	from urllib2 import Request, urlopen
+except ImportError:
+	from urllib.parse import quote
+	from urllib.request import Request, urlopen
+
+BASE_URL = 'http://www.databazeknih.cz/'
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+
+
+def fetch(url):
+	return urlopen(Request(url, headers={'User-Agent': USER_AGENT}), timeout=30).read()
+
+
+def save(name, data):
+	path = os.path.join(CORPUS_DIR, name)
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		f.write(data)
+	print('%s: %d bytes' % (name, len(data)))
+
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Record pages for the benchmarks')
+	parser.add_argument('--search', action='append', default=[], help='title to search for')
+	parser.add_argument('--book', action='append', default=[], help='book id, e.g. saturnin-228710')
+	parser.add_argument('--bid', action='append', default=[], help='bid of the ISBN lookup')
+	parser.add_argument('--pages', type=int, default=1, help='pages of search results to record')
+	parser.add_argument('--base-url', default=BASE_URL)
+	opts = parser.parse_args(args)
+	for query in opts.search:
+		text = query.encode('utf-8') if isinstance(query, type('')) else query
+		url = opts.base_url + 'index.php?stranka=search&q=' + quote(text.replace(b' ', b'+'))
+		save(os.path.join('search', slug(query) + '.html'), fetch(url))
+		for page in range(2, opts.pages + 1):
+			save(os.path.join('search', '%s.%d.html' % (slug(query), page)),
+				fetch(url + '&strana=%d' % page))
+	for book in opts.book:
+		save(os.path.join('knihy', book + '.html'), fetch(opts.base_url + 'knihy/' + book))
+	for bid in opts.bid:
+		save(os.path.join('more_binfo', bid + '.html'), fetch(opts.base_url +
+			'helpful/ajax/more_binfo.php?bid=' + bid))
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
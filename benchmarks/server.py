@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+Local stand-in for www.databazeknih.cz serving the pages of
+benchmarks/corpus with configurable latency. Point the plugin's BASE_URL
+at it. Runs without calibre:
+
+	python benchmarks/server.py --port 8080 --latency 0.08 --jitter 0.03
+
+	corpus/search/<slug of q>.html     index.php?stranka=search&q=...
+	corpus/search/<slug of q>.<n>.html index.php?stranka=search&q=...&strana=<n>
+	corpus/knihy/<id>.html             knihy/<id>
+	corpus/more_binfo/<bid>.html       helpful/ajax/more_binfo.php?bid=...
+	anything under images_books/       a generated JPEG
+'''
+
+import gzip, io, os, random, re, sys, threading, time, unicodedata
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import parse_qs, urlsplit
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import parse_qs, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(HERE, 'corpus')
+# Smallest valid JPEG padded to a cover-like size
+COVER = (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+		+ b'\x00' * 24000 + b'\xff\xd9')
+
+
+def slug(text):
+	'''
+	File name of the search page for the query text in the corpus
+	'''
+	if isinstance(text, bytes):
+		text = text.decode('utf-8')
+	text = unicodedata.normalize('NFKD', text)
+	text = ''.join(c for c in text if not unicodedata.combining(c))
+	return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-') or 'empty'
+
+
+def route(url):
+	'''
+	Request kind and corpus file for a request path
+	'''
+	parts = urlsplit(url)
+	query = parse_qs(parts.query)
+	path = parts.path.lstrip('/')
+	if path == 'index.php' and query.get('stranka') == ['search']:
+		page = query.get('strana', ['1'])[0]
+		name = slug(query.get('q', [''])[0]) + ('.' + page if page != '1' else '')
+		return 'search', os.path.join('search', name + '.html')
+	if path.startswith('knihy/'):
+		return 'detail', os.path.join('knihy', path[len('knihy/'):] + '.html')
+	if path == 'helpful/ajax/more_binfo.php':
+		return 'isbn', os.path.join('more_binfo', query.get('bid', [''])[0] + '.html')
+	if path.startswith('images_books/'):
+		return 'cover', None
+	return 'other', None
+
+
+def gzipped(body):
+	buf = io.BytesIO()
+	with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+		f.write(body)
+	return buf.getvalue()
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+	'''
+	Serves the corpus. Every response is delayed by ``latency`` seconds plus
+	a random jitter of up to ``jitter`` seconds, every request is logged.
+	With more than ``capacity`` requests in progress the server answers
+	503 with ``Retry-After: retry_after`` like an overloaded site. Pages are
+	sent gzipped to clients accepting it, unless ``compress`` is False.
+
+	A ``stragglers`` share of the responses is delayed by ``straggler_delay``
+	seconds more, a ``drops`` share of the requests is never answered, the
+	connection is closed instead.
+	'''
+
+	daemon_threads = True
+
+	def __init__(self, port=0, latency=0.0, jitter=0.0, corpus=CORPUS_DIR,
+			capacity=None, retry_after=1, compress=True, stragglers=0.0,
+			straggler_delay=2.0, drops=0.0):
+		HTTPServer.__init__(self, (str('127.0.0.1'), port), Handler)
+		self.latency, self.jitter, self.corpus = latency, jitter, corpus
+		self.compress = compress
+		self.stragglers, self.straggler_delay = stragglers, straggler_delay
+		self.drops = drops
+		self.capacity, self.retry_after = capacity, retry_after
+		self.in_progress = 0
+		self.lock = threading.Lock()
+		self.log = []
+		self.thread = None
+
+	@property
+	def base_url(self):
+		return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def delay(self):
+		delay = self.latency + random.uniform(0, self.jitter)
+		if self.stragglers and random.random() < self.stragglers:
+			delay += self.straggler_delay
+		return delay
+
+	def enter(self):
+		with self.lock:
+			self.in_progress += 1
+			return self.capacity is None or self.in_progress <= self.capacity
+
+	def leave(self):
+		with self.lock:
+			self.in_progress -= 1
+
+	def record(self, kind, path, start, status, size):
+		with self.lock:
+			self.log.append({'kind': kind, 'path': path, 'start': start,
+				'end': time.time(), 'status': status, 'bytes': size})
+
+	def take_log(self):
+		with self.lock:
+			log, self.log = self.log, []
+		return log
+
+
+class Handler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		start = time.time()
+		kind, name = route(self.path)
+		try:
+			if self.server.enter():
+				self.respond(start, kind, name)
+			else:
+				self.overloaded(start, kind)
+		finally:
+			self.server.leave()
+
+	def overloaded(self, start, kind):
+		body = b'Service Unavailable'
+		self.send_response(503)
+		self.send_header('Retry-After', str(self.server.retry_after))
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.server.record(kind, self.path, start, 503, len(body))
+
+	def respond(self, start, kind, name):
+		body, content_type = None, 'text/html; charset=utf-8'
+		if kind == 'cover':
+			body, content_type = COVER, 'image/jpeg'
+		elif name is not None:
+			path = os.path.join(self.server.corpus, name)
+			if os.path.exists(path):
+				with open(path, 'rb') as f:
+					body = f.read()
+		time.sleep(self.server.delay())
+		if self.server.drops and random.random() < self.server.drops:
+			self.close_connection = True
+			self.server.record(kind, self.path, start, 0, 0)
+			return
+		status = 200 if body is not None else 404
+		body = body if body is not None else b'Not found'
+		encoding = None
+		if self.server.compress and content_type.startswith('text/') and \
+				'gzip' in (self.headers.get('Accept-Encoding') or ''):
+			body, encoding = gzipped(body), 'gzip'
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		if encoding is not None:
+			self.send_header('Content-Encoding', encoding)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.server.record(kind, self.path, start, status, len(body))
+
+	def log_message(self, *args):
+		pass
+
+
+def main(args):
+	import argparse
+	parser = argparse.ArgumentParser(description='Serve the corpus pages as databazeknih.cz')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+	parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, seconds')
+	parser.add_argument('--capacity', type=int, help='answer 503 above this many parallel requests')
+	parser.add_argument('--no-compress', action='store_true', help='never gzip the pages')
+	parser.add_argument('--stragglers', type=float, default=0.0, help='share of slow responses')
+	parser.add_argument('--straggler-delay', type=float, default=2.0, help='seconds added to them')
+	parser.add_argument('--drops', type=float, default=0.0, help='share of requests never answered')
+	opts = parser.parse_args(args)
+	server = StandInServer(opts.port, opts.latency, opts.jitter, capacity=opts.capacity,
+			compress=not opts.no_compress, stragglers=opts.stragglers,
+			straggler_delay=opts.straggler_delay, drops=opts.drops)
+	print('Serving %s on %s' % (CORPUS_DIR, server.base_url))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -8,15 +8,13 @@ __license__   = 'GPL v3'
 __copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>, based on Pavel Skutil <pavelsku@gmail.com>'
 __docformat__ = 'restructuredtext cs'
 
-import time
-from Queue import Queue, Empty
-from lxml.html import fromstring
+# calibre imports every metadata source at startup and for each metadata
+# job. Only what registering the plugin needs is imported here, the other
+# modules of the plugin and their dependencies load on first use.
 from calibre import as_unicode
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.sources.base import Source
-from calibre.utils.cleantext import clean_ascii_chars
-import lxml, sys, traceback, urllib, urllib2
-from calibre import browser
+import sys, time
 
 
 class databazeknih(Source):
@@ -29,16 +27,55 @@ class databazeknih(Source):
 	capabilities = frozenset(['identify', 'cover'])
 	touched_fields = frozenset(['title', 'authors', 'identifier:databazeknih', 'tags', 'comments', 'rating', 'series', 'publisher','pubdate'])
 	has_html_comments = False
-	supports_gzip_transfer_encoding = False
+	supports_gzip_transfer_encoding = True
 
 	BASE_URL = "http://www.databazeknih.cz/"
+	# Pages of search results read at most for one search
+	MAX_SEARCH_PAGES = 3
+
+	def __init__(self, *args, **kwargs):
+		Source.__init__(self, *args, **kwargs)
+		self._bid_to_isbn_cache = {}
 	
 	def config_widget(self):
 		'''
 		Overriding the default configuration screen for our own custom configuration
 		'''
-		from calibre_plugins.databazeknih.config import ConfigWidget
+		from calibre_plugins.databazeknih.gui import ConfigWidget
 		return ConfigWidget(self)
+
+	@property
+	def session(self):
+		'''
+		Keep-alive connections shared by search, details, ISBN and covers
+		'''
+		from calibre_plugins.databazeknih.session import shared_session
+		return shared_session()
+
+	@property
+	def policy(self):
+		'''
+		The session with retries and hedged requests, used for every page
+		'''
+		from calibre_plugins.databazeknih.policy import shared_policy
+		return shared_policy()
+
+	def engine(self, log):
+		'''
+		The asyncio engine when it is selected in the options and can be
+		used, None to use the thread pool
+		'''
+		import calibre_plugins.databazeknih.config as cfg
+		if not cfg.get_option(cfg.KEY_ASYNCIO_ENGINE):
+			return None
+		if sys.version_info < (3, 7):
+			log.info('The asyncio engine needs Python 3.7 or newer, using threads')
+			return None
+		from calibre_plugins.databazeknih.aio import shared_engine
+		engine = shared_engine()
+		if engine is None:
+			log.info('The asyncio engine does not support proxies, using threads')
+		return engine
 		
 	def get_book_url(self, identifiers):
 		databazeknih_id = identifiers.get('databazeknih', None)
@@ -47,6 +84,10 @@ class databazeknih(Source):
 					databazeknih.BASE_URL + 'knihy/' + databazeknih_id)
 
 	def create_query(self, log, title=None, authors=None):
+		try:
+			from urllib2 import quote
+		except ImportError:
+			from urllib.parse import quote
 		if title is not None:
 			search_title = title.replace(' ', '+')
 		else:
@@ -58,10 +99,85 @@ class databazeknih(Source):
 			search_author = ' '
 
 #		search_page = 'http://moly.hu/kereses?q=%s+%s&x=0&y=0'%(search_author, search_title)
-		SP = 'http://www.databazeknih.cz/index.php?stranka=search&q={title}'
-		search_page = SP.format(title=urllib2.quote(search_title.encode('utf-8')))
+		SP = self.BASE_URL + 'index.php?stranka=search&q={title}'
+		search_page = SP.format(title=quote(search_title.encode('utf-8')))
 		return search_page
 
+	@property
+	def index(self):
+		'''
+		The lookups below kept across calibre restarts
+		'''
+		from calibre_plugins.databazeknih.index import shared_index
+		return shared_index()
+
+	def cache_bid_to_isbn(self, bid, isbn):
+		with self.cache_lock:
+			if self._bid_to_isbn_cache.get(bid, None) == isbn:
+				return
+			self._bid_to_isbn_cache[bid] = isbn
+		self.index.put('bid', bid, isbn)
+
+	def cached_bid_to_isbn(self, bid):
+		with self.cache_lock:
+			isbn = self._bid_to_isbn_cache.get(bid, None)
+		if isbn is None and bid:
+			isbn = self.index.get('bid', bid)
+			if isbn is not None:
+				with self.cache_lock:
+					self._bid_to_isbn_cache[bid] = isbn
+		return isbn
+
+	def cache_isbn_to_identifier(self, isbn, identifier):
+		isbn = check_isbn(isbn) or isbn
+		if Source.cached_isbn_to_identifier(self, isbn) == identifier:
+			return
+		Source.cache_isbn_to_identifier(self, isbn, identifier)
+		self.index.put('isbn', isbn, identifier)
+
+	def cached_isbn_to_identifier(self, isbn):
+		isbn = check_isbn(isbn) or isbn
+		if not isbn:
+			return None
+		identifier = Source.cached_isbn_to_identifier(self, isbn)
+		if identifier is None:
+			identifier = self.index.get('isbn', isbn)
+			if identifier is not None:
+				Source.cache_isbn_to_identifier(self, isbn, identifier)
+		return identifier
+
+	def cache_identifier_to_cover_url(self, id_, url):
+		if Source.cached_identifier_to_cover_url(self, id_) == url:
+			return
+		Source.cache_identifier_to_cover_url(self, id_, url)
+		self.index.put('cover', id_, url)
+
+	def cached_identifier_to_cover_url(self, id_):
+		url = Source.cached_identifier_to_cover_url(self, id_)
+		if url is None and id_:
+			url = self.index.get('cover', id_)
+			if url is not None:
+				Source.cache_identifier_to_cover_url(self, id_, url)
+		return url
+
+	def cache_search_page(self, url, page):
+		from calibre_plugins.databazeknih.cache import search_cache
+		cache = search_cache()
+		if cache is not None:
+			cache.put(url, page.hits, page.next)
+
+	def cached_search_page(self, log, url, recorder):
+		'''
+		The SearchPage of the URL, None when it has to be fetched
+		'''
+		from calibre_plugins.databazeknih.cache import search_cache
+		cache = search_cache()
+		page = cache.get(url) if cache is not None else None
+		if page is not None:
+			log.info('Using cached search results for: %s'%url)
+			recorder.count('cache.search_hits')
+		return page
+
 	def get_cached_cover_url(self, identifiers):
 		url = None
 		databazeknih_id = identifiers.get(u'databazeknih', None)
@@ -79,147 +195,412 @@ class databazeknih(Source):
 		Note this method will retry without identifiers automatically if no
 		match is found with identifiers.
 		'''
+		from calibre_plugins.databazeknih.instrument import Recorder, report
+		recorder = Recorder('identify')
+		try:
+			engine = self.engine(log)
+			if engine is not None:
+				return engine.identify(self, log, result_queue, abort, title,
+						authors, identifiers, timeout, recorder)
+			return self._identify(log, result_queue, abort, title, authors,
+					identifiers, timeout, recorder)
+		finally:
+			report(log, recorder)
+
+	def _identify(self, log, result_queue, abort, title, authors, identifiers,
+			timeout, recorder, budget=None):
+		from calibre_plugins.databazeknih.policy import Budget
+		# The retry without identifiers has what is left of the timeout
+		budget = budget if budget is not None else Budget.starting_now(timeout)
 		matches = []
 		databazeknih_id = identifiers.get('databazeknih', None)
 		log.info(u'\nTitl1e:%s\nAuthors:%s\n'%(title, authors))
-		br = browser()
+		if not databazeknih_id:
+			databazeknih_id = self.cached_isbn_to_identifier(identifiers.get('isbn', None))
+			if databazeknih_id:
+				log.info('Book with the ISBN known from before: %s'%databazeknih_id)
+				recorder.count('cache.index_hits')
+		br = self.session
+		from threading import Lock
+		from calibre_plugins.databazeknih.executor import (CancelToken,
+				TaskGroup, abort_watcher, shared_pool)
+		from calibre_plugins.databazeknih.worker import Worker
+		from calibre_plugins.databazeknih.scoring import same_book
+		group = TaskGroup(shared_pool())
+		isbn = check_isbn(identifiers.get('isbn', None))
+		# Cancelled to stop reading more search results
+		cancel = CancelToken()
+		lock = Lock()
+		workers = []
+
+		def found(worker, mi):
+			# The book asked for is found, the other candidates are not needed
+			if (isbn and (check_isbn(mi.isbn) == isbn or
+					self.cached_isbn_to_identifier(isbn) == worker.databazeknih_id)) or \
+					same_book(title, authors, mi.title, mi.authors):
+				with lock:
+					cancel.cancel()
+					others = [w for w in workers if w is not worker]
+				if others:
+					log.info('Exact match %r found, cancelling the other workers'%worker.url)
+				for w in others:
+					w.cancel.cancel()
+
+		def start(relevance, url):
+			# Candidates are downloaded while the next search page is read
+			with lock:
+				if cancel.is_set():
+					return
+				w = Worker(url, result_queue, self.policy, log, relevance, self,
+						timeout=timeout, identifiers=identifiers, group=group,
+						cancel=CancelToken(), on_result=found, recorder=recorder,
+						budget=budget)
+				workers.append(w)
+			log.debug('Starting worker for: %s'%url)
+			group.submit(w.run)
+
 		if databazeknih_id:
 			matches.append(databazeknih.BASE_URL + 'knihy/' + databazeknih_id)
+			start(0, matches[0])
 		else:
 			query = self.create_query(log, title=title, authors=authors)
 			if query is None:
 				log.error('Insufficient metadata to construct query')
 				return
-			try:
-				log.info(u'Querying: %s'%query)
-			
-				response = br.open(query)
-			except Exception as e:
-				isbn = check_isbn(identifiers.get('isbn', None))
-				if isbn and callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
-					log.info('Failed to find match for ISBN: %s'%isbn)
-				else:
-					err = 'Failed to make identify query: %r'%query
-					log.info(err)
-					return as_unicode(e)
-#					return e
-			try:
-				raw = response.read().strip()
-				raw = raw.decode('utf-8', errors='replace')
-				if not raw:
-					log.error('Failed to get raw result for query: %r'%query)
-					return
-				root = fromstring(clean_ascii_chars(raw))
-			except:
-				msg = 'Failed to parse databazeknih page for query: %r'%query
-				log.exception(msg)
-				return msg
-			
-			self._parse_search_results(log, title, authors, root, matches, timeout)
+			# Runs in the calling thread, the shared pool only gets the book
+			# pages and ISBN lookups. An abort cancels the token, which
+			# interrupts the request in flight right away.
+			with abort_watcher().linked(abort, cancel):
+				err = self.search(log, query, title, authors, identifiers, matches,
+						budget.phase('search'), cancel, recorder, start)
+			if err is not None:
+				return err
+		if not group.wait(abort):
+			with lock:
+				cancel.cancel()
+			for w in workers:
+				w.cancel.cancel()
+			return
 
 		if abort.is_set():
 			return
-		
+
 		if not matches:
 			if identifiers and title and authors:
 				log.info('No matches found with identifiers, retrying using only'
 						' title and authors')
-				return self.identify(log, result_queue, abort, title=title,
-						authors=authors, timeout=timeout)
+				return self._identify(log, result_queue, abort, title, authors,
+						{}, timeout, recorder, budget)
 			log.error('No matches found with query: %r'%query)
 			return
-			
-		log.debug('Starting workers for: %s' % (matches,))	
-		from calibre_plugins.databazeknih.worker import Worker
-		workers = [Worker(url, result_queue, br, log, i, self) for i, url in
-				enumerate(matches)]
 
-		for w in workers:
-			w.start()
-			time.sleep(0.1)
+		stats = br.snapshot()
+		log.info('Connections: %(connections_opened)d opened, %(connections_reused)d'
+				' reused for %(requests)d requests'%stats)
+		log.info('Transferred %d kB for %d kB of pages'%(stats['wire_bytes'] // 1024,
+				stats['body_bytes'] // 1024))
+		if br.throttle is not None:
+			log.info('Throttle: %(window).1f parallel requests allowed, %(waits)d'
+					' requests waited %(waited).1fs'%br.throttle.snapshot())
+		log.info('Requests: %(retries)d retried, %(hedges)d hedged, %(hedge_wins)d'
+				' hedges answered first'%self.policy.snapshot())
+		return None
+
+	def identify_many(self, log, books, result_queue, abort, timeout=30):
+		'''
+		Identify many books in one pass, e.g. for a whole library. books is
+		an iterable of (title, authors, identifiers) tuples. Every distinct
+		search and book page is fetched only once for the whole batch.
 
-		while not abort.is_set():
-			a_worker_is_alive = False
-			for w in workers:
-				w.join(0.2)
-				if abort.is_set():
-					break
-				if w.is_alive():
-					a_worker_is_alive = True
-			if not a_worker_is_alive:
-				break
+		result_queue receives (index, Metadata) for every match as soon as
+		it is ready and (index, None) once the book at index is done.
+		Returns False when aborted.
+		'''
+		engine = self.engine(log)
+		if engine is not None:
+			from calibre_plugins.databazeknih.instrument import Recorder, report
+			recorder = Recorder('identify_many')
+			try:
+				return engine.identify_many(self, log, books, result_queue, abort,
+						timeout, recorder)
+			finally:
+				report(log, recorder)
+		from calibre_plugins.databazeknih.batch import Batch
+		return Batch(self, log, result_queue, abort, timeout).run(books)
 
+	def search(self, log, query, title, authors, identifiers, matches, timeout=30,
+			cancel=None, recorder=None, on_match=None):
+		'''
+		Run the search query and append the URLs of the matching books to
+		matches, on_match(relevance, url) is called for each as soon as it is
+		found. Returns an error message when the search failed.
+		'''
+		from calibre_plugins.databazeknih.executor import Cancelled
+		from calibre_plugins.databazeknih.instrument import Recorder
+		recorder = recorder if recorder is not None else Recorder('search')
+		try:
+			for candidate in self.candidates(log, query, title, authors, timeout,
+					cancel, recorder):
+				matches.append(candidate.url)
+				if on_match is not None:
+					on_match(len(matches) - 1, candidate.url)
+		except Cancelled:
+			return None
+		except Exception as e:
+			if matches:
+				log.exception('Failed to read more results for query: %r'%query)
+				return None
+			log.exception('Failed to make identify query: %r'%query)
+			return as_unicode(e)
 		return None
-	def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
-		log.info('Parse')
-		results = root.xpath('//*[@class="new_search"]')
-		results.sort()
+
+	def candidates(self, log, query, title, authors, timeout=30, cancel=None,
+			recorder=None):
+		'''
+		Ranked candidates of the search, the best of every page of results
+		first. The next page is fetched only when more candidates are asked
+		for than the pages before had. Stops after KEY_MAX_DOWNLOADS
+		candidates, an exact match or MAX_SEARCH_PAGES pages.
+		'''
+		from calibre_plugins.databazeknih.instrument import Recorder
+		from calibre_plugins.databazeknih.scoring import Candidates
 		import calibre_plugins.databazeknih.config as cfg
-#		max_results = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_MAX_DOWNLOADS]
-		max_results = 10
-		i = 0
-		for result in results:
-            title = results[i].xpath('a//text()')
-			log.info('kniha: %s'%title)
-			log.info('orig.autor: %s'%orig_authors)
-			product = results[i].xpath('span[@class="smallfind"]//text()')
-			product = product[0]
-			product = product.split()
-			prijmeni = product[len(product)-1]
-			if prijmeni == '(pseudonym)':
-				prijmeni = product[len(product)-2]
-			log.info('produkt:%s<<'%prijmeni)
-			vlozit = False
-#			log.info('data %s'%data)
-# ***************************************************
-            if orig_authors:
-                for o_jmena in orig_authors:
-				    log.info('ojmena: %s'%o_jmena)
-    				os_jmena = o_jmena.lower().split()
-	    			log.info('osjmena0 :%s<<'%os_jmena[0])
-		    		#log.info('osjmena1 :%s<<'%os_jmena[1])
-			    	if prijmeni.lower() in os_jmena:
-				    	log.info('ano')
-					    vlozit=True
-			book_url = results[i].xpath('a/@href')
-			log.info('Book URL:%r'%book_url)
-			result_url = 'http://www.databazeknih.cz/' + book_url[0]
-			log.info('Result URL:%r'%result_url)
-			i = i+1
-			if vlozit:
-				matches.append(result_url)
-			if len(matches) >= max_results:
-				break
+		recorder = recorder if recorder is not None else Recorder('search')
+		ranking = Candidates(title, authors, cfg.get_option(cfg.KEY_MAX_DOWNLOADS))
+		url, number, seen = query, 1, set()
+		while url is not None and ranking.wanted and number <= self.MAX_SEARCH_PAGES:
+			page = self.search_page(log, url, timeout, cancel, recorder)
+			if page is None:
+				return
+			for candidate in self.rank_search_page(log, ranking, number, page, recorder):
+				if self.seen_before(log, seen, candidate):
+					continue
+				yield candidate
+			url, number = page.next, number + 1
+
+	def seen_before(self, log, seen, candidate):
+		'''
+		Whether another spelling of the URL of the candidate is in seen, adds
+		it otherwise. The same book page is downloaded once per search.
+		'''
+		from calibre_plugins.databazeknih.session import canonical_url
+		url = canonical_url(candidate.url)
+		if url in seen:
+			log.info('Duplicate candidate: %s'%candidate.url)
+			return True
+		seen.add(url)
+		return False
+
+	def rank_search_page(self, log, ranking, number, page, recorder):
+		'''
+		The new candidates of the search page, ranked by the Candidates
+		'''
+		with recorder.span('search.rank'):
+			ranked = ranking.add(page.hits)
+		log.info('Search results page %d: %d, candidates: %d'%(number,
+			len(page.hits), len(ranked)))
+		for candidate in ranked:
+			log.info('Candidate %.2f%s: %s (%s) %s'%(candidate.score,
+				' exact' if candidate.exact else '', candidate.title,
+				', '.join(candidate.authors), candidate.url))
+		return ranked
+
+	def search_page(self, log, url, timeout=30, cancel=None, recorder=None):
+		'''
+		One page of search results as a SearchPage, from the search cache
+		when it has it. A page answered with 404 has no hits, None is returned
+		for an empty page. Identify calls asking for a page already being
+		downloaded get the page of that download.
+		'''
+		from calibre_plugins.databazeknih.executor import shared_flights
+		from calibre_plugins.databazeknih.session import canonical_url
+		page = self.cached_search_page(log, url, recorder)
+		if page is not None:
+			return page
+		return shared_flights().run(('search', canonical_url(url)),
+				lambda: self.fetch_search_page(log, url, timeout, cancel, recorder),
+				cancel, recorder)
+
+	def fetch_search_page(self, log, url, timeout, cancel, recorder):
+		from calibre_plugins.databazeknih.cache import SearchPage
+		from calibre_plugins.databazeknih.executor import Cancelled, document_limit
+		from calibre_plugins.databazeknih.extract import (parse_html,
+				search_hits, search_next_page)
+		started = time.time()
+		try:
+			log.info(u'Querying: %s'%url)
+			response = self.policy.open(url, timeout=timeout, cancel=cancel,
+					recorder=recorder)
+		except Cancelled:
+			raise
+		except Exception as e:
+			if not callable(getattr(e, 'getcode', None)) or e.getcode() != 404:
+				recorder.count('errors')
+				recorder.count('search.fetch.errors')
+				raise
+			# Nothing found, not asked again while the entry is kept
+			response = None
+		finally:
+			recorder.add_span('search.fetch', time.time() - started)
+		page = SearchPage([], None)
+		if response is not None:
+			try:
+				with document_limit().slot(cancel, recorder), \
+						recorder.span('search.parse'):
+					root = parse_html(response)
+					if root is None:
+						log.error('Failed to get raw result for query: %r'%url)
+						return None
+					page = SearchPage(search_hits(root, self.BASE_URL),
+							search_next_page(root, url))
+					del root
+				log.info('Search page: %s'%response.transferred())
+			finally:
+				response.close()
+				recorder.add_response(response)
+		self.cache_search_page(url, page)
+		return page
+
+	def cli_main(self, args):
+		'''
+		calibre-debug -r Databazeknih -- stats|export FILE|import FILE|evict [MAX]|prefetch FILE [PAGES_PER_S]
+
+		prefetch fills the caches for the books listed in FILE, the JSON of
+		calibredb list --fields title,authors,identifiers --for-machine or a
+		CSV catalog. It continues where an interrupted prefetch stopped.
+		'''
+		from calibre_plugins.databazeknih.index import main
+		main(args[1:], self)
+
 	def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
-		cached_url = self.get_cached_cover_url(identifiers)
-		if cached_url is None:
-			log.info('No cached cover found, running identify')
-			rq = Queue()
-			self.identify(log, rq, abort, title=title, authors=authors, identifiers=identifiers)
-			if abort.is_set():
+		'''
+		Covers need neither the book details nor the ISBN. The cover is taken
+		from the cover cache, else its URL from the URL cache, the book page
+		or the thumbnail of the best search result.
+		'''
+		from calibre_plugins.databazeknih.instrument import Recorder, report
+		recorder = Recorder('download_cover')
+		try:
+			self._download_cover(log, result_queue, abort, title, authors,
+					identifiers, timeout, recorder)
+		finally:
+			report(log, recorder)
+
+	def _download_cover(self, log, result_queue, abort, title, authors,
+			identifiers, timeout, recorder):
+		from calibre_plugins.databazeknih.cache import cover_cache
+		from calibre_plugins.databazeknih.executor import shared_flights
+		from calibre_plugins.databazeknih.policy import Budget
+		from calibre_plugins.databazeknih.session import canonical_url
+		budget = Budget.starting_now(timeout)
+		databazeknih_id = identifiers.get(u'databazeknih', None)
+		if databazeknih_id is None:
+			isbn = check_isbn(identifiers.get(u'isbn', None))
+			if isbn is not None:
+				databazeknih_id = self.cached_isbn_to_identifier(isbn)
+		cache = cover_cache()
+		if self.cached_cover(log, result_queue, databazeknih_id, recorder):
+			return
+
+		try:
+			with recorder.span('cover.find'):
+				found_id, urls = self._find_cover_urls(log, databazeknih_id,
+						title, authors, identifiers, budget, recorder)
+		except:
+			log.exception('Failed to find the cover URL')
+			return
+		if found_id != databazeknih_id:
+			# Found by the search, the cover may be cached all the same
+			databazeknih_id = found_id
+			if self.cached_cover(log, result_queue, databazeknih_id, recorder):
 				return
-			results = []
-			while True:
-				try:
-					results.append(rq.get_nowait())
-				except Empty:
-					break
-			results.sort(key=self.identify_results_keygen(
-				title=title, authors=authors, identifiers=identifiers))
-			for mi in results:
-				cached_url = self.get_cached_cover_url(mi.identifiers)
-				if cached_url is not None:
-					break
-		if cached_url is None:
+		if not urls:
 			log.info('No cover found')
 			return
 
-		if abort.is_set():
+		for url in urls:
+			if abort.is_set():
+				return
+			log.info('Downloading cover from:', url)
+			started = time.time()
+			try:
+				# A cover being downloaded for another call is not asked for again
+				cdata = shared_flights().run(('cover', canonical_url(url)),
+						lambda: self.fetch_cover(log, url, budget.phase('cover'),
+							recorder), recorder=recorder)
+			except Exception as e:
+				if callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
+					continue
+				recorder.count('errors')
+				recorder.count('cover.fetch.errors')
+				log.exception('Failed to download cover from:', url)
+				return
+			finally:
+				recorder.add_span('cover.fetch', time.time() - started)
+			if databazeknih_id is not None:
+				self.cache_identifier_to_cover_url(databazeknih_id, url)
+				if cache is not None:
+					cache.put(databazeknih_id, url, cdata)
+			result_queue.put((self, cdata))
 			return
-		br = self.browser
-		log.info('Downloading cover from:', cached_url)
+		log.info('No cover found at:', urls)
+
+	def fetch_cover(self, log, url, timeout, recorder):
+		response = self.policy.open(url, timeout=timeout, recorder=recorder)
+		cdata = response.read()
+		log.info('Cover: %s'%response.transferred())
+		recorder.add_response(response)
+		return cdata
+
+	def cached_cover(self, log, result_queue, databazeknih_id, recorder):
+		'''
+		Put the cover of the book from the cover cache into result_queue,
+		False when it is not there
+		'''
+		from calibre_plugins.databazeknih.cache import cover_cache
+		cache = cover_cache()
+		if databazeknih_id is None or cache is None:
+			return False
+		cached = cache.get(databazeknih_id)
+		if cached is None:
+			return False
+		log.info('Using cached cover of:', databazeknih_id)
+		recorder.count('cache.cover_hits')
+		result_queue.put((self, cached[0]))
+		return True
+
+	def _find_cover_urls(self, log, databazeknih_id, title, authors, identifiers,
+			budget, recorder):
+		'''
+		The databazeknih id and the URLs to try for the cover, large first
+		'''
+		from calibre_plugins.databazeknih.extract import cover_urls, stream_cover
+		url = self.get_cached_cover_url(identifiers)
+		if url is not None:
+			recorder.count('cache.cover_url_hits')
+			return databazeknih_id, cover_urls(url, self.BASE_URL)
+		if databazeknih_id is None:
+			from calibre_plugins.databazeknih.scoring import rank
+			query = self.create_query(log, title=title, authors=authors)
+			page = self.search_page(log, query, budget.phase('search'),
+					recorder=recorder)
+			if page is None:
+				return None, []
+			hits = page.hits
+			candidates = rank(hits, title, authors, 1)
+			if not candidates:
+				return None, []
+			databazeknih_id = candidates[0].url.rpartition('/knihy/')[2]
+			thumbnail = [hit['cover'] for hit in hits if hit['url'] == candidates[0].url][0]
+			if thumbnail:
+				log.info('Cover from search result:', thumbnail)
+				return databazeknih_id, cover_urls(thumbnail, self.BASE_URL)
+		response = self.policy.open(self.BASE_URL + 'knihy/' + databazeknih_id,
+				timeout=budget.phase('detail'), recorder=recorder)
 		try:
-			cdata = br.open_novisit(cached_url, timeout=timeout).read()
-			result_queue.put((self, cdata))
-		except:
-			log.exception('Failed to download cover from:', cached_url)
+			src = stream_cover(response)
+			log.info('Book page: %s'%response.transferred())
+		finally:
+			response.close()
+			recorder.add_response(response)
+		return databazeknih_id, cover_urls(src, self.BASE_URL)
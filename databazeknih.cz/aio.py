@@ -0,0 +1,823 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+# Python 3.7 and newer only (calibre 5 and newer), it uses async
+# comprehensions and concurrent.futures.BrokenExecutor. Imported only when
+# the asyncio engine is selected.
+
+import asyncio, concurrent.futures, socket, ssl, threading, time
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from lxml import html
+from calibre_plugins.databazeknih.cache import SearchPage
+from calibre_plugins.databazeknih.executor import ABORT_CHECK_INTERVAL
+from calibre_plugins.databazeknih.extract import (STREAM_CHUNK,
+		extract_fields, isbn_nodes, parse_fields, search_hits, search_next_page)
+from calibre_plugins.databazeknih.processes import shared_parse_pool
+from calibre_plugins.databazeknih.session import (ACCEPT_ENCODING,
+		IDLE_TIMEOUT, MAX_OVERLOAD_RETRIES, MAX_REDIRECTS, canonical_url, decoder,
+		quote_url)
+from calibre_plugins.databazeknih.throttle import OVERLOAD_STATUSES, Throttle
+
+# Threads running the SQLite lookups of the caches, which would block the loop
+CACHE_THREADS = 2
+
+_lock = threading.Lock()
+_engine = None
+_ssl_context = None
+
+
+def ssl_context():
+	global _ssl_context
+	if _ssl_context is None:
+		_ssl_context = ssl.create_default_context()
+	return _ssl_context
+
+
+async def read_head(reader):
+	'''
+	Status line and headers of a response, header names in lower case
+	'''
+	line = await reader.readline()
+	if not line:
+		raise asyncio.IncompleteReadError(b'', None)
+	version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		name, _, value = line.decode('latin-1').partition(':')
+		name, value = name.strip().lower(), value.strip()
+		headers[name] = headers[name] + ', ' + value if name in headers else value
+	return version, int(status), reason, headers
+
+
+async def parse_page(response):
+	'''
+	Feed the page to lxml chunk by chunk as it arrives. Returns None for
+	an empty page.
+	'''
+	parser = html.HTMLParser(encoding='utf-8')
+	fed = False
+	try:
+		while True:
+			chunk = await response.read(STREAM_CHUNK)
+			if not chunk:
+				break
+			parser.feed(chunk)
+			fed = fed or bool(chunk.strip())
+	finally:
+		response.close()
+	return parser.close() if fed else None
+
+
+class Connection(object):
+
+	def __init__(self, key, reader, writer):
+		self.key, self.reader, self.writer = key, reader, writer
+		self.since = time.time()
+
+	def close(self):
+		self.writer.close()
+
+
+class AsyncResponse(object):
+	'''
+	A response of the engine, the connection returns to the pool once the
+	body is read. Compressed bodies are decompressed while they are read,
+	with the same counters as session.Response.
+	'''
+
+	def __init__(self, engine, conn, url, version, status, reason, headers, timeout):
+		self.engine, self.conn, self.url = engine, conn, url
+		self.code, self.reason, self.headers = status, reason, headers
+		self.timeout = timeout
+		self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+		self.remaining = None
+		if status in (204, 304) or 100 <= status < 200:
+			self.chunked, self.remaining = False, 0
+		elif not self.chunked and 'content-length' in headers:
+			self.remaining = int(headers['content-length'])
+		connection = headers.get('connection', '').lower()
+		self.will_close = 'close' in connection or (version == 'HTTP/1.0' and
+				'keep-alive' not in connection) or (not self.chunked and
+				self.remaining is None)
+		self.chunk_left = 0
+		self.decoder = decoder(self)
+		self.pending = b''
+		self.wire_bytes = self.body_bytes = 0
+		if self.remaining == 0:
+			self.release()
+
+	def getheader(self, name, default=None):
+		return self.headers.get(name.lower(), default)
+
+	def getcode(self):
+		return self.code
+
+	def transferred(self):
+		'''
+		Size of the body read so far, for the log
+		'''
+		if self.decoder is None:
+			return '%d bytes'%self.body_bytes
+		return '%d bytes, %d compressed'%(self.body_bytes, self.wire_bytes)
+
+	async def read(self, size=-1):
+		'''
+		Read at most size bytes of the decompressed body, all of it when
+		size is negative
+		'''
+		whole = size is None or size < 0
+		while (whole or len(self.pending) < size) and self.conn is not None:
+			data = await self.read_raw(STREAM_CHUNK if whole else size)
+			self.pending += self.decoder.decode(data) if self.decoder is not None else data
+			if self.conn is None and self.decoder is not None:
+				self.pending += self.decoder.flush()
+		if whole:
+			data, self.pending = self.pending, b''
+		else:
+			data, self.pending = self.pending[:size], self.pending[size:]
+		self.body_bytes += len(data)
+		self.engine.count('body_bytes', len(data))
+		return data
+
+	async def read_raw(self, size):
+		if self.conn is None:
+			return b''
+		try:
+			data = await asyncio.wait_for(self.read_framed(size), self.timeout)
+		except asyncio.TimeoutError:
+			self.close()
+			raise socket.timeout('timed out')
+		except:
+			self.close()
+			raise
+		self.wire_bytes += len(data)
+		self.engine.count('wire_bytes', len(data))
+		if not data or self.remaining == 0:
+			self.release()
+		return data
+
+	async def read_framed(self, size):
+		'''
+		The next part of the body as sent, b'' at its end
+		'''
+		reader = self.conn.reader
+		if self.chunked:
+			if self.chunk_left == 0:
+				line = await reader.readline()
+				self.chunk_left = int(line.split(b';')[0].strip() or b'0', 16)
+				if self.chunk_left == 0:
+					while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+						pass
+					return b''
+			data = await reader.read(min(size, self.chunk_left))
+			if not data:
+				raise asyncio.IncompleteReadError(b'', self.chunk_left)
+			self.chunk_left -= len(data)
+			if self.chunk_left == 0:
+				await reader.readexactly(2)
+			return data
+		if self.remaining is not None:
+			data = await reader.read(min(size, self.remaining))
+			if not data:
+				raise asyncio.IncompleteReadError(b'', self.remaining)
+			self.remaining -= len(data)
+			return data
+		return await reader.read(size)
+
+	def release(self):
+		'''
+		Give the connection back to the pool, the body was read completely
+		'''
+		if self.conn is not None:
+			conn, self.conn = self.conn, None
+			self.engine.checkin(conn, not self.will_close)
+
+	def close(self):
+		'''
+		Stop reading. A connection with unread body cannot be reused.
+		'''
+		if self.conn is not None:
+			conn, self.conn = self.conn, None
+			self.engine.checkin(conn, False)
+
+
+class Engine(object):
+	'''
+	Runs the search, detail and ISBN requests of identify and
+	identify_many as coroutines on one event loop in a background thread.
+	The throttle window bounds the requests in flight, lookups waiting for
+	their turn cost no thread. Pass the ``throttle`` of the session, so that
+	the requests of the thread workers and of the engine count against the
+	same limits. The caches are read and written on CACHE_THREADS threads.
+
+	Connections are kept alive like in session.Session, but they belong to
+	the loop of the engine and are not shared with the thread workers.
+	'''
+
+	def __init__(self, headers=None, max_per_host=4, rate=8, throttle=None):
+		self.headers = dict(headers or {})
+		self.throttle = throttle if throttle is not None else Throttle(rate, max_per_host)
+		self.throttle.watch(self.wake)
+		self.cache_executor = concurrent.futures.ThreadPoolExecutor(CACHE_THREADS,
+				'databazeknih-cache')
+		self.idle = {}
+		self.stats = {'requests': 0, 'connections_opened': 0,
+				'connections_reused': 0, 'stale_retries': 0, 'overload_retries': 0,
+				'wire_bytes': 0, 'body_bytes': 0}
+		self.loop = asyncio.new_event_loop()
+		self.freed = None
+		# Calls in flight by key, see shared()
+		self.flights = {}
+		started = threading.Event()
+		self.thread = threading.Thread(target=self.run_loop, args=(started,),
+				name='databazeknih-asyncio')
+		self.thread.daemon = True
+		self.thread.start()
+		started.wait()
+
+	def run_loop(self, started):
+		asyncio.set_event_loop(self.loop)
+		# Set whenever a request finishes, wakes the requests waiting for
+		# the throttle window
+		self.freed = asyncio.Event()
+		started.set()
+		self.loop.run_forever()
+
+	def wake(self):
+		'''
+		A request finished or the rate changed, in any thread
+		'''
+		if self.freed is not None:
+			self.loop.call_soon_threadsafe(self.freed.set)
+
+	async def blocking(self, fn, *args):
+		'''
+		fn(*args) run on the cache threads
+		'''
+		return await self.loop.run_in_executor(self.cache_executor, fn, *args)
+
+	def count(self, name, value=1):
+		self.stats[name] += value
+
+	def snapshot(self):
+		return dict(self.stats)
+
+	def run(self, coro, abort):
+		'''
+		Run the coroutine on the loop and wait for it. Returns (True, its
+		result), or (False, None) when calibre asked to abort, the
+		coroutine is cancelled then.
+		'''
+		future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+		while not future.done():
+			concurrent.futures.wait([future], ABORT_CHECK_INTERVAL)
+			if abort is not None and abort.is_set() and not future.done():
+				future.cancel()
+				return False, None
+		return True, future.result()
+
+	async def acquire(self, timeout):
+		'''
+		Wait for the throttle to allow a request
+		'''
+		throttle = self.throttle
+		start = time.time()
+		deadline = start + timeout
+		while True:
+			now = time.time()
+			with throttle.cond:
+				wait = throttle.turn(now, start)
+				if wait == 0:
+					return
+				if throttle.expired(now, deadline):
+					raise socket.timeout('Too many requests to databazeknih.cz')
+			remaining = deadline - now
+			wait = remaining if wait is None else min(wait, remaining)
+			self.freed.clear()
+			try:
+				await asyncio.wait_for(self.freed.wait(), wait)
+			except asyncio.TimeoutError:
+				pass
+
+	async def checkout(self, key, timeout):
+		now = time.time()
+		idle = self.idle.get(key, [])
+		while idle:
+			conn = idle.pop()
+			if now - conn.since < IDLE_TIMEOUT and not conn.reader.at_eof():
+				self.stats['connections_reused'] += 1
+				return conn, True
+			conn.close()
+		self.stats['connections_opened'] += 1
+		scheme, host, port = key
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port,
+			ssl=ssl_context() if scheme == 'https' else None), timeout)
+		return Connection(key, reader, writer), False
+
+	def checkin(self, conn, reusable):
+		if reusable:
+			conn.since = time.time()
+			self.idle.setdefault(conn.key, []).append(conn)
+		else:
+			conn.close()
+		self.throttle.release()
+		self.freed.set()
+
+	def close(self):
+		'''
+		Close the idle connections
+		'''
+		def close_idle():
+			idle, self.idle = self.idle, {}
+			for conns in idle.values():
+				for conn in conns:
+					conn.close()
+		self.loop.call_soon_threadsafe(close_idle)
+
+	async def shared(self, key, make, recorder):
+		'''
+		The result of the coroutine make() for the key, like
+		executor.SingleFlight: coroutines asking for a key in flight wait
+		for the same task. A cancelled coroutine only stops waiting, the
+		task is cancelled when nobody waits for it anymore.
+		'''
+		flight = self.flights.get(key)
+		if flight is None:
+			flight = self.flights[key] = [asyncio.ensure_future(make()), 0]
+			flight[0].add_done_callback(lambda task: self.landed(key, flight))
+		else:
+			recorder.count('coalesced')
+		flight[1] += 1
+		try:
+			return await asyncio.shield(flight[0])
+		finally:
+			flight[1] -= 1
+			if not flight[1] and not flight[0].done():
+				self.landed(key, flight)
+				flight[0].cancel()
+
+	def landed(self, key, flight):
+		if self.flights.get(key) is flight:
+			del self.flights[key]
+
+	async def open(self, url, timeout=30, headers=None):
+		'''
+		GET the url following redirects, like session.Session.open. Raises
+		HTTPError for error statuses and for 304 Not Modified.
+		'''
+		redirects = retries = 0
+		while True:
+			response = await self.request(url, timeout, headers)
+			if response.code in (301, 302, 303, 307, 308) and redirects < MAX_REDIRECTS:
+				location = response.getheader('Location')
+				await response.read()
+				if not location:
+					break
+				url = urljoin(url, location)
+				redirects += 1
+				continue
+			if response.code in OVERLOAD_STATUSES and retries < MAX_OVERLOAD_RETRIES:
+				await response.read()
+				retries += 1
+				self.count('overload_retries')
+				continue
+			break
+		if response.code >= 300:
+			body = await response.read()
+			raise HTTPError(url, response.code, response.reason, response.headers,
+					BytesIO(body))
+		return response
+
+	async def request(self, url, timeout, headers=None):
+		url = quote_url(url)
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.hostname,
+				parts.port or (443 if parts.scheme == 'https' else 80))
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		all_headers = {'Accept-Encoding': ACCEPT_ENCODING}
+		all_headers.update(self.headers)
+		all_headers.update(headers or {})
+		all_headers['Host'] = parts.netloc
+		head = ['GET %s HTTP/1.1'%path] + ['%s: %s'%item for item in all_headers.items()]
+		head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+		self.count('requests')
+		while True:
+			await self.acquire(timeout)
+			try:
+				conn, reused = await self.checkout(key, timeout)
+			except:
+				self.throttle.release()
+				self.freed.set()
+				raise
+			started = time.time()
+			try:
+				conn.writer.write(head)
+				await asyncio.wait_for(conn.writer.drain(), timeout)
+				version, status, reason, response_headers = await asyncio.wait_for(
+						read_head(conn.reader), timeout)
+			except asyncio.CancelledError:
+				self.checkin(conn, False)
+				raise
+			except Exception as e:
+				self.checkin(conn, False)
+				if isinstance(e, asyncio.TimeoutError):
+					self.throttle.observe(started, timed_out=True)
+					raise socket.timeout('timed out')
+				if reused and isinstance(e, (OSError, asyncio.IncompleteReadError)):
+					# The server closed the idle connection meanwhile
+					self.count('stale_retries')
+					continue
+				raise
+			self.throttle.observe(started, status, response_headers.get('retry-after'))
+			return AsyncResponse(self, conn, url, version, status, reason,
+					response_headers, timeout)
+
+	async def search_page(self, plugin, log, url, timeout, recorder):
+		'''
+		One page of search results like databazeknih.search_page
+		'''
+		page = await self.blocking(plugin.cached_search_page, log, url, recorder)
+		if page is not None:
+			return page
+		log.info('Querying: %s'%url)
+		started = time.time()
+		try:
+			response = await self.open(url, timeout)
+		except HTTPError as e:
+			if e.code != 404:
+				raise
+			# Nothing found, not asked again while the entry is kept
+			response = None
+		finally:
+			recorder.add_span('search.fetch', time.time() - started)
+		page = SearchPage([], None)
+		if response is not None:
+			try:
+				with recorder.span('search.parse'):
+					root = await parse_page(response)
+			finally:
+				recorder.add_response(response)
+			log.info('Search page: %s'%response.transferred())
+			if root is None:
+				log.error('Failed to get raw result for query: %r'%url)
+				return None
+			page = SearchPage(search_hits(root, plugin.BASE_URL),
+					search_next_page(root, url))
+		await self.blocking(plugin.cache_search_page, url, page)
+		return page
+
+	async def candidates(self, plugin, log, query, title, authors, timeout, recorder):
+		'''
+		Ranked candidates of the search like databazeknih.candidates, the
+		next page is fetched only when more are asked for
+		'''
+		import calibre_plugins.databazeknih.config as cfg
+		from calibre_plugins.databazeknih.scoring import Candidates
+		ranking = Candidates(title, authors, cfg.get_option(cfg.KEY_MAX_DOWNLOADS))
+		url, number, seen = query, 1, set()
+		while url is not None and ranking.wanted and number <= plugin.MAX_SEARCH_PAGES:
+			page = await self.shared(('search', canonical_url(url)),
+					lambda: self.search_page(plugin, log, url, timeout, recorder),
+					recorder)
+			if page is None:
+				return
+			for candidate in plugin.rank_search_page(log, ranking, number, page, recorder):
+				if plugin.seen_before(log, seen, candidate):
+					continue
+				yield candidate
+			url, number = page.next, number + 1
+
+	async def search(self, plugin, log, query, title, authors, timeout, recorder):
+		'''
+		URLs of all candidates of the search query
+		'''
+		return [candidate.url async for candidate in self.candidates(plugin, log,
+			query, title, authors, timeout, recorder)]
+
+	async def details(self, plugin, log, url, timeout, recorder):
+		'''
+		Fields of the book page, from the details cache while they are
+		fresh. None when the page lacks the title or authors.
+		'''
+		from calibre_plugins.databazeknih.cache import details_cache
+		databazeknih_id = url.rpartition('/knihy/')[2]
+		cache = await self.blocking(details_cache)
+		entry = await self.blocking(cache.get, databazeknih_id) if cache is not None else None
+		if entry is not None and entry.fresh:
+			log.info('Using cached details for: %s'%databazeknih_id)
+			recorder.count('cache.details_hits')
+			return entry.fields
+		if cache is not None:
+			recorder.count('cache.details_misses')
+		headers = {}
+		if entry is not None:
+			if entry.etag:
+				headers['If-None-Match'] = entry.etag
+			if entry.last_modified:
+				headers['If-Modified-Since'] = entry.last_modified
+		started = time.time()
+		try:
+			response = await self.open(url, timeout, headers)
+		except HTTPError as e:
+			if entry is not None and e.code == 304:
+				log.info('Cached details still valid for: %s'%databazeknih_id)
+				recorder.count('cache.details_revalidated')
+				await self.blocking(cache.refresh, databazeknih_id)
+				return entry.fields
+			raise
+		finally:
+			recorder.add_span('detail.fetch', time.time() - started)
+		pool = shared_parse_pool(plugin)
+		root = values = None
+		try:
+			if pool is not None:
+				values = await self.parse_in_process(pool, response, recorder)
+			else:
+				with recorder.span('detail.parse'):
+					root = await parse_page(response)
+		finally:
+			recorder.add_response(response)
+		log.info('Read %s of the page'%response.transferred())
+		if root is None and values is None:
+			log.error('Empty book page: %r'%url)
+			return None
+		with recorder.span('detail.extract'):
+			if values is not None:
+				fields = parse_fields(values, plugin.BASE_URL, recorder)
+			else:
+				fields = extract_fields(root, plugin.BASE_URL, recorder)
+		if not fields['title'] or not fields['authors']:
+			log.error('Could not find title/authors/databazeknih id for %r'%url)
+			return None
+		if cache is not None:
+			await self.blocking(cache.put, databazeknih_id, fields,
+					response.getheader('ETag'), response.getheader('Last-Modified'))
+		return fields
+
+	async def parse_in_process(self, pool, response, recorder):
+		'''
+		Raw values of the book details, the whole page is parsed by the
+		parse processes while the loop goes on
+		'''
+		with recorder.span('detail.read'):
+			try:
+				data = await response.read()
+			finally:
+				response.close()
+		with recorder.span('detail.parse'):
+			try:
+				return await asyncio.wrap_future(pool.submit(data))
+			except concurrent.futures.BrokenExecutor:
+				return pool.parse(data)
+
+	async def isbn(self, plugin, log, bid, timeout, recorder):
+		url = plugin.BASE_URL + 'helpful/ajax/more_binfo.php?bid=' + bid
+		log.info('More info: %s'%url)
+		with recorder.span('isbn.fetch'):
+			response = await self.open(url, timeout)
+			try:
+				root = await parse_page(response)
+			finally:
+				recorder.add_response(response)
+		nodes = isbn_nodes(root) if root is not None else []
+		if nodes:
+			log.info('ISBN : %s'%nodes[0])
+			return nodes[0].strip() or None
+		return None
+
+	async def book(self, plugin, log, url, identifiers, timeout, recorder):
+		'''
+		Fields of the book page including the ISBN, unless it is not needed
+		'''
+		import calibre_plugins.databazeknih.config as cfg
+		from calibre.ebooks.metadata import check_isbn
+		fields = await self.shared(('details', canonical_url(url)),
+				lambda: self.details(plugin, log, url, timeout, recorder), recorder)
+		if fields is None:
+			return None
+		databazeknih_id = url.rpartition('/knihy/')[2]
+		if fields.get('cover_url'):
+			await self.blocking(plugin.cache_identifier_to_cover_url, databazeknih_id,
+					fields['cover_url'])
+		bid = fields.get('bid')
+		if fields.get('isbn') or not bid or not cfg.get_option(cfg.KEY_ISBN_LOOKUP) \
+				or check_isbn(identifiers.get('isbn', None)):
+			if fields.get('isbn'):
+				await self.blocking(plugin.cache_isbn_to_identifier, fields['isbn'],
+						databazeknih_id)
+			return fields
+		isbn = await self.blocking(plugin.cached_bid_to_isbn, bid)
+		if isbn:
+			recorder.count('cache.isbn_hits')
+		else:
+			isbn = await self.shared(('isbn', canonical_url(plugin.BASE_URL +
+				'helpful/ajax/more_binfo.php?bid=' + bid)),
+				lambda: self.isbn(plugin, log, bid, timeout, recorder), recorder)
+			if isbn:
+				from calibre_plugins.databazeknih.cache import details_cache
+				await self.blocking(plugin.cache_bid_to_isbn, bid, isbn)
+				cache = await self.blocking(details_cache)
+				if cache is not None:
+					await self.blocking(cache.update, databazeknih_id, {'isbn': isbn})
+		if isbn:
+			await self.blocking(plugin.cache_isbn_to_identifier, isbn, databazeknih_id)
+			fields = dict(fields, isbn=isbn)
+		return fields
+
+	async def fetch_book(self, plugin, log, url, identifiers, timeout, recorder):
+		'''
+		book() logging the errors instead of raising them
+		'''
+		try:
+			return await self.book(plugin, log, url, identifiers, timeout, recorder)
+		except asyncio.CancelledError:
+			raise
+		except HTTPError as e:
+			if e.code == 404:
+				log.error('URL malformed: %r'%url)
+				return None
+			recorder.count('errors')
+			log.exception('Failed to make details query: %r'%url)
+		except socket.timeout:
+			recorder.count('errors')
+			log.error('Databazeknih timed out. Try again later.')
+		except Exception:
+			recorder.count('errors')
+			log.exception('Failed to make details query: %r'%url)
+		return None
+
+	async def find(self, plugin, log, result_queue, title, authors, identifiers,
+			timeout, recorder):
+		'''
+		The coroutine of identify, returns an error message or None
+		'''
+		from calibre import as_unicode
+		from calibre.ebooks.metadata import check_isbn
+		from calibre_plugins.databazeknih.scoring import same_book
+		from calibre_plugins.databazeknih.worker import to_metadata
+		databazeknih_id = identifiers.get('databazeknih', None)
+		isbn = check_isbn(identifiers.get('isbn', None))
+		if not databazeknih_id and isbn:
+			databazeknih_id = await self.blocking(plugin.cached_isbn_to_identifier, isbn)
+			if databazeknih_id:
+				log.info('Book with the ISBN known from before: %s'%databazeknih_id)
+				recorder.count('cache.index_hits')
+
+		async def fetch(relevance, url):
+			fields = await self.fetch_book(plugin, log, url, identifiers, timeout, recorder)
+			if fields is None:
+				return
+			databazeknih_id = url.rpartition('/knihy/')[2]
+			mi = to_metadata(fields, databazeknih_id, relevance)
+			result_queue.put(mi)
+			if (isbn and (check_isbn(mi.isbn) == isbn or
+					await self.blocking(plugin.cached_isbn_to_identifier, isbn)
+						== databazeknih_id)) or \
+					same_book(title, authors, mi.title, mi.authors):
+				# The book asked for is found, the other candidates are not needed
+				found.set()
+				others = [t for i, t in enumerate(tasks) if i != relevance and not t.done()]
+				if others:
+					log.info('Exact match %r found, cancelling the other requests'%url)
+				for task in others:
+					task.cancel()
+
+		tasks, found = [], asyncio.Event()
+		if databazeknih_id:
+			url = plugin.BASE_URL + 'knihy/' + databazeknih_id
+			tasks.append(asyncio.ensure_future(fetch(0, url)))
+		else:
+			query = plugin.create_query(log, title=title, authors=authors)
+			if query is None:
+				log.error('Insufficient metadata to construct query')
+				return None
+			try:
+				# Candidates are downloaded while the next search page is read
+				async for candidate in self.candidates(plugin, log, query, title,
+						authors, timeout, recorder):
+					if found.is_set():
+						break
+					tasks.append(asyncio.ensure_future(fetch(len(tasks), candidate.url)))
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				recorder.count('errors')
+				if not tasks:
+					log.info('Failed to make identify query: %r'%query)
+					return as_unicode(e)
+				log.exception('Failed to read more results for query: %r'%query)
+		if not tasks:
+			if identifiers and title and authors:
+				log.info('No matches found with identifiers, retrying using only'
+						' title and authors')
+				return await self.find(plugin, log, result_queue, title, authors,
+						{}, timeout, recorder)
+			log.error('No matches found')
+			return None
+		await asyncio.gather(*tasks, return_exceptions=True)
+		return None
+
+	async def find_many(self, plugin, log, books, result_queue, timeout, recorder):
+		'''
+		The coroutine of identify_many. Every distinct search and book page
+		is fetched once, all books are looked up at the same time.
+		'''
+		from calibre_plugins.databazeknih.worker import to_metadata
+		searches, pages = {}, {}
+
+		async def search(query, title, authors):
+			try:
+				return await self.search(plugin, log, query, title, authors,
+						timeout, recorder)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				recorder.count('errors')
+				log.exception('Search failed: %r'%query)
+				return []
+
+		async def deliver(index, relevance, url):
+			key = canonical_url(url)
+			if key not in pages:
+				# No identifiers, the ISBN is looked up once for all books of
+				# the page
+				pages[key] = asyncio.ensure_future(self.fetch_book(plugin, log,
+					url, {}, timeout, recorder))
+			fields = await pages[key]
+			if fields is not None:
+				mi = to_metadata(fields, url.rpartition('/knihy/')[2], relevance)
+				result_queue.put((index, mi))
+
+		async def book(index, title, authors, identifiers):
+			try:
+				databazeknih_id = identifiers.get('databazeknih', None)
+				if not databazeknih_id:
+					databazeknih_id = await self.blocking(plugin.cached_isbn_to_identifier,
+							identifiers.get('isbn', None))
+					if databazeknih_id:
+						recorder.count('cache.index_hits')
+				if databazeknih_id:
+					matches = [plugin.BASE_URL + 'knihy/' + databazeknih_id]
+				else:
+					query = plugin.create_query(log, title=title, authors=authors)
+					if query not in searches:
+						searches[query] = asyncio.ensure_future(search(query, title, authors))
+					matches = await searches[query]
+				await asyncio.gather(*[deliver(index, relevance, url)
+					for relevance, url in enumerate(matches)])
+			finally:
+				result_queue.put((index, None))
+
+		tasks = [book(index, title, authors, identifiers or {}) for index,
+				(title, authors, identifiers) in enumerate(books)]
+		await asyncio.gather(*tasks)
+		log.info('Batch of %d books: %d searches, %d book pages'%(len(tasks),
+			len(searches), len(pages)))
+
+	def identify(self, plugin, log, result_queue, abort, title, authors,
+			identifiers, timeout, recorder):
+		finished, result = self.run(self.find(plugin, log, result_queue, title,
+			authors, identifiers, timeout, recorder), abort)
+		log.info('Connections: %(connections_opened)d opened, %(connections_reused)d'
+				' reused for %(requests)d requests'%self.snapshot())
+		return result
+
+	def identify_many(self, plugin, log, books, result_queue, abort, timeout, recorder):
+		finished, result = self.run(self.find_many(plugin, log, books,
+			result_queue, timeout, recorder), abort)
+		return finished
+
+
+def shared_engine():
+	'''
+	The engine used by every identify call while the asyncio engine is
+	selected. None when it cannot be used: proxies are not supported.
+	'''
+	global _engine
+	with _lock:
+		if _engine is None:
+			from calibre import browser, get_proxies
+			import calibre_plugins.databazeknih.config as cfg
+			if get_proxies():
+				return None
+			from calibre_plugins.databazeknih.session import shared_session
+			# One throttle for the thread workers and the engine, the limits
+			# hold for both together
+			_engine = Engine(headers=browser().addheaders,
+					max_per_host=cfg.get_option(cfg.KEY_MAX_CONNECTIONS),
+					rate=cfg.get_option(cfg.KEY_MAX_RATE),
+					throttle=shared_session().throttle)
+		return _engine
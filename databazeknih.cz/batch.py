@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+from copy import deepcopy
+from threading import Lock
+
+
+class Fanout(object):
+	'''
+	Takes the place of the result queue of a Worker, the Metadata it
+	publishes is kept for all books that match the same page
+	'''
+
+	def __init__(self):
+		self.mi = None
+
+	def put(self, mi):
+		self.mi = mi
+
+
+class Batch(object):
+	'''
+	Identify many books in one pass. Every distinct search query and book
+	page is fetched once for the whole batch, all requests run on the shared
+	worker pool.
+
+	Results are put into ``result_queue`` as ``(index, Metadata)`` as soon
+	as a page is parsed, ``index`` being the position of the book in the
+	batch. ``(index, None)`` follows the last result of a book.
+	'''
+
+	def __init__(self, plugin, log, result_queue, abort, timeout=30):
+		self.plugin, self.log = plugin, log
+		self.result_queue, self.abort, self.timeout = result_queue, abort, timeout
+		self.lock = Lock()
+		# query -> indexes of the books waiting for the search results
+		self.searches = {}
+		# canonical url -> {'mi': Metadata, 'done': bool, 'waiters': [(index, relevance)]}
+		self.pages = {}
+		# index -> number of searches and pages the book still waits for
+		self.pending = {}
+		self.group = self.cancel = self.recorder = None
+		# Per request timeouts, a batch has no deadline as a whole
+		from calibre_plugins.databazeknih.policy import Budget
+		self.budget = Budget(timeout)
+		self.stats = {'books': 0, 'searches': 0, 'pages': 0}
+
+	def run(self, books):
+		from calibre_plugins.databazeknih.executor import (CancelToken,
+				TaskGroup, shared_pool)
+		from calibre_plugins.databazeknih.instrument import Recorder, report
+		self.group, self.cancel = TaskGroup(shared_pool()), CancelToken()
+		self.recorder = Recorder('identify_many')
+		for index, (title, authors, identifiers) in enumerate(books):
+			if self.abort.is_set():
+				break
+			self.stats['books'] += 1
+			self.add_book(index, title, authors, identifiers or {})
+		finished = self.group.wait(self.abort)
+		if not finished:
+			self.cancel.cancel()
+		self.log.info('Batch of %(books)d books: %(searches)d searches,'
+				' %(pages)d book pages'%self.stats)
+		report(self.log, self.recorder)
+		return finished
+
+	def add_book(self, index, title, authors, identifiers):
+		databazeknih_id = identifiers.get('databazeknih', None)
+		if not databazeknih_id:
+			databazeknih_id = self.plugin.cached_isbn_to_identifier(identifiers.get('isbn', None))
+			if databazeknih_id:
+				self.recorder.count('cache.index_hits')
+		with self.lock:
+			self.pending[index] = 1
+		if databazeknih_id:
+			self.add_matches(index, [self.plugin.BASE_URL + 'knihy/' + databazeknih_id])
+			return
+		query = self.plugin.create_query(self.log, title=title, authors=authors)
+		with self.lock:
+			waiting = self.searches.get(query)
+			if waiting is None:
+				self.searches[query] = waiting = []
+				self.stats['searches'] += 1
+				self.group.submit(self.search, query, title, authors, identifiers)
+			elif not isinstance(waiting, list):
+				# The search is finished already
+				matches, waiting = waiting, None
+			if waiting is not None:
+				waiting.append(index)
+				return
+		self.add_matches(index, matches)
+
+	def search(self, query, title, authors, identifiers):
+		'''
+		Runs the search of the first book with the query, the other books
+		get the same matches
+		'''
+		matches = []
+		try:
+			self.plugin.search(self.log, query, title, authors, identifiers,
+					matches, self.budget.phase('search'), self.cancel, self.recorder)
+		except:
+			self.log.exception('Search failed: %r'%query)
+		with self.lock:
+			waiting, self.searches[query] = self.searches[query], tuple(matches)
+		for index in waiting:
+			self.add_matches(index, matches)
+
+	def add_matches(self, index, matches):
+		'''
+		The book waits for the pages of its matches instead of its search
+		'''
+		from calibre_plugins.databazeknih.session import canonical_url
+		ready = []
+		with self.lock:
+			self.pending[index] += len(matches) - 1
+			for relevance, url in enumerate(matches):
+				key = canonical_url(url)
+				page = self.pages.get(key)
+				if page is None:
+					self.pages[key] = page = {'mi': None, 'done': False, 'waiters': []}
+					self.stats['pages'] += 1
+					self.group.submit(self.fetch, url)
+				if page['done']:
+					ready.append((page, relevance))
+				else:
+					page['waiters'].append((index, relevance))
+		for page, relevance in ready:
+			self.deliver(index, relevance, page['mi'])
+		if not matches:
+			self.book_done(index)
+
+	def fetch(self, url):
+		from calibre_plugins.databazeknih.worker import Worker
+		fanout = Fanout()
+		# No identifiers, the ISBN is looked up once for all books of the page
+		w = Worker(url, fanout, self.plugin.policy, self.log, 0, self.plugin,
+				timeout=self.timeout, group=self.group, cancel=self.cancel,
+				recorder=self.recorder, budget=self.budget)
+		w.run()
+		if w.isbn_lookup is not None:
+			w.isbn_lookup.add_done_callback(lambda f: self.page_done(url, fanout.mi))
+		else:
+			self.page_done(url, fanout.mi)
+
+	def page_done(self, url, mi):
+		from calibre_plugins.databazeknih.session import canonical_url
+		with self.lock:
+			page = self.pages[canonical_url(url)]
+			page['mi'], page['done'] = mi, True
+			waiters, page['waiters'] = page['waiters'], []
+		for index, relevance in waiters:
+			self.deliver(index, relevance, mi)
+
+	def deliver(self, index, relevance, mi):
+		if mi is not None:
+			mi = deepcopy(mi)
+			mi.source_relevance = relevance
+			self.result_queue.put((index, mi))
+		with self.lock:
+			self.pending[index] -= 1
+			last = not self.pending[index]
+		if last:
+			self.book_done(index)
+
+	def book_done(self, index):
+		with self.lock:
+			del self.pending[index]
+		self.result_queue.put((index, None))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import hashlib, json, os, re, sqlite3, time, unicodedata
+from collections import namedtuple
+from datetime import datetime
+from threading import RLock
+try:
+	from urllib import unquote as unquote_to_bytes
+except ImportError:
+	from urllib.parse import unquote_to_bytes
+
+CacheEntry = namedtuple('CacheEntry', 'fields etag last_modified fresh')
+# Parsed page of search results and the URL of the page after it
+SearchPage = namedtuple('SearchPage', 'hits next')
+
+_lock = RLock()
+_details_cache = None
+_cover_cache = None
+_search_cache = None
+
+
+class DetailsCache(object):
+	'''
+	Parsed book details stored in a SQLite file and keyed by databazeknih id.
+
+	Entries younger than ``ttl`` seconds are fresh and can be used without
+	asking the server. Older entries keep their ETag/Last-Modified so that
+	they can be revalidated with a conditional request. When there are more
+	than ``max_entries`` books, the least recently used ones are dropped.
+	'''
+
+	def __init__(self, path, ttl, max_entries):
+		self.path, self.ttl, self.max_entries = path, ttl, max_entries
+		self.lock = RLock()
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		with self.lock, self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS details ('
+					'id TEXT PRIMARY KEY, fields TEXT NOT NULL, etag TEXT,'
+					' last_modified TEXT, fetched REAL NOT NULL,'
+					' accessed REAL NOT NULL)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS details_accessed'
+					' ON details (accessed)')
+			self.count = self.conn.execute('SELECT COUNT(*) FROM details').fetchone()[0]
+
+	def get(self, databazeknih_id):
+		now = time.time()
+		with self.lock, self.conn:
+			row = self.conn.execute('SELECT fields, etag, last_modified, fetched'
+					' FROM details WHERE id=?', (databazeknih_id,)).fetchone()
+			if row is None:
+				return None
+			self.conn.execute('UPDATE details SET accessed=? WHERE id=?',
+					(now, databazeknih_id))
+		fields, etag, last_modified, fetched = row
+		return CacheEntry(decode_fields(fields), etag, last_modified,
+				now - fetched < self.ttl)
+
+	def put(self, databazeknih_id, fields, etag=None, last_modified=None):
+		now = time.time()
+		with self.lock, self.conn:
+			cur = self.conn.execute('UPDATE details SET fields=?, etag=?,'
+					' last_modified=?, fetched=?, accessed=? WHERE id=?',
+					(encode_fields(fields), etag, last_modified, now, now,
+						databazeknih_id))
+			if cur.rowcount == 0:
+				self.conn.execute('INSERT INTO details VALUES (?, ?, ?, ?, ?, ?)',
+						(databazeknih_id, encode_fields(fields), etag,
+							last_modified, now, now))
+				self.count += 1
+				self.evict()
+
+	def update(self, databazeknih_id, changes):
+		'''
+		Change some fields of a cached book, e.g. the ISBN found later
+		'''
+		with self.lock, self.conn:
+			row = self.conn.execute('SELECT fields FROM details WHERE id=?',
+					(databazeknih_id,)).fetchone()
+			if row is not None:
+				fields = decode_fields(row[0])
+				fields.update(changes)
+				self.conn.execute('UPDATE details SET fields=? WHERE id=?',
+						(encode_fields(fields), databazeknih_id))
+
+	def refresh(self, databazeknih_id):
+		'''
+		Mark an entry as fresh again after the server answered 304.
+		'''
+		now = time.time()
+		with self.lock, self.conn:
+			self.conn.execute('UPDATE details SET fetched=?, accessed=?'
+					' WHERE id=?', (now, now, databazeknih_id))
+
+	def evict(self):
+		with self.lock, self.conn:
+			excess = self.count - self.max_entries
+			if excess > 0:
+				self.conn.execute('DELETE FROM details WHERE id IN (SELECT id'
+						' FROM details ORDER BY accessed LIMIT ?)', (excess,))
+				self.count = self.conn.execute('SELECT COUNT(*) FROM details').fetchone()[0]
+
+
+class SearchCache(object):
+	'''
+	Parsed pages of search results stored in SQLite and keyed by the
+	normalized page URL, see search_key. A search that found nothing is
+	stored as an empty list, so it is not repeated either.
+
+	Entries are used for ``ttl`` seconds, at most ``max_entries`` queries
+	are kept, the least recently used ones are dropped first.
+	'''
+
+	def __init__(self, path, ttl, max_entries):
+		self.path, self.ttl, self.max_entries = path, ttl, max_entries
+		self.lock = RLock()
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		with self.lock, self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS search_pages ('
+					'query TEXT PRIMARY KEY, hits TEXT NOT NULL, next TEXT,'
+					' fetched REAL NOT NULL, accessed REAL NOT NULL)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS search_pages_accessed'
+					' ON search_pages (accessed)')
+			self.count = self.conn.execute('SELECT COUNT(*) FROM search_pages').fetchone()[0]
+
+	def get(self, query):
+		'''
+		The SearchPage of the URL, its hits are empty when nothing was found.
+		None when the page is not cached or the entry is too old.
+		'''
+		key, now = search_key(query), time.time()
+		with self.lock, self.conn:
+			row = self.conn.execute('SELECT hits, next, fetched FROM search_pages'
+					' WHERE query=?', (key,)).fetchone()
+			if row is None or now - row[2] >= self.ttl:
+				return None
+			self.conn.execute('UPDATE search_pages SET accessed=? WHERE query=?',
+					(now, key))
+		return SearchPage(json.loads(row[0]), row[1])
+
+	def put(self, query, hits, next_page=None):
+		key, now = search_key(query), time.time()
+		with self.lock, self.conn:
+			cur = self.conn.execute('UPDATE search_pages SET hits=?, next=?,'
+					' fetched=?, accessed=? WHERE query=?',
+					(json.dumps(hits), next_page, now, now, key))
+			if cur.rowcount == 0:
+				self.conn.execute('INSERT INTO search_pages VALUES (?, ?, ?, ?, ?)',
+						(key, json.dumps(hits), next_page, now, now))
+				self.count += 1
+				self.evict()
+
+	def evict(self):
+		with self.lock, self.conn:
+			excess = self.count - self.max_entries
+			if excess > 0:
+				self.conn.execute('DELETE FROM search_pages WHERE query IN (SELECT'
+						' query FROM search_pages ORDER BY accessed LIMIT ?)', (excess,))
+				self.count = self.conn.execute('SELECT COUNT(*) FROM search_pages').fetchone()[0]
+
+
+class CoverCache(object):
+	'''
+	Downloaded covers stored as files named by the SHA-1 of the image, so an
+	image shared by several books is stored once. A SQLite index maps
+	databazeknih ids to the files. When the images take more than
+	``max_bytes``, the covers used least recently are removed.
+	'''
+
+	def __init__(self, directory, max_bytes):
+		self.directory, self.max_bytes = directory, max_bytes
+		self.lock = RLock()
+		self.conn = sqlite3.connect(os.path.join(directory, 'covers.sqlite'),
+				timeout=30, check_same_thread=False)
+		with self.lock, self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS covers ('
+					'id TEXT PRIMARY KEY, url TEXT, hash TEXT NOT NULL,'
+					' accessed REAL NOT NULL)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS covers_accessed'
+					' ON covers (accessed)')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS images ('
+					'hash TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+			self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0)'
+					' FROM images').fetchone()[0]
+
+	def path(self, digest):
+		return os.path.join(self.directory, digest[:2], digest)
+
+	def get(self, databazeknih_id):
+		'''
+		The image and its URL, or None
+		'''
+		with self.lock, self.conn:
+			row = self.conn.execute('SELECT url, hash FROM covers WHERE id=?',
+					(databazeknih_id,)).fetchone()
+			if row is None:
+				return None
+			url, digest = row
+			try:
+				with open(self.path(digest), 'rb') as f:
+					data = f.read()
+			except (IOError, OSError):
+				self.conn.execute('DELETE FROM covers WHERE id=?', (databazeknih_id,))
+				self.drop_image(digest)
+				return None
+			self.conn.execute('UPDATE covers SET accessed=? WHERE id=?',
+					(time.time(), databazeknih_id))
+		return data, url
+
+	def put(self, databazeknih_id, url, data):
+		digest = hashlib.sha1(data).hexdigest()
+		path = self.path(digest)
+		with self.lock, self.conn:
+			if self.conn.execute('SELECT 1 FROM images WHERE hash=?',
+					(digest,)).fetchone() is None:
+				if not os.path.isdir(os.path.dirname(path)):
+					os.makedirs(os.path.dirname(path))
+				with open(path + '.tmp', 'wb') as f:
+					f.write(data)
+				if os.path.exists(path):
+					os.remove(path)
+				os.rename(path + '.tmp', path)
+				self.conn.execute('INSERT INTO images VALUES (?, ?)', (digest, len(data)))
+				self.total += len(data)
+			row = self.conn.execute('SELECT hash FROM covers WHERE id=?',
+					(databazeknih_id,)).fetchone()
+			self.conn.execute('INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)',
+					(databazeknih_id, url, digest, time.time()))
+			if row is not None and row[0] != digest:
+				self.drop_image(row[0])
+			self.evict()
+
+	def drop_image(self, digest):
+		'''
+		Delete the image file unless another book still uses it
+		'''
+		with self.lock, self.conn:
+			if self.conn.execute('SELECT 1 FROM covers WHERE hash=? LIMIT 1',
+					(digest,)).fetchone() is not None:
+				return
+			row = self.conn.execute('SELECT size FROM images WHERE hash=?',
+					(digest,)).fetchone()
+			self.conn.execute('DELETE FROM images WHERE hash=?', (digest,))
+			if row is not None:
+				self.total -= row[0]
+			try:
+				os.remove(self.path(digest))
+			except OSError:
+				pass
+
+	def evict(self):
+		with self.lock, self.conn:
+			if self.total <= self.max_bytes:
+				return
+			for databazeknih_id, digest in self.conn.execute('SELECT id, hash'
+					' FROM covers ORDER BY accessed').fetchall():
+				self.conn.execute('DELETE FROM covers WHERE id=?', (databazeknih_id,))
+				self.drop_image(digest)
+				if self.total <= self.max_bytes:
+					break
+
+
+def encode_fields(fields):
+	fields = dict(fields)
+	if fields.get('pubdate') is not None:
+		fields['pubdate'] = fields['pubdate'].isoformat()
+	return json.dumps(fields)
+
+
+def decode_fields(raw):
+	fields = json.loads(raw)
+	if fields.get('pubdate') is not None:
+		from calibre.utils.date import utc_tz
+		pubdate = datetime.strptime(fields['pubdate'][:10], '%Y-%m-%d')
+		fields['pubdate'] = pubdate.replace(tzinfo=utc_tz)
+	return fields
+
+
+def search_key(query):
+	'''
+	The search URL with the searched text unquoted, in lower case and with
+	runs of spaces and pluses collapsed, so that "Harry+Potter" and
+	"harry  potter" are one entry
+	'''
+	base, sep, text = query.partition('q=')
+	text = unquote_to_bytes(text.encode('utf-8')).decode('utf-8', 'replace')
+	text = unicodedata.normalize('NFC', text).lower()
+	return base + sep + ' '.join(re.split(r'[\s+]+', text)).strip()
+
+
+def details_cache():
+	'''
+	The cache shared by all workers, or None when caching is turned off.
+	'''
+	global _details_cache
+	with _lock:
+		if _details_cache is None:
+			import calibre_plugins.databazeknih.config as cfg
+			ttl = cfg.get_option(cfg.KEY_CACHE_TTL)
+			if not ttl:
+				return None
+			path = os.path.join(cfg.plugin_data_dir(), 'details.sqlite')
+			_details_cache = DetailsCache(path, ttl * 24 * 60 * 60,
+					cfg.get_option(cfg.KEY_CACHE_SIZE))
+		return _details_cache
+
+
+def cover_cache():
+	'''
+	The cover cache, or None when it is turned off
+	'''
+	global _cover_cache
+	with _lock:
+		if _cover_cache is None:
+			import calibre_plugins.databazeknih.config as cfg
+			size = cfg.get_option(cfg.KEY_COVER_CACHE_SIZE)
+			if not size:
+				return None
+			directory = os.path.join(cfg.plugin_data_dir(), 'covers')
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			_cover_cache = CoverCache(directory, size * 1024 * 1024)
+		return _cover_cache
+
+
+def search_cache():
+	'''
+	The cache of search results, or None when it is turned off
+	'''
+	global _search_cache
+	with _lock:
+		if _search_cache is None:
+			import calibre_plugins.databazeknih.config as cfg
+			ttl = cfg.get_option(cfg.KEY_SEARCH_CACHE_TTL)
+			if not ttl:
+				return None
+			path = os.path.join(cfg.plugin_data_dir(), 'search_pages.sqlite')
+			_search_cache = SearchCache(path, ttl * 60 * 60,
+					cfg.get_option(cfg.KEY_CACHE_SIZE))
+		return _search_cache
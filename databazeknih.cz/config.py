@@ -7,20 +7,49 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Pavel Skulil <pavelsku@gmail.com>'
 __docformat__ = 'restructuredtext cs'
 
-try:
-    from PyQt5 import Qt as QtGui
-    from PyQt5.Qt import QLabel, QHBoxLayout, Qt, QGroupBox
-except ImportError:
-    from PyQt4 import QtGui
-    from PyQt4.Qt import QLabel, QHBoxLayout, Qt, QGroupBox
-from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
-from calibre.utils.config import JSONConfig
+import os
+
+# No Qt here, the options are read by every identify. The configuration
+# widget is in gui.py.
+from calibre.utils.config import JSONConfig, config_dir
 
 STORE_NAME = 'Options'
 KEY_MAX_DOWNLOADS = 'maxDownloads'
+KEY_MAX_WORKERS = 'maxWorkers'
+KEY_CACHE_TTL = 'cacheTtlDays'
+KEY_CACHE_SIZE = 'cacheSize'
+KEY_SEARCH_CACHE_TTL = 'searchCacheTtlHours'
+KEY_COVER_CACHE_SIZE = 'coverCacheMb'
+KEY_MAX_CONNECTIONS = 'maxConnections'
+KEY_MAX_RATE = 'maxRequestsPerSecond'
+KEY_HEDGE_PERCENTILE = 'hedgePercentile'
+KEY_MAX_DOCUMENTS = 'maxParsedPages'
+KEY_PARSE_PROCESSES = 'parseProcesses'
+KEY_STREAMING_PARSE = 'streamingParse'
+KEY_ISBN_LOOKUP = 'isbnLookup'
+KEY_QUIET_LOG = 'quietLog'
+KEY_TIMINGS_LOG = 'timingsLog'
+KEY_ASYNCIO_ENGINE = 'asyncioEngine'
+KEY_MEMORY_PROFILE = 'memoryProfile'
 
 DEFAULT_STORE_VALUES = {
-    KEY_MAX_DOWNLOADS: 10
+    KEY_MAX_DOWNLOADS: 10,
+    KEY_MAX_WORKERS: 4,
+    KEY_CACHE_TTL: 30,
+    KEY_CACHE_SIZE: 25000,
+    KEY_SEARCH_CACHE_TTL: 24,
+    KEY_COVER_CACHE_SIZE: 200,
+    KEY_MAX_CONNECTIONS: 4,
+    KEY_MAX_RATE: 8,
+    KEY_HEDGE_PERCENTILE: 95,
+    KEY_MAX_DOCUMENTS: 8,
+    KEY_PARSE_PROCESSES: 0,
+    KEY_STREAMING_PARSE: False,
+    KEY_ISBN_LOOKUP: True,
+    KEY_QUIET_LOG: False,
+    KEY_TIMINGS_LOG: False,
+    KEY_ASYNCIO_ENGINE: False,
+    KEY_MEMORY_PROFILE: False,
 }
 
 # This is where all preferences for this plugin will be stored
@@ -30,34 +59,19 @@ plugin_prefs = JSONConfig('plugins/databazeknih')
 plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
 
 
-class ConfigWidget(DefaultConfigWidget):
-
-    def __init__(self, plugin):
-        DefaultConfigWidget.__init__(self, plugin)
-        c = plugin_prefs[STORE_NAME]
-
-        other_group_box = QGroupBox('Other options', self)
-        self.l.addWidget(other_group_box, self.l.rowCount(), 0, 1, 2)
-        other_group_box_layout = QHBoxLayout()
-        other_group_box.setLayout(other_group_box_layout)
-
-        max_label = QLabel('Maximum title/author search matches to evaluate (1 = fastest):', self)
-        max_label.setToolTip('Libri.hu do not always have links to large covers for every ISBN\n'
-                             'of the same book. Increasing this value will take effect when doing\n'
-                             'title/author searches to consider more ISBN editions.\n\n'
-                             'This will increase the potential likelihood of getting a larger cover\n'
-                             'though does not guarantee it.')
-        other_group_box_layout.addWidget(max_label)
-        self.max_downloads_spin = QtGui.QSpinBox(self)
-        self.max_downloads_spin.setMinimum(5)
-        self.max_downloads_spin.setMaximum(50)
-        self.max_downloads_spin.setProperty('value', c.get(KEY_MAX_DOWNLOADS, DEFAULT_STORE_VALUES[KEY_MAX_DOWNLOADS]))
-        other_group_box_layout.addWidget(self.max_downloads_spin)
-        other_group_box_layout.insertStretch(-1)
-
-    def commit(self):
-        DefaultConfigWidget.commit(self)
-        new_prefs = {}
-        new_prefs[KEY_MAX_DOWNLOADS] = int(unicode(self.max_downloads_spin.value()))
-        plugin_prefs[STORE_NAME] = new_prefs
+def get_option(key):
+    '''
+    Value of a single option, falling back to its default when the stored
+    options were saved by an older version of the plugin.
+    '''
+    return plugin_prefs[STORE_NAME].get(key, DEFAULT_STORE_VALUES[key])
+
 
+def plugin_data_dir():
+    '''
+    Directory next to the plugin preferences where caches are kept.
+    '''
+    path = os.path.join(config_dir, 'plugins', 'databazeknih')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
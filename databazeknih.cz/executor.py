@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import sys, time
+from contextlib import contextmanager
+from threading import Condition, Event, Lock, Thread, local
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+
+# How often a waiting identify looks at calibre's abort event. Finished
+# tasks wake it up immediately.
+ABORT_CHECK_INTERVAL = 0.01
+
+_lock = Lock()
+_pool = None
+_documents = None
+_flights = None
+_watcher = None
+
+
+class Cancelled(Exception):
+	pass
+
+
+class CancelToken(object):
+	'''
+	Tells the requests of a task that their result is not needed anymore.
+	cancel() runs the registered callbacks, which interrupt the requests in
+	progress, and later requests raise Cancelled right away.
+	'''
+
+	def __init__(self):
+		self.lock = Lock()
+		self.cancelled = False
+		self.callbacks = []
+
+	def is_set(self):
+		return self.cancelled
+
+	def cancel(self):
+		with self.lock:
+			if self.cancelled:
+				return
+			self.cancelled = True
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			try:
+				callback()
+			except:
+				pass
+
+	def register(self, callback):
+		'''
+		Run callback on cancel(). Returns False without registering it when
+		the token is cancelled already.
+		'''
+		with self.lock:
+			if self.cancelled:
+				return False
+			self.callbacks.append(callback)
+			return True
+
+	def unregister(self, callback):
+		with self.lock:
+			if callback in self.callbacks:
+				self.callbacks.remove(callback)
+
+	def check(self):
+		if self.cancelled:
+			raise Cancelled()
+
+
+class Future(object):
+	'''
+	Result of a callable submitted to a ThreadPool
+	'''
+
+	PENDING, RUNNING, FINISHED, CANCELLED = range(4)
+
+	def __init__(self):
+		self.lock = Lock()
+		self.finished = Event()
+		self.state = self.PENDING
+		self.value = self.exc_info = None
+		self.callbacks, self.last_callbacks = [], []
+
+	def start(self):
+		with self.lock:
+			if self.state != self.PENDING:
+				return False
+			self.state = self.RUNNING
+			return True
+
+	def cancel(self):
+		'''
+		Cancel the call if it did not start yet
+		'''
+		with self.lock:
+			if self.state != self.PENDING:
+				return self.state == self.CANCELLED
+			self.state = self.CANCELLED
+		self.finish()
+		return True
+
+	def set_result(self, value):
+		self.value = value
+		with self.lock:
+			self.state = self.FINISHED
+		self.finish()
+
+	def set_exception(self, exc_info):
+		self.exc_info = exc_info
+		with self.lock:
+			self.state = self.FINISHED
+		self.finish()
+
+	def finish(self):
+		self.finished.set()
+		with self.lock:
+			callbacks = self.callbacks + self.last_callbacks
+			self.callbacks, self.last_callbacks = [], []
+		for callback in callbacks:
+			callback(self)
+
+	def add_done_callback(self, callback, last=False):
+		'''
+		``last`` callbacks run after the others, wherever they were added
+		'''
+		with self.lock:
+			if not self.finished.is_set():
+				(self.last_callbacks if last else self.callbacks).append(callback)
+				return
+		callback(self)
+
+	def done(self):
+		return self.finished.is_set()
+
+	def cancelled(self):
+		return self.state == self.CANCELLED
+
+	def result(self, timeout=None):
+		self.finished.wait(timeout)
+		if self.state == self.CANCELLED:
+			raise Cancelled()
+		if self.exc_info is not None:
+			raise self.exc_info[1]
+		return self.value
+
+
+class ThreadPool(object):
+	'''
+	Runs submitted callables on at most ``max_workers`` daemon threads.
+	Threads are started only when there is more work than idle threads.
+	'''
+
+	def __init__(self, max_workers, name='databazeknih'):
+		self.max_workers, self.name = max_workers, name
+		self.tasks = Queue()
+		self.lock = Lock()
+		self.threads = []
+		self.idle = self.pending = 0
+
+	def submit(self, fn, *args, **kwargs):
+		future = Future()
+		with self.lock:
+			self.pending += 1
+			if self.pending > self.idle and len(self.threads) < self.max_workers:
+				t = Thread(target=self.work, name='%s-%d'%(self.name, len(self.threads)))
+				t.daemon = True
+				self.threads.append(t)
+				t.start()
+		self.tasks.put((future, fn, args, kwargs))
+		return future
+
+	def work(self):
+		while True:
+			with self.lock:
+				self.idle += 1
+			future, fn, args, kwargs = self.tasks.get()
+			with self.lock:
+				self.idle -= 1
+				self.pending -= 1
+			if not future.start():
+				continue
+			try:
+				future.set_result(fn(*args, **kwargs))
+			except:
+				future.set_exception(sys.exc_info())
+			del future, fn, args, kwargs
+
+
+class TaskGroup(object):
+	'''
+	The tasks of one identify call. Tasks may submit further tasks to the
+	group, wait() returns once all of them are finished.
+	'''
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.cond = Condition()
+		self.futures = set()
+
+	def submit(self, fn, *args, **kwargs):
+		future = self.pool.submit(fn, *args, **kwargs)
+		with self.cond:
+			self.futures.add(future)
+		# The task counts as finished once the callbacks of the other tasks
+		# ran, e.g. the ISBN found is set before wait() returns
+		future.add_done_callback(self.task_done, last=True)
+		return future
+
+	def task_done(self, future):
+		with self.cond:
+			self.futures.discard(future)
+			self.cond.notify_all()
+
+	def cancel(self):
+		'''
+		Cancel the tasks that did not start yet
+		'''
+		with self.cond:
+			futures = list(self.futures)
+		for future in futures:
+			future.cancel()
+
+	def wait(self, abort=None, timeout=None):
+		'''
+		Wait until all tasks are finished. Returns False when calibre asked
+		to abort or the timeout expired, the tasks not started yet are then
+		cancelled.
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.cond:
+			while self.futures:
+				if abort is not None and abort.is_set():
+					break
+				interval = ABORT_CHECK_INTERVAL if abort is not None else None
+				if deadline is not None:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					interval = remaining if interval is None else min(interval, remaining)
+				self.cond.wait(interval)
+			if not self.futures:
+				return True
+		self.cancel()
+		return False
+
+
+class DocumentLimit(object):
+	'''
+	At most ``limit`` parsed pages alive at the same time, 0 for no limit.
+	The trees lxml builds live outside of Python's memory accounting and
+	are the largest objects of the plugin, the cap bounds them in large
+	batch runs. A thread holding a slot may parse more pages, e.g. the
+	ISBN page found while streaming a book page, so slots cannot deadlock.
+	'''
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.cond = Condition()
+		self.alive = self.peak = 0
+		self.held = local()
+
+	@contextmanager
+	def slot(self, cancel=None, recorder=None):
+		depth = getattr(self.held, 'depth', 0)
+		if self.limit and not depth:
+			self.acquire(cancel, recorder)
+		self.held.depth = depth + 1
+		try:
+			yield
+		finally:
+			self.held.depth = depth
+			if self.limit and not depth:
+				with self.cond:
+					self.alive -= 1
+					self.cond.notify()
+
+	def acquire(self, cancel, recorder):
+		started = None
+		with self.cond:
+			while self.alive >= self.limit:
+				if cancel is not None:
+					cancel.check()
+				if started is None:
+					started = time.time()
+				self.cond.wait(ABORT_CHECK_INTERVAL)
+			self.alive += 1
+			self.peak = max(self.peak, self.alive)
+		if started is not None and recorder is not None:
+			recorder.add_span('memory.wait', time.time() - started)
+
+	def snapshot(self):
+		with self.cond:
+			return {'limit': self.limit, 'alive': self.alive, 'peak': self.peak}
+
+
+class SingleFlight(object):
+	'''
+	Runs one call per key at a time, e.g. the download of a canonical URL.
+	Callers asking for a key already in flight wait for its result instead
+	of making the same request, the result or the exception of the call is
+	theirs too. Nothing is kept once the call is done, that is what the
+	caches are for.
+
+	A waiting caller whose own token is cancelled raises Cancelled without
+	disturbing the others. When the call is cancelled by its own caller,
+	the waiting callers run the key again, one of them making the call.
+	'''
+
+	def __init__(self):
+		self.lock = Lock()
+		self.calls = {}
+		self.stats = {'calls': 0, 'shared': 0}
+
+	def run(self, key, fn, cancel=None, recorder=None):
+		while True:
+			with self.lock:
+				self.stats['calls'] += 1
+				future = self.calls.get(key)
+				leader = future is None
+				if leader:
+					future = self.calls[key] = Future()
+					future.token = cancel
+				else:
+					self.stats['shared'] += 1
+			if leader:
+				return self.call(key, future, fn)
+			if recorder is not None:
+				recorder.count('coalesced')
+			self.wait(future, cancel)
+			try:
+				return future.result()
+			except:
+				if cancel is not None:
+					cancel.check()
+				token = future.token
+				if token is None or not token.is_set():
+					raise
+
+	def call(self, key, future, fn):
+		try:
+			value = fn()
+		except:
+			exc_info = sys.exc_info()
+			self.forget(key)
+			future.set_exception(exc_info)
+			raise
+		self.forget(key)
+		future.set_result(value)
+		return value
+
+	def forget(self, key):
+		with self.lock:
+			self.calls.pop(key, None)
+
+	def wait(self, future, cancel):
+		woken = Event()
+		future.add_done_callback(lambda f: woken.set())
+		if cancel is None:
+			woken.wait()
+			return
+		if not cancel.register(woken.set):
+			raise Cancelled()
+		try:
+			woken.wait()
+		finally:
+			cancel.unregister(woken.set)
+		cancel.check()
+
+	def snapshot(self):
+		with self.lock:
+			return dict(self.stats, in_flight=len(self.calls))
+
+
+class AbortWatcher(object):
+	'''
+	Cancels a token as soon as calibre's abort event is set, for work that
+	runs in the thread calibre called the plugin in and so cannot wait on
+	the event itself. One thread looks at the linked events every
+	ABORT_CHECK_INTERVAL while there are any.
+	'''
+
+	def __init__(self, interval=ABORT_CHECK_INTERVAL):
+		self.interval = interval
+		self.lock = Lock()
+		self.links = {}
+		self.thread = None
+
+	@contextmanager
+	def linked(self, abort, cancel):
+		'''
+		Cancel the token when abort is set while the block runs
+		'''
+		key = object()
+		with self.lock:
+			self.links[key] = (abort, cancel)
+			if self.thread is None:
+				self.thread = Thread(target=self.watch, name='databazeknih-abort')
+				self.thread.daemon = True
+				self.thread.start()
+		try:
+			if abort.is_set():
+				cancel.cancel()
+			yield
+		finally:
+			with self.lock:
+				del self.links[key]
+
+	def watch(self):
+		while True:
+			with self.lock:
+				if not self.links:
+					self.thread = None
+					return
+				links = list(self.links.values())
+			for abort, cancel in links:
+				if abort.is_set():
+					cancel.cancel()
+			time.sleep(self.interval)
+
+
+def document_limit():
+	'''
+	The cap on parsed pages shared by all identify calls
+	'''
+	global _documents
+	with _lock:
+		if _documents is None:
+			import calibre_plugins.databazeknih.config as cfg
+			_documents = DocumentLimit(cfg.get_option(cfg.KEY_MAX_DOCUMENTS))
+		return _documents
+
+
+def shared_pool():
+	'''
+	Worker threads shared by all identify calls
+	'''
+	global _pool
+	with _lock:
+		if _pool is None:
+			import calibre_plugins.databazeknih.config as cfg
+			_pool = ThreadPool(cfg.get_option(cfg.KEY_MAX_WORKERS))
+		return _pool
+
+
+def shared_flights():
+	'''
+	The requests in flight shared by all identify and download_cover calls
+	'''
+	global _flights
+	with _lock:
+		if _flights is None:
+			_flights = SingleFlight()
+		return _flights
+
+
+def abort_watcher():
+	'''
+	The watcher linking calibre's abort events to the cancel tokens of all
+	identify calls
+	'''
+	global _watcher
+	with _lock:
+		if _watcher is None:
+			_watcher = AbortWatcher()
+		return _watcher
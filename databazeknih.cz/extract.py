@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import re
+from datetime import datetime
+from lxml import etree, html
+try:
+	from urlparse import urljoin
+except ImportError:
+	from urllib.parse import urljoin
+
+# Tags of the elements that carry some of the book details
+TARGETS = ('h1', 'h2', 'h3', 'h5', 'span', 'a', 'img', 'p')
+
+# All elements with book details in document order. libxml2 filters the
+# elements, so Python only sees the dozen or so that matter and not every
+# link and paragraph of the discussion below the book.
+detail_nodes = etree.XPath(
+	'//h1[@itemprop="name"] | //h2[@class="jmenaautoru"] | //h3'
+	' | //h5[@itemprop="category"]'
+	' | //span[@itemprop="datePublished" or @itemprop="publisher"]'
+	' | //a[@class="bpoints" or @id="bukinfo"] | //img[@class="kniha_img"]'
+	' | //p[@id="biall" or @itemprop="description"]')
+# Plain strings: lxml's smart strings reference their element, a value
+# kept in the fields would keep the whole tree of the page alive
+text_nodes = etree.XPath('text()', smart_strings=False)
+link_text_nodes = etree.XPath('a/text()', smart_strings=False)
+series_info_nodes = etree.XPath('em[@class="info"]/text()', smart_strings=False)
+isbn_nodes = etree.XPath('//span[@itemprop="isbn"]/text()', smart_strings=False)
+SERIES_INDEX = re.compile(r'\((\d*)\.\)')
+
+# One result of the search page
+search_hit_nodes = etree.XPath('//p[@class="new_search"]')
+# "2000, J. K. Rowling" below the title of a search result
+SEARCH_YEAR = re.compile(r'^\s*(\d{4})?\s*,\s*')
+# Links to the other pages of the search results, "...&strana=2"
+search_page_links = etree.XPath('//a[contains(@href, "strana=")]/@href',
+	smart_strings=False)
+SEARCH_PAGE = re.compile(r'[?&]strana=(\d+)')
+
+# Streaming parse: the page is read in chunks of STREAM_CHUNK bytes. Once
+# the title and authors are known, reading stops when no other detail was
+# found in the last STREAM_LOOKAHEAD bytes, or STREAM_GRACE bytes after
+# all details were found (more tags may follow the first ones).
+STREAM_CHUNK = 16 * 1024
+STREAM_LOOKAHEAD = 48 * 1024
+STREAM_GRACE = 4 * 1024
+SINGLE_FIELDS = frozenset(('title', 'authors', 'series', 'series_index',
+	'comments', 'cover', 'publisher', 'pubdate', 'rating', 'bid'))
+# Finished elements of these tags are cleared to keep the partial tree small
+CONTAINERS = ('div', 'ul', 'ol', 'table', 'form', 'li')
+
+
+class FieldCollector(object):
+	'''
+	Collects raw values of the book details from elements of the book page.
+	Every handled element is passed to feed() once, in document order, the
+	first match wins like with the ``root.xpath('//...')[0]`` queries of the
+	per-field Worker.parse_* methods.
+	'''
+
+	def __init__(self):
+		self.raw = {}
+
+	def complete(self):
+		raw = self.raw
+		return SINGLE_FIELDS.issubset(raw) or ('description' in raw and
+				(SINGLE_FIELDS - {'comments'}).issubset(raw))
+
+	def first(self, name, nodes):
+		if nodes and name not in self.raw:
+			self.raw[name] = nodes[0]
+			return name
+
+	def feed(self, el):
+		'''
+		Returns the name of the field the element provided, if any
+		'''
+		tag = el.tag
+		if tag == 'a':
+			if el.get('class') == 'bpoints':
+				return self.first('rating', text_nodes(el))
+			if el.get('id') == 'bukinfo':
+				return self.first('bid', [el.get('bid')] if el.get('bid') else None)
+		elif tag == 'span':
+			itemprop = el.get('itemprop')
+			if itemprop == 'datePublished':
+				return self.first('pubdate', text_nodes(el))
+			if itemprop == 'publisher':
+				return self.first('publisher', link_text_nodes(el))
+		elif tag == 'h5':
+			if el.get('itemprop') == 'category':
+				tags = link_text_nodes(el)
+				if tags:
+					self.raw.setdefault('tags', []).extend(tags)
+					return 'tags'
+		elif tag == 'p':
+			if el.get('id') == 'biall':
+				return self.first('comments', [text_nodes(el)])
+			if el.get('itemprop') == 'description':
+				return self.first('description', [text_nodes(el)])
+		elif tag == 'h3':
+			found = self.first('series', link_text_nodes(el))
+			return self.first('series_index', series_info_nodes(el)) or found
+		elif tag == 'h2':
+			if el.get('class') == 'jmenaautoru':
+				return self.first('authors', link_text_nodes(el))
+		elif tag == 'h1':
+			if el.get('itemprop') == 'name':
+				return self.first('title', text_nodes(el))
+		elif tag == 'img':
+			if el.get('class') == 'kniha_img':
+				return self.first('cover', [el.get('src')] if el.get('src') else None)
+
+	def fields(self, base_url, recorder=None):
+		'''
+		Convert the raw values to the fields used to build the Metadata,
+		timing every field parser when a recorder is given
+		'''
+		return parse_fields(self.raw, base_url, recorder)
+
+
+def parse_fields(raw, base_url, recorder=None):
+	'''
+	The fields of the raw values collected by a FieldCollector
+	'''
+	fields = {}
+	for name, parse in FIELD_PARSERS:
+		if recorder is None:
+			fields[name] = parse(raw, base_url)
+		else:
+			with recorder.span('field.' + name):
+				fields[name] = parse(raw, base_url)
+	return fields
+
+
+def collect(root):
+	collector = FieldCollector()
+	for el in detail_nodes(root):
+		collector.feed(el)
+	return collector
+
+
+def extract_fields(root, base_url, recorder=None):
+	'''
+	Collect all book details from a parsed book page with one precompiled
+	query
+	'''
+	return collect(root).fields(base_url, recorder)
+
+
+def page_values(data):
+	'''
+	Raw values of the book details of a whole book page given as bytes,
+	None for an empty page. Runs in the parse processes: the values are
+	plain strings and lists, cheap to send back, parse_fields() makes the
+	fields of them.
+	'''
+	if not data.strip():
+		return None
+	root = etree.fromstring(data, html.HTMLParser(encoding='utf-8'))
+	return collect(root).raw
+
+
+def stream_fields(response, base_url, on_field=None, recorder=None):
+	'''
+	Collect the book details while the page is being downloaded. Reading
+	stops as soon as the details are found, finished parts of the tree are
+	freed on the way. Returns the fields and the number of bytes read.
+
+	``on_field(name, collector)`` is called whenever a detail is found.
+	'''
+	collector = FieldCollector()
+	parser = etree.HTMLPullParser(events=('end',), tag=TARGETS + CONTAINERS)
+	fed = last_found = 0
+	while True:
+		chunk = response.read(STREAM_CHUNK)
+		if not chunk:
+			break
+		parser.feed(chunk)
+		fed += len(chunk)
+		for action, el in parser.read_events():
+			if el.tag in CONTAINERS:
+				el.clear()
+				parent = el.getparent()
+				while parent is not None and el.getprevious() is not None:
+					del parent[0]
+				continue
+			name = collector.feed(el)
+			if name is not None:
+				last_found = fed
+				if on_field is not None:
+					on_field(name, collector)
+		raw = collector.raw
+		if raw.get('title') and raw.get('authors'):
+			lookahead = STREAM_GRACE if collector.complete() else STREAM_LOOKAHEAD
+			if fed - last_found >= lookahead:
+				break
+	try:
+		parser.close()
+	except etree.LxmlError:
+		pass
+	return collector.fields(base_url, recorder), fed
+
+
+def parse_html(response):
+	'''
+	Parse a whole page, feeding it to lxml chunk by chunk as it is read.
+	Returns None for an empty page.
+	'''
+	parser = html.HTMLParser(encoding='utf-8')
+	fed = False
+	while True:
+		chunk = response.read(STREAM_CHUNK)
+		if not chunk:
+			break
+		parser.feed(chunk)
+		fed = fed or bool(chunk.strip())
+	if not fed:
+		return None
+	return parser.close()
+
+
+def search_hits(root, base_url):
+	'''
+	Results of a search page in the page order, as dicts with url, title,
+	authors, year and the src of the cover thumbnail
+	'''
+	hits = []
+	for p in search_hit_nodes(root):
+		hit = {'url': None, 'title': None, 'authors': [], 'year': None, 'cover': None}
+		for child in p:
+			if child.tag == 'img' and hit['cover'] is None:
+				hit['cover'] = child.get('src') or None
+			elif child.tag == 'a' and hit['url'] is None and child.get('href'):
+				hit['url'] = base_url + child.get('href').lstrip('/')
+				hit['title'] = child.text_content().strip()
+			elif child.tag == 'span' and child.get('class') == 'smallfind':
+				info = child.text_content()
+				match = SEARCH_YEAR.match(info)
+				if match is not None:
+					hit['year'] = match.group(1)
+					info = info[match.end():]
+				hit['authors'] = [a.strip() for a in info.split(',') if a.strip()]
+		if hit['url'] is not None:
+			hits.append(hit)
+	return hits
+
+
+def search_next_page(root, url):
+	'''
+	URL of the next page of the search results at url, None on the last
+	page
+	'''
+	match = SEARCH_PAGE.search(url)
+	wanted = (int(match.group(1)) if match is not None else 1) + 1
+	for href in search_page_links(root):
+		match = SEARCH_PAGE.search(href)
+		if match is not None and int(match.group(1)) == wanted:
+			return urljoin(url, href)
+	return None
+
+
+def stream_cover(response):
+	'''
+	The src of the cover on a book page, reading stops right after it
+	'''
+	parser = etree.HTMLPullParser(events=('end',), tag='img')
+	src = None
+	while src is None:
+		chunk = response.read(STREAM_CHUNK)
+		if not chunk:
+			break
+		parser.feed(chunk)
+		for action, el in parser.read_events():
+			if el.get('class') == 'kniha_img' and el.get('src'):
+				src = el.get('src')
+				break
+	try:
+		parser.close()
+	except etree.LxmlError:
+		pass
+	return src
+
+
+def has_series(raw):
+	return bool(raw.get('series') and raw.get('series_index'))
+
+
+# Parsers of the fields from the raw values, (name, parse(raw, base_url))
+FIELD_PARSERS = (
+	('title', lambda raw, base_url: clean_title(raw.get('title'))),
+	('authors', lambda raw, base_url: [raw['authors']] if raw.get('authors') else []),
+	('series', lambda raw, base_url: raw['series'] if has_series(raw) else None),
+	('series_index', lambda raw, base_url: series_index(raw['series_index'])
+		if has_series(raw) else None),
+	('comments', lambda raw, base_url: ''.join(raw.get('comments') or
+		raw.get('description') or []) or None),
+	('cover_url', lambda raw, base_url: cover_url(raw.get('cover'), base_url)),
+	('tags', lambda raw, base_url: raw.get('tags') or None),
+	('publisher', lambda raw, base_url: raw.get('publisher')),
+	('pubdate', lambda raw, base_url: pubdate(raw.get('pubdate'))),
+	('rating', lambda raw, base_url: rating(raw.get('rating'))),
+	('bid', lambda raw, base_url: raw.get('bid')),
+)
+
+
+def clean_title(title):
+	if title:
+		return title.replace('&nbsp;', '').strip() or None
+
+
+def series_index(text):
+	match = SERIES_INDEX.search(text)
+	try:
+		return float(match.group(1))
+	except (AttributeError, ValueError):
+		return None
+
+
+def pubdate(text):
+	try:
+		year = int(text)
+	except (TypeError, ValueError):
+		return None
+	from calibre.utils.date import utc_tz
+	return datetime(year, 1, 1, tzinfo=utc_tz)
+
+
+def rating(text):
+	'''
+	Map the percentage shown on the page to 0-5 stars
+	'''
+	try:
+		percent = float((text or '0').strip().strip('%'))
+	except ValueError:
+		return None
+	if not percent:
+		return None
+	for limit, stars in ((90, 5), (70, 4), (50, 3), (30, 2), (10, 1)):
+		if percent >= limit:
+			return stars
+	return 0
+
+
+def cover_url(src, base_url):
+	'''
+	URL of the large cover, the page shows the medium one
+	'''
+	if not src:
+		return None
+	url = src.replace('mid_', 'big_', 1)
+	if not url.startswith('http://') and not url.startswith('https://'):
+		url = base_url + url.lstrip('/')
+	return url
+
+
+def cover_urls(src, base_url):
+	'''
+	URLs to try for the cover, the large one first and the one shown on the
+	page when there is no large one
+	'''
+	if not src:
+		return []
+	urls = [cover_url(src, base_url), cover_url(src, base_url).replace('big_', 'mid_', 1)]
+	return urls[:1] if urls[0] == urls[1] else urls
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Pavel Skulil <pavelsku@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+try:
+    from PyQt5 import Qt as QtGui
+    from PyQt5.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox
+except ImportError:
+    from PyQt4 import QtGui
+    from PyQt4.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox
+from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
+from calibre_plugins.databazeknih.config import (DEFAULT_STORE_VALUES,
+        STORE_NAME, KEY_ASYNCIO_ENGINE, KEY_CACHE_SIZE, KEY_CACHE_TTL,
+        KEY_COVER_CACHE_SIZE, KEY_HEDGE_PERCENTILE, KEY_ISBN_LOOKUP,
+        KEY_MAX_CONNECTIONS, KEY_MAX_DOCUMENTS, KEY_MAX_DOWNLOADS,
+        KEY_MAX_RATE, KEY_MAX_WORKERS, KEY_MEMORY_PROFILE, KEY_PARSE_PROCESSES,
+        KEY_QUIET_LOG, KEY_SEARCH_CACHE_TTL, KEY_STREAMING_PARSE,
+        KEY_TIMINGS_LOG, plugin_prefs)
+
+
+class ConfigWidget(DefaultConfigWidget):
+
+    def __init__(self, plugin):
+        DefaultConfigWidget.__init__(self, plugin)
+        c = plugin_prefs[STORE_NAME]
+
+        other_group_box = QGroupBox('Other options', self)
+        self.l.addWidget(other_group_box, self.l.rowCount(), 0, 1, 2)
+        other_group_box_layout = QGridLayout()
+        other_group_box.setLayout(other_group_box_layout)
+
+        max_label = QLabel('Maximum title/author search matches to evaluate (1 = fastest):', self)
+        max_label.setToolTip('Search results are ranked by how well their title and authors match\n'
+                             'before any book page is downloaded. Only this many best results are\n'
+                             'downloaded, an exact match is downloaded alone.\n\n'
+                             'Increasing this value considers more editions of the same book.')
+        other_group_box_layout.addWidget(max_label, 0, 0, 1, 1)
+        self.max_downloads_spin = QtGui.QSpinBox(self)
+        self.max_downloads_spin.setMinimum(1)
+        self.max_downloads_spin.setMaximum(50)
+        self.max_downloads_spin.setProperty('value', c.get(KEY_MAX_DOWNLOADS, DEFAULT_STORE_VALUES[KEY_MAX_DOWNLOADS]))
+        other_group_box_layout.addWidget(self.max_downloads_spin, 0, 1, 1, 1)
+
+        workers_label = QLabel('Maximum book pages downloaded at the same time:', self)
+        workers_label.setToolTip('Number of threads downloading and parsing book pages.\n'
+                                 'Changes take effect after calibre is restarted.')
+        other_group_box_layout.addWidget(workers_label, 1, 0, 1, 1)
+        self.workers_spin = QtGui.QSpinBox(self)
+        self.workers_spin.setMinimum(1)
+        self.workers_spin.setMaximum(16)
+        self.workers_spin.setProperty('value', c.get(KEY_MAX_WORKERS, DEFAULT_STORE_VALUES[KEY_MAX_WORKERS]))
+        other_group_box_layout.addWidget(self.workers_spin, 1, 1, 1, 1)
+
+        cache_ttl_label = QLabel('Keep downloaded book details for (days, 0 = no cache):', self)
+        cache_ttl_label.setToolTip('Details of books downloaded earlier are reused without asking\n'
+                                   'databazeknih.cz again. Older entries are revalidated with\n'
+                                   'the server and downloaded again only when the page changed.')
+        other_group_box_layout.addWidget(cache_ttl_label, 2, 0, 1, 1)
+        self.cache_ttl_spin = QtGui.QSpinBox(self)
+        self.cache_ttl_spin.setMinimum(0)
+        self.cache_ttl_spin.setMaximum(365)
+        self.cache_ttl_spin.setProperty('value', c.get(KEY_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_CACHE_TTL]))
+        other_group_box_layout.addWidget(self.cache_ttl_spin, 2, 1, 1, 1)
+
+        cache_size_label = QLabel('Maximum number of cached books:', self)
+        cache_size_label.setToolTip('When the cache is full, the books used least recently are removed.')
+        other_group_box_layout.addWidget(cache_size_label, 3, 0, 1, 1)
+        self.cache_size_spin = QtGui.QSpinBox(self)
+        self.cache_size_spin.setMinimum(100)
+        self.cache_size_spin.setMaximum(1000000)
+        self.cache_size_spin.setSingleStep(1000)
+        self.cache_size_spin.setProperty('value', c.get(KEY_CACHE_SIZE, DEFAULT_STORE_VALUES[KEY_CACHE_SIZE]))
+        other_group_box_layout.addWidget(self.cache_size_spin, 3, 1, 1, 1)
+
+        search_ttl_label = QLabel('Keep search results for (hours, 0 = no cache):', self)
+        search_ttl_label.setToolTip('The same title is searched only once, also when the cover is downloaded\n'
+                                    'later. Searches that found nothing are remembered as well.')
+        other_group_box_layout.addWidget(search_ttl_label, 4, 0, 1, 1)
+        self.search_ttl_spin = QtGui.QSpinBox(self)
+        self.search_ttl_spin.setMinimum(0)
+        self.search_ttl_spin.setMaximum(24 * 30)
+        self.search_ttl_spin.setProperty('value', c.get(KEY_SEARCH_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_SEARCH_CACHE_TTL]))
+        other_group_box_layout.addWidget(self.search_ttl_spin, 4, 1, 1, 1)
+
+        cover_cache_label = QLabel('Space for downloaded covers (MB, 0 = no cache):', self)
+        cover_cache_label.setToolTip('Covers downloaded once are taken from the disk the next time.\n'
+                                     'When the space is used up, the covers used least recently are removed.')
+        other_group_box_layout.addWidget(cover_cache_label, 5, 0, 1, 1)
+        self.cover_cache_spin = QtGui.QSpinBox(self)
+        self.cover_cache_spin.setMinimum(0)
+        self.cover_cache_spin.setMaximum(10000)
+        self.cover_cache_spin.setSingleStep(50)
+        self.cover_cache_spin.setProperty('value', c.get(KEY_COVER_CACHE_SIZE, DEFAULT_STORE_VALUES[KEY_COVER_CACHE_SIZE]))
+        other_group_box_layout.addWidget(self.cover_cache_spin, 5, 1, 1, 1)
+
+        connections_label = QLabel('Maximum parallel connections to databazeknih.cz:', self)
+        connections_label.setToolTip('Connections are kept open and reused for the following requests.\n'
+                                     'Changes take effect after calibre is restarted.')
+        other_group_box_layout.addWidget(connections_label, 6, 0, 1, 1)
+        self.connections_spin = QtGui.QSpinBox(self)
+        self.connections_spin.setMinimum(1)
+        self.connections_spin.setMaximum(16)
+        self.connections_spin.setProperty('value', c.get(KEY_MAX_CONNECTIONS, DEFAULT_STORE_VALUES[KEY_MAX_CONNECTIONS]))
+        other_group_box_layout.addWidget(self.connections_spin, 6, 1, 1, 1)
+
+        rate_label = QLabel('Maximum requests per second (0 = no limit):', self)
+        rate_label.setToolTip('Requests above this rate wait. Fewer requests run in parallel while\n'
+                              'databazeknih.cz answers slowly or asks to slow down.\n'
+                              'Changes take effect after calibre is restarted.')
+        other_group_box_layout.addWidget(rate_label, 7, 0, 1, 1)
+        self.rate_spin = QtGui.QSpinBox(self)
+        self.rate_spin.setMinimum(0)
+        self.rate_spin.setMaximum(100)
+        self.rate_spin.setProperty('value', c.get(KEY_MAX_RATE, DEFAULT_STORE_VALUES[KEY_MAX_RATE]))
+        other_group_box_layout.addWidget(self.rate_spin, 7, 1, 1, 1)
+
+        hedge_label = QLabel('Repeat requests slower than this percent of the recent ones (0 = never):', self)
+        hedge_label.setToolTip('A request that takes longer than most recent requests is sent once more\n'
+                               'and the answer that comes first is used. Failed requests are repeated\n'
+                               'after a short random pause, as long as the identify timeout allows.')
+        other_group_box_layout.addWidget(hedge_label, 8, 0, 1, 1)
+        self.hedge_spin = QtGui.QSpinBox(self)
+        self.hedge_spin.setMinimum(0)
+        self.hedge_spin.setMaximum(99)
+        self.hedge_spin.setProperty('value', c.get(KEY_HEDGE_PERCENTILE, DEFAULT_STORE_VALUES[KEY_HEDGE_PERCENTILE]))
+        other_group_box_layout.addWidget(self.hedge_spin, 8, 1, 1, 1)
+
+        documents_label = QLabel('Most pages parsed at the same time (0 = no limit):', self)
+        documents_label.setToolTip('Parsed pages take the most memory. Downloads wait while this many\n'
+                                   'pages are being parsed, which keeps memory low when metadata of many\n'
+                                   'books is downloaded at once.')
+        other_group_box_layout.addWidget(documents_label, 9, 0, 1, 1)
+        self.documents_spin = QtGui.QSpinBox(self)
+        self.documents_spin.setMinimum(0)
+        self.documents_spin.setMaximum(100)
+        self.documents_spin.setProperty('value', c.get(KEY_MAX_DOCUMENTS, DEFAULT_STORE_VALUES[KEY_MAX_DOCUMENTS]))
+        other_group_box_layout.addWidget(self.documents_spin, 9, 1, 1, 1)
+
+        processes_label = QLabel('Parse book pages in this many processes (0 = in the download threads):', self)
+        processes_label.setToolTip('Parsing is the slow part when metadata of many books is downloaded at\n'
+                                   'once. Separate processes use all processor cores. Pages parsed this way\n'
+                                   'are downloaded whole. Needs calibre 5 or newer, used after a restart.')
+        other_group_box_layout.addWidget(processes_label, 10, 0, 1, 1)
+        self.processes_spin = QtGui.QSpinBox(self)
+        self.processes_spin.setMinimum(0)
+        self.processes_spin.setMaximum(32)
+        self.processes_spin.setProperty('value', c.get(KEY_PARSE_PROCESSES, DEFAULT_STORE_VALUES[KEY_PARSE_PROCESSES]))
+        other_group_box_layout.addWidget(self.processes_spin, 10, 1, 1, 1)
+
+        self.streaming_checkbox = QCheckBox('Stop downloading book pages once all details are read', self)
+        self.streaming_checkbox.setToolTip('Book pages are parsed while they are being downloaded and the rest\n'
+                                           'of the page (comments, discussion) is not downloaded at all.\n'
+                                           'Saves data and memory, a detail placed unusually low on the page may be missed.')
+        self.streaming_checkbox.setChecked(c.get(KEY_STREAMING_PARSE, DEFAULT_STORE_VALUES[KEY_STREAMING_PARSE]))
+        other_group_box_layout.addWidget(self.streaming_checkbox, 11, 0, 1, 2)
+
+        self.isbn_checkbox = QCheckBox('Download ISBN (one more request per book)', self)
+        self.isbn_checkbox.setToolTip('The ISBN is not on the book page and needs a separate request.\n'
+                                      'It is never requested for books that already have an ISBN.\n'
+                                      'Turn this off to speed up downloading metadata for many books.')
+        self.isbn_checkbox.setChecked(c.get(KEY_ISBN_LOOKUP, DEFAULT_STORE_VALUES[KEY_ISBN_LOOKUP]))
+        other_group_box_layout.addWidget(self.isbn_checkbox, 12, 0, 1, 2)
+
+        self.quiet_checkbox = QCheckBox('Shorter log (skip the parsed details of every book)', self)
+        self.quiet_checkbox.setToolTip('The log shows the timings and errors but not the values found on\n'
+                                       'every page. Formatting those takes time when many books are downloaded.')
+        self.quiet_checkbox.setChecked(c.get(KEY_QUIET_LOG, DEFAULT_STORE_VALUES[KEY_QUIET_LOG]))
+        other_group_box_layout.addWidget(self.quiet_checkbox, 13, 0, 1, 2)
+
+        self.timings_checkbox = QCheckBox('Save timings of every download to timings.jsonl', self)
+        self.timings_checkbox.setToolTip('One line of JSON per identify or cover download is appended to\n'
+                                         'timings.jsonl in the plugins/databazeknih folder of the calibre\n'
+                                         'configuration directory.')
+        self.timings_checkbox.setChecked(c.get(KEY_TIMINGS_LOG, DEFAULT_STORE_VALUES[KEY_TIMINGS_LOG]))
+        other_group_box_layout.addWidget(self.timings_checkbox, 14, 0, 1, 2)
+
+        self.asyncio_checkbox = QCheckBox('Download with one asyncio event loop instead of threads (Python 3.7 or newer)', self)
+        self.asyncio_checkbox.setToolTip('All searches, book pages and ISBN requests run on a single thread, so\n'
+                                         'hundreds of books can be looked up at once. Not used with a proxy.\n'
+                                         'Covers are still downloaded by the threads.')
+        self.asyncio_checkbox.setChecked(c.get(KEY_ASYNCIO_ENGINE, DEFAULT_STORE_VALUES[KEY_ASYNCIO_ENGINE]))
+        other_group_box_layout.addWidget(self.asyncio_checkbox, 15, 0, 1, 2)
+
+        self.memory_checkbox = QCheckBox('Profile memory (log the memory used by every download, slower)', self)
+        self.memory_checkbox.setToolTip('Memory allocations are traced and the log shows the peak memory of\n'
+                                        'every identify and cover download and of its phases. Needs calibre 5\n'
+                                        'or newer, takes effect after calibre is restarted when turned off.')
+        self.memory_checkbox.setChecked(c.get(KEY_MEMORY_PROFILE, DEFAULT_STORE_VALUES[KEY_MEMORY_PROFILE]))
+        other_group_box_layout.addWidget(self.memory_checkbox, 16, 0, 1, 2)
+        other_group_box_layout.setColumnStretch(2, 1)
+
+    def commit(self):
+        DefaultConfigWidget.commit(self)
+        new_prefs = dict(plugin_prefs[STORE_NAME])
+        new_prefs[KEY_MAX_DOWNLOADS] = int(self.max_downloads_spin.value())
+        new_prefs[KEY_MAX_WORKERS] = int(self.workers_spin.value())
+        new_prefs[KEY_CACHE_TTL] = int(self.cache_ttl_spin.value())
+        new_prefs[KEY_CACHE_SIZE] = int(self.cache_size_spin.value())
+        new_prefs[KEY_SEARCH_CACHE_TTL] = int(self.search_ttl_spin.value())
+        new_prefs[KEY_COVER_CACHE_SIZE] = int(self.cover_cache_spin.value())
+        new_prefs[KEY_MAX_CONNECTIONS] = int(self.connections_spin.value())
+        new_prefs[KEY_MAX_RATE] = int(self.rate_spin.value())
+        new_prefs[KEY_HEDGE_PERCENTILE] = int(self.hedge_spin.value())
+        new_prefs[KEY_MAX_DOCUMENTS] = int(self.documents_spin.value())
+        new_prefs[KEY_PARSE_PROCESSES] = int(self.processes_spin.value())
+        new_prefs[KEY_STREAMING_PARSE] = self.streaming_checkbox.isChecked()
+        new_prefs[KEY_ISBN_LOOKUP] = self.isbn_checkbox.isChecked()
+        new_prefs[KEY_QUIET_LOG] = self.quiet_checkbox.isChecked()
+        new_prefs[KEY_TIMINGS_LOG] = self.timings_checkbox.isChecked()
+        new_prefs[KEY_ASYNCIO_ENGINE] = self.asyncio_checkbox.isChecked()
+        new_prefs[KEY_MEMORY_PROFILE] = self.memory_checkbox.isChecked()
+        plugin_prefs[STORE_NAME] = new_prefs
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import json, os, sqlite3, time
+from threading import RLock
+
+# ISBN -> databazeknih id, bid -> ISBN, databazeknih id -> cover URL
+KINDS = ('isbn', 'bid', 'cover')
+
+_lock = RLock()
+_index = None
+
+
+class Index(object):
+	'''
+	The lookups calibre keeps in memory only (ISBN -> id, id -> cover URL)
+	and the bid -> ISBN lookup, stored in SQLite so that they survive
+	calibre restarts. Every kind keeps at most ``max_entries`` entries, the
+	least recently used ones are dropped.
+	'''
+
+	def __init__(self, path, max_entries):
+		self.path, self.max_entries = path, max_entries
+		self.lock = RLock()
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		with self.lock, self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+					'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+					' accessed REAL NOT NULL, PRIMARY KEY (kind, key))')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed'
+					' ON entries (kind, accessed)')
+			self.counts = dict((kind, 0) for kind in KINDS)
+			self.counts.update(self.conn.execute('SELECT kind, COUNT(*) FROM'
+				' entries GROUP BY kind').fetchall())
+
+	def get(self, kind, key):
+		with self.lock, self.conn:
+			row = self.conn.execute('SELECT value FROM entries WHERE kind=? AND'
+					' key=?', (kind, key)).fetchone()
+			if row is not None:
+				self.conn.execute('UPDATE entries SET accessed=? WHERE kind=? AND'
+						' key=?', (time.time(), kind, key))
+				return row[0]
+
+	def put(self, kind, key, value):
+		self.put_many(kind, [(key, value)])
+
+	def put_many(self, kind, items):
+		'''
+		Store (key, value) pairs of one kind in a single transaction
+		'''
+		now = time.time()
+		with self.lock, self.conn:
+			for key, value in items:
+				cur = self.conn.execute('UPDATE entries SET value=?, accessed=?'
+						' WHERE kind=? AND key=?', (value, now, kind, key))
+				if cur.rowcount == 0:
+					self.conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+							(kind, key, value, now))
+					self.counts[kind] += 1
+			self.evict(kind)
+
+	def evict(self, kind, max_entries=None):
+		max_entries = self.max_entries if max_entries is None else max_entries
+		with self.lock, self.conn:
+			excess = self.counts[kind] - max_entries
+			if excess > 0:
+				self.conn.execute('DELETE FROM entries WHERE kind=? AND key IN'
+						' (SELECT key FROM entries WHERE kind=? ORDER BY accessed'
+						' LIMIT ?)', (kind, kind, excess))
+				self.counts[kind] = self.conn.execute('SELECT COUNT(*) FROM entries'
+						' WHERE kind=?', (kind,)).fetchone()[0]
+			return max(excess, 0)
+
+	def items(self, kind):
+		with self.lock:
+			return self.conn.execute('SELECT key, value FROM entries WHERE kind=?'
+					' ORDER BY key', (kind,)).fetchall()
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counts)
+		stats['bytes'] = os.path.getsize(self.path)
+		return stats
+
+
+def shared_index():
+	'''
+	The index shared by all identify and download_cover calls
+	'''
+	global _index
+	with _lock:
+		if _index is None:
+			import calibre_plugins.databazeknih.config as cfg
+			_index = Index(os.path.join(cfg.plugin_data_dir(), 'index.sqlite'),
+					cfg.get_option(cfg.KEY_CACHE_SIZE))
+		return _index
+
+
+def export_index(index):
+	return dict((kind, dict(index.items(kind))) for kind in KINDS)
+
+
+def import_index(index, data):
+	'''
+	Load a file written by export_index or the output of
+	``calibredb list --fields identifiers --for-machine``. Returns the number
+	of entries per kind.
+	'''
+	from calibre.ebooks.metadata import check_isbn
+	found = dict((kind, []) for kind in KINDS)
+	if isinstance(data, dict):
+		for kind in KINDS:
+			found[kind].extend((data.get(kind) or {}).items())
+	else:
+		for book in data:
+			identifiers = book.get('identifiers') or {}
+			isbn = check_isbn(identifiers.get('isbn', None))
+			if isbn and identifiers.get('databazeknih'):
+				found['isbn'].append((isbn, identifiers['databazeknih']))
+	for kind in KINDS:
+		index.put_many(kind, found[kind])
+	return dict((kind, len(found[kind])) for kind in KINDS)
+
+
+def main(args, plugin=None):
+	'''
+	calibre-debug -r Databazeknih -- stats|export FILE|import FILE|evict [MAX]|prefetch FILE [PAGES_PER_S]
+	'''
+	from calibre_plugins.databazeknih.cache import cover_cache, details_cache
+	index = shared_index()
+	command = args[0] if args else 'stats'
+	if command == 'prefetch' and len(args) > 1:
+		from calibre_plugins.databazeknih.prefetch import main as prefetch
+		prefetch(args[1:], plugin)
+	elif command == 'import' and len(args) > 1:
+		with open(args[1], 'rb') as f:
+			counts = import_index(index, json.loads(f.read().decode('utf-8')))
+		print('Imported %(isbn)d ISBNs, %(bid)d bids and %(cover)d cover URLs'%counts)
+	elif command == 'export' and len(args) > 1:
+		with open(args[1], 'wb') as f:
+			f.write(json.dumps(export_index(index), indent=1, sort_keys=True).encode('utf-8'))
+		print('Exported to %s'%args[1])
+	elif command == 'evict':
+		max_entries = int(args[1]) if len(args) > 1 else None
+		for kind in KINDS:
+			print('%s: %d entries removed'%(kind, index.evict(kind, max_entries)))
+	elif command == 'stats':
+		print('Index %s: %d ISBNs, %d bids, %d cover URLs, %d kB'%(index.path,
+			index.counts['isbn'], index.counts['bid'], index.counts['cover'],
+			index.stats()['bytes'] // 1024))
+		cache = details_cache()
+		if cache is not None:
+			print('Book details cache: %d books'%cache.count)
+		covers = cover_cache()
+		if covers is not None:
+			print('Cover cache: %d kB of %d kB'%(covers.total // 1024,
+				covers.max_bytes // 1024))
+	else:
+		print(main.__doc__.strip())
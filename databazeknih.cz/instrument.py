@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import io, json, os, sys, time
+from contextlib import contextmanager
+from threading import Lock
+from weakref import WeakSet
+from calibre_plugins.databazeknih.executor import Cancelled
+
+# Appended to in the plugin data directory when the timings log is on
+TIMINGS_FILE = 'timings.jsonl'
+# Frames kept per traced allocation and allocation sites reported in the
+# memory profile
+TRACE_FRAMES = 1
+TOP_ALLOCATIONS = 5
+
+_sink_lock = Lock()
+# Recorders profiling memory whose call is not summarized yet, the peak of
+# tracemalloc is process-wide and only reset when there are none
+_profiling = WeakSet()
+_profiling_lock = Lock()
+
+
+def memory_profile():
+	'''
+	True when memory is to be profiled, tracemalloc is started then. Also
+	True when tracing was started otherwise, e.g. by PYTHONTRACEMALLOC.
+	Never on Python 2, which has no tracemalloc.
+	'''
+	try:
+		import tracemalloc
+	except ImportError:
+		return False
+	if tracemalloc.is_tracing():
+		return True
+	import calibre_plugins.databazeknih.config as cfg
+	if not cfg.get_option(cfg.KEY_MEMORY_PROFILE):
+		return False
+	tracemalloc.start(TRACE_FRAMES)
+	return True
+
+
+def traced_memory():
+	import tracemalloc
+	return tracemalloc.get_traced_memory()[0]
+
+
+def max_rss():
+	'''
+	Largest resident set size of the process in bytes, None where it is not
+	known. It includes the trees of lxml, which tracemalloc does not see.
+	'''
+	try:
+		import resource
+	except ImportError:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Kilobytes on Linux, bytes on macOS
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def top_allocations(snapshot, start):
+	'''
+	Source lines that allocated the most memory since the start snapshot
+	'''
+	import tracemalloc
+	ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+	stats = snapshot.filter_traces(ignore).compare_to(start.filter_traces(ignore),
+			'lineno')
+	return [{'line': '%s:%d'%(stat.traceback[0].filename, stat.traceback[0].lineno),
+		'size': stat.size_diff, 'count': stat.count_diff}
+		for stat in stats[:TOP_ALLOCATIONS]]
+
+
+class Recorder(object):
+	'''
+	Wall time spans and counters of one identify, identify_many or
+	download_cover call, shared by all threads working on it.
+
+	Spans are named by phase, ``search.fetch``, ``detail.parse``,
+	``field.title`` and so on, counters count requests, bytes, cache hits
+	and errors.
+
+	When ``memory`` is on, by default when the memory profile is, the
+	summary also has the peak of the memory traced by tracemalloc during
+	the call, the most memory any phase left allocated and the lines that
+	allocated the most. Threads of other calls running at the same time
+	are counted too. The peak is the one of the call only when no other
+	profiled call was running as it started, else it is the peak of the
+	process and ``process_peak`` says so.
+	'''
+
+	def __init__(self, name, memory=None):
+		self.name = name
+		self.started = time.time()
+		self.lock = Lock()
+		# name -> [count, total seconds, longest]
+		self.spans = {}
+		self.counters = {}
+		self.memory = memory_profile() if memory is None else memory
+		if self.memory:
+			import tracemalloc
+			with _profiling_lock:
+				# Resetting the peak would lose the one of the calls running
+				self.process_peak = len(_profiling) > 0 or not hasattr(tracemalloc,
+						'reset_peak')
+				if not self.process_peak:
+					tracemalloc.reset_peak()
+				_profiling.add(self)
+			self.baseline = traced_memory()
+			self.snapshot = tracemalloc.take_snapshot()
+			# name -> largest growth of the traced memory over one span
+			self.memory_spans = {}
+
+	@contextmanager
+	def span(self, name):
+		'''
+		Time the block. An exception other than a cancellation is counted
+		as an error of the span.
+		'''
+		start = time.time()
+		before = traced_memory() if self.memory else None
+		try:
+			yield
+		except Cancelled:
+			raise
+		except Exception:
+			self.count('errors')
+			self.count(name + '.errors')
+			raise
+		finally:
+			self.add_span(name, time.time() - start)
+			if before is not None:
+				self.add_memory(name, traced_memory() - before)
+
+	def add_span(self, name, seconds):
+		with self.lock:
+			span = self.spans.get(name)
+			if span is None:
+				self.spans[name] = [1, seconds, seconds]
+			else:
+				span[0] += 1
+				span[1] += seconds
+				span[2] = max(span[2], seconds)
+
+	def add_memory(self, name, growth):
+		with self.lock:
+			self.memory_spans[name] = max(growth, self.memory_spans.get(name, growth))
+
+	def count(self, name, value=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def add_response(self, response):
+		'''
+		Count a request and the bytes read of its response
+		'''
+		with self.lock:
+			for name, value in (('requests', 1), ('wire_bytes', response.wire_bytes),
+					('body_bytes', response.body_bytes)):
+				self.counters[name] = self.counters.get(name, 0) + value
+
+	def summary(self):
+		with self.lock:
+			summary = {
+				'name': self.name,
+				'started': self.started,
+				'wall': time.time() - self.started,
+				'spans': dict((name, {'count': count, 'total': total, 'max': longest})
+					for name, (count, total, longest) in self.spans.items()),
+				'counters': dict(self.counters),
+			}
+		if self.memory:
+			summary['memory'] = self.memory_summary()
+			with _profiling_lock:
+				_profiling.discard(self)
+		return summary
+
+	def memory_summary(self):
+		import tracemalloc
+		from calibre_plugins.databazeknih.executor import document_limit
+		current, peak = tracemalloc.get_traced_memory()
+		with self.lock:
+			spans = dict(self.memory_spans)
+		return {
+			'baseline': self.baseline,
+			'current': current,
+			'peak': peak,
+			'process_peak': self.process_peak,
+			'growth': max(0, peak - self.baseline),
+			'spans': spans,
+			'top': top_allocations(tracemalloc.take_snapshot(), self.snapshot),
+			'max_rss': max_rss(),
+			'documents': document_limit().snapshot(),
+		}
+
+
+def format_summary(summary):
+	'''
+	The summary as a few lines for the calibre log
+	'''
+	lines = ['%s took %.3fs'%(summary['name'], summary['wall'])]
+	for name, span in sorted(summary['spans'].items()):
+		lines.append('  %-18s %4dx %8.3fs total %8.3fs max'%(name, span['count'],
+			span['total'], span['max']))
+	if summary['counters']:
+		lines.append('  ' + ', '.join('%s=%d'%item for item in
+			sorted(summary['counters'].items())))
+	memory = summary.get('memory')
+	if memory:
+		lines.append('  memory peak %s%s, %s above the start, %s still allocated'%(
+			mib(memory['peak']), ' of the process' if memory['process_peak'] else '',
+			mib(memory['growth']), mib(memory['current'])))
+		if memory['max_rss'] is not None:
+			lines.append('  max rss %s'%mib(memory['max_rss']))
+		lines.append('  parsed pages %(peak)d at once, limit %(limit)d'%memory['documents'])
+		lines.append('  memory left allocated by a phase, most of one run:')
+		for name, growth in sorted(memory['spans'].items()):
+			lines.append('  %-18s %+10.1f kB'%(name, growth / 1024))
+		if memory['top']:
+			lines.append('  allocated since the start:')
+		for top in memory['top']:
+			lines.append('  %+10.1f kB %6d blocks %s'%(top['size'] / 1024, top['count'],
+				top['line']))
+	return '\n'.join(lines)
+
+
+def mib(size):
+	return '%.1f MiB'%(size / 1024 / 1024)
+
+
+def write_summary(summary, path=None):
+	'''
+	Append the summary to the JSON lines file, one object per line
+	'''
+	if path is None:
+		import calibre_plugins.databazeknih.config as cfg
+		path = os.path.join(cfg.plugin_data_dir(), TIMINGS_FILE)
+	line = json.dumps(summary, sort_keys=True)
+	with _sink_lock, io.open(path, 'ab') as f:
+		f.write(line.encode('utf-8') + b'\n')
+
+
+def report(log, recorder):
+	'''
+	Log the summary of the recorder and write it to the timings log when
+	that is turned on
+	'''
+	import calibre_plugins.databazeknih.config as cfg
+	summary = recorder.summary()
+	log.info(format_summary(summary))
+	if cfg.get_option(cfg.KEY_TIMINGS_LOG):
+		try:
+			write_summary(summary)
+		except:
+			log.exception('Failed to write the timings log')
+	return summary
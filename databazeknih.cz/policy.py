@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import random, socket, time
+from collections import deque
+from threading import Event, Lock
+try:
+	from Queue import Queue, Empty
+	from httplib import HTTPException
+except ImportError:
+	from queue import Queue, Empty
+	from http.client import HTTPException
+from calibre_plugins.databazeknih.executor import (Cancelled, CancelToken,
+		ThreadPool)
+
+# Share of the identify timeout one request of the phase may take, its
+# retries and duplicates included
+PHASE_SHARES = {'search': 0.4, 'detail': 0.6, 'isbn': 0.3, 'cover': 0.5}
+# A request is never given less than this, even past the deadline
+MIN_TIMEOUT = 1.0
+# Tries after the first one, the pause before try n is random between 0
+# and BACKOFF_BASE * 2 ** n seconds, at most BACKOFF_MAX
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 4.0
+# Server errors worth another try, 429 and 503 are repeated by the session
+RETRY_STATUSES = frozenset((500, 502, 504))
+# Latencies of the last LATENCY_WINDOW responses are kept, the percentile
+# is used once there are MIN_SAMPLES of them
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+# Threads running the tries of hedged requests per worker thread, the
+# first try and its duplicate
+HEDGE_THREADS_PER_WORKER = 2
+
+_lock = Lock()
+_policy = None
+
+
+class Budget(object):
+	'''
+	Time the requests of one identify call may take. Every phase gets its
+	share of ``timeout`` per request, but no request runs past the
+	``deadline`` of the whole call, if there is one.
+	'''
+
+	def __init__(self, timeout, deadline=None):
+		self.timeout, self.deadline = timeout, deadline
+
+	@classmethod
+	def starting_now(cls, timeout):
+		return cls(timeout, time.time() + timeout)
+
+	def phase(self, name):
+		'''
+		Seconds the next request of the phase may take
+		'''
+		seconds = self.timeout * PHASE_SHARES.get(name, 1.0)
+		if self.deadline is not None:
+			seconds = min(seconds, self.deadline - time.time())
+		return max(MIN_TIMEOUT, seconds)
+
+
+class Latency(object):
+	'''
+	Time to the response headers of recent successful requests
+	'''
+
+	def __init__(self, window=LATENCY_WINDOW):
+		self.lock = Lock()
+		self.samples = deque(maxlen=window)
+
+	def add(self, seconds):
+		with self.lock:
+			self.samples.append(seconds)
+
+	def percentile(self, percent):
+		'''
+		None until there are MIN_SAMPLES samples
+		'''
+		with self.lock:
+			if len(self.samples) < MIN_SAMPLES:
+				return None
+			samples = sorted(self.samples)
+		return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def retryable(e):
+	'''
+	True for failures another try of the same GET may not hit: timeouts,
+	dropped connections and some server errors
+	'''
+	if callable(getattr(e, 'getcode', None)):
+		return e.getcode() in RETRY_STATUSES
+	return isinstance(e, (socket.error, HTTPException))
+
+
+def backoff(attempt):
+	'''
+	Pause before the retry, with full jitter
+	'''
+	return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def pause(seconds, cancel=None):
+	'''
+	Sleep, but wake up and raise Cancelled when the token is cancelled
+	'''
+	if cancel is None:
+		time.sleep(seconds)
+		return
+	woken = Event()
+	if not cancel.register(woken.set):
+		raise Cancelled()
+	try:
+		woken.wait(seconds)
+	finally:
+		cancel.unregister(woken.set)
+	cancel.check()
+
+
+class RequestPolicy(object):
+	'''
+	Opens URLs through the session like Session.open does, but tries again
+	after timeouts, dropped connections and server errors, and sends a
+	duplicate of a request that is slower than ``hedge_percentile`` percent
+	of the recent ones, the response that comes first is used.
+
+	The ``timeout`` of open() covers all tries of the request. All requests
+	of the plugin are GETs, so repeating them is safe. The tries of hedged
+	requests run on at most ``hedge_threads`` threads of their own, the
+	callers waiting for them are often threads of the shared pool.
+	'''
+
+	def __init__(self, session, retries=MAX_RETRIES, hedge_percentile=95,
+			hedge_threads=8):
+		self.session = session
+		self.retries, self.hedge_percentile = retries, hedge_percentile
+		self.pool = ThreadPool(hedge_threads, 'databazeknih-hedge')
+		self.latency = Latency()
+		self.lock = Lock()
+		self.stats = {'retries': 0, 'hedges': 0, 'hedge_wins': 0}
+
+	def count(self, name, recorder=None):
+		with self.lock:
+			self.stats[name] += 1
+		if recorder is not None:
+			recorder.count(name)
+
+	def snapshot(self):
+		with self.lock:
+			return dict(self.stats)
+
+	def open(self, url, timeout=30, headers=None, cancel=None, recorder=None):
+		deadline = time.time() + timeout
+		attempt = 0
+		while True:
+			try:
+				return self.hedged(url, deadline, headers, cancel, recorder)
+			except Cancelled:
+				raise
+			except Exception as e:
+				if attempt >= self.retries or not retryable(e):
+					raise
+				delay = backoff(attempt)
+				if time.time() + delay + MIN_TIMEOUT > deadline:
+					raise
+			attempt += 1
+			self.count('retries', recorder)
+			pause(delay, cancel)
+
+	open_novisit = open
+
+	def timed(self, url, timeout, headers, cancel):
+		started = time.time()
+		response = self.session.open(url, timeout=timeout, headers=headers,
+				cancel=cancel)
+		self.latency.add(time.time() - started)
+		return response
+
+	def hedged(self, url, deadline, headers, cancel, recorder):
+		'''
+		One try of the request, run twice when the first one is slow
+		'''
+		timeout = max(MIN_TIMEOUT, deadline - time.time())
+		delay = None
+		if self.hedge_percentile:
+			delay = self.latency.percentile(self.hedge_percentile)
+		if delay is None or delay >= timeout:
+			return self.timed(url, timeout, headers, cancel)
+
+		lock, outcomes, tokens = Lock(), Queue(), []
+		decided = [False]
+
+		def run(token):
+			try:
+				response = self.timed(url, max(MIN_TIMEOUT, deadline - time.time()),
+						headers, token)
+			except Exception as e:
+				outcomes.put((token, None, e))
+				return
+			with lock:
+				if decided[0]:
+					# The other request won meanwhile
+					response.close()
+					return
+				outcomes.put((token, response, None))
+
+		def launch():
+			token = CancelToken()
+			if cancel is not None and not cancel.register(token.cancel):
+				raise Cancelled()
+			tokens.append(token)
+			self.pool.submit(run, token)
+
+		launch()
+		try:
+			token, response, error = outcomes.get(timeout=delay)
+		except Empty:
+			self.count('hedges', recorder)
+			launch()
+			token, response, error = outcomes.get()
+		running = len(tokens) - 1
+		while response is None and running:
+			# The first one failed, the other may still succeed
+			token, response, error = outcomes.get()
+			running -= 1
+		with lock:
+			decided[0] = True
+			late = []
+			while True:
+				try:
+					late.append(outcomes.get_nowait())
+				except Empty:
+					break
+		for other in late:
+			if other[1] is not None:
+				other[1].close()
+		for t in tokens:
+			if t is token and response is not None:
+				# The token of the response used stays linked to cancel, which
+				# interrupts reading its body, until the body is read
+				if cancel is not None:
+					response.add_done_callback(lambda: cancel.unregister(token.cancel))
+				continue
+			if cancel is not None:
+				cancel.unregister(t.cancel)
+			t.cancel()
+		if response is None:
+			raise error
+		if len(tokens) > 1 and token is tokens[1]:
+			self.count('hedge_wins', recorder)
+		return response
+
+
+def shared_policy():
+	'''
+	The policy used by every request of the plugin, over the shared session
+	'''
+	global _policy
+	with _lock:
+		if _policy is None:
+			from calibre_plugins.databazeknih.session import shared_session
+			import calibre_plugins.databazeknih.config as cfg
+			_policy = RequestPolicy(shared_session(),
+					hedge_percentile=cfg.get_option(cfg.KEY_HEDGE_PERCENTILE),
+					hedge_threads=HEDGE_THREADS_PER_WORKER *
+						cfg.get_option(cfg.KEY_MAX_WORKERS))
+		return _policy
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import codecs, csv, hashlib, io, json, os, sqlite3, sys, time, traceback
+from threading import Event, Lock, RLock
+try:
+	from Queue import Queue, Empty
+except ImportError:
+	from queue import Queue, Empty
+
+# Books identified together, the progress is saved after each chunk
+PREFETCH_CHUNK = 20
+# Requests per second the prefetch may make, interactive downloads have
+# KEY_MAX_RATE
+PREFETCH_RATE = 2.0
+# The prefetch runs in its own process, which is made nicer by this much
+PREFETCH_NICENESS = 10
+
+_lock = RLock()
+_progress = None
+
+
+class ErrorLog(object):
+	'''
+	Log of the prefetch, only errors are printed
+	'''
+
+	def info(self, *args, **kwargs):
+		pass
+
+	debug = info
+
+	def error(self, *args, **kwargs):
+		print(' '.join('%s'%arg for arg in args), file=sys.stderr)
+
+	warn = warning = error
+
+	def exception(self, *args, **kwargs):
+		self.error(*args)
+		traceback.print_exc()
+
+	def __call__(self, *args, **kwargs):
+		pass
+
+
+def parse_identifiers(text):
+	'''
+	Identifiers written like calibre does in its CSV catalog,
+	``isbn:9788020412345,databazeknih:krakatit-123``
+	'''
+	identifiers = {}
+	for item in text.split(','):
+		key, sep, value = item.partition(':')
+		if sep and key.strip() and value.strip():
+			identifiers[key.strip()] = value.strip()
+	return identifiers
+
+
+def csv_rows(text):
+	'''
+	Rows of a CSV file with a header as dicts keyed by lower case column names
+	'''
+	if sys.version_info[0] < 3:
+		reader = csv.reader(io.BytesIO(text.encode('utf-8')))
+		rows = [[cell.decode('utf-8') for cell in row] for row in reader]
+	else:
+		rows = list(csv.reader(io.StringIO(text)))
+	if not rows:
+		return []
+	header = [name.strip().lower() for name in rows[0]]
+	return [dict(zip(header, row)) for row in rows[1:]]
+
+
+def read_books(path):
+	'''
+	(title, authors, identifiers) of the books listed in the file: the JSON
+	of ``calibredb list --fields title,authors,identifiers --for-machine``
+	or a CSV with title, authors and identifiers columns, like the CSV
+	catalog of calibre. Several authors are separated by ``&``.
+	'''
+	with open(path, 'rb') as f:
+		data = f.read()
+	if data.startswith(codecs.BOM_UTF8):
+		data = data[len(codecs.BOM_UTF8):]
+	text = data.decode('utf-8')
+	rows = json.loads(text) if text.lstrip().startswith('[') else csv_rows(text)
+	books = []
+	for row in rows:
+		title = (row.get('title') or '').strip() or None
+		authors = row.get('authors') or []
+		if not isinstance(authors, list):
+			authors = [a.strip() for a in authors.split('&') if a.strip()]
+		identifiers = row.get('identifiers') or {}
+		if not isinstance(identifiers, dict):
+			identifiers = parse_identifiers(identifiers)
+		if title or identifiers.get('databazeknih') or identifiers.get('isbn'):
+			books.append((title, authors, identifiers))
+	return books
+
+
+def book_key(title, authors, identifiers):
+	text = json.dumps([title, authors, sorted(identifiers.items())])
+	return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Progress(object):
+	'''
+	The books of every list the prefetch has finished, so that an
+	interrupted prefetch continues where it stopped
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = RLock()
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		with self.lock, self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS done ('
+					'source TEXT NOT NULL, key TEXT NOT NULL, found INTEGER NOT NULL,'
+					' finished REAL NOT NULL, PRIMARY KEY (source, key))')
+
+	def done(self, source):
+		'''
+		Keys of the finished books and how many of them were found
+		'''
+		with self.lock:
+			rows = self.conn.execute('SELECT key, found FROM done WHERE source=?',
+					(source,)).fetchall()
+		return set(key for key, found in rows), sum(found for key, found in rows)
+
+	def mark(self, source, items):
+		'''
+		Store (key, found) of finished books in a single transaction
+		'''
+		now = time.time()
+		with self.lock, self.conn:
+			self.conn.executemany('INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)',
+					[(source, key, int(found), now) for key, found in items])
+
+	def forget(self, source):
+		with self.lock, self.conn:
+			self.conn.execute('DELETE FROM done WHERE source=?', (source,))
+
+
+def prefetch_progress():
+	global _progress
+	with _lock:
+		if _progress is None:
+			import calibre_plugins.databazeknih.config as cfg
+			_progress = Progress(os.path.join(cfg.plugin_data_dir(), 'prefetch.sqlite'))
+		return _progress
+
+
+class Prefetch(object):
+	'''
+	Identifies a list of books in the background so that later identify
+	and download_cover calls find everything in the caches: the search
+	results, the book details, the ISBNs and, when the cover cache is on,
+	the covers.
+
+	The books go through Batch, PREFETCH_CHUNK books at a time, and all
+	requests of the process are kept below ``rate`` per second. Books of a
+	finished chunk are recorded in the Progress, an interrupted prefetch
+	of the same ``source`` skips them. The progress is forgotten once the
+	whole list is done, so running the prefetch again refreshes the caches.
+	'''
+
+	def __init__(self, plugin, log, rate=PREFETCH_RATE, abort=None, timeout=30,
+			out=print):
+		self.plugin, self.log, self.rate = plugin, log, rate
+		self.abort = abort if abort is not None else Event()
+		self.timeout, self.out = timeout, out
+		self.lock = Lock()
+		self.stats = {'books': 0, 'done': 0, 'found': 0, 'covers': 0}
+
+	def run(self, source, books):
+		'''
+		Returns True when all books are done
+		'''
+		progress = prefetch_progress()
+		done, found = progress.done(source)
+		todo = [book for book in books if book_key(*book) not in done]
+		self.stats.update(books=len(books), done=len(books) - len(todo), found=found)
+		self.out('Prefetching %d of %d books at %.1f pages/s'%(len(todo),
+			len(books), self.rate))
+		session = self.plugin.policy.session
+		# The asyncio engine shares the throttle of the session
+		if session.throttle is not None:
+			session.throttle.set_rate(self.rate)
+		self.started, self.requests = time.time(), session.snapshot()['requests']
+		for start in range(0, len(todo), PREFETCH_CHUNK):
+			chunk = todo[start:start + PREFETCH_CHUNK]
+			best = self.identify(chunk)
+			if best is None:
+				return False
+			self.fetch_covers(best.values())
+			if self.abort.is_set():
+				return False
+			progress.mark(source, [(book_key(*book), index in best)
+				for index, book in enumerate(chunk)])
+			self.stats['done'] += len(chunk)
+			self.stats['found'] += len(best)
+			self.report()
+		progress.forget(source)
+		return True
+
+	def identify(self, books):
+		'''
+		The best match of every book found, by position in books, None when
+		aborted
+		'''
+		from calibre_plugins.databazeknih.batch import Batch
+		results = Queue()
+		if not Batch(self.plugin, self.log, results, self.abort,
+				self.timeout).run(books):
+			return None
+		best = {}
+		while True:
+			try:
+				index, mi = results.get_nowait()
+			except Empty:
+				break
+			if mi is not None and (index not in best or
+					mi.source_relevance < best[index].source_relevance):
+				best[index] = mi
+		return best
+
+	def fetch_covers(self, matches):
+		from calibre_plugins.databazeknih.cache import cover_cache
+		from calibre_plugins.databazeknih.executor import TaskGroup, shared_pool
+		if cover_cache() is None:
+			return
+		group = TaskGroup(shared_pool())
+		for databazeknih_id in set(mi.identifiers.get('databazeknih') for mi in matches):
+			if databazeknih_id:
+				group.submit(self.fetch_cover, databazeknih_id)
+		group.wait(self.abort)
+
+	def fetch_cover(self, databazeknih_id):
+		covers = Queue()
+		self.plugin.download_cover(self.log, covers, self.abort,
+				identifiers={'databazeknih': databazeknih_id}, timeout=self.timeout)
+		if not covers.empty():
+			with self.lock:
+				self.stats['covers'] += 1
+
+	def report(self):
+		elapsed = time.time() - self.started
+		requests = self.plugin.policy.session.snapshot()['requests'] - self.requests
+		self.out('%d of %d books, %d found, %d covers, %d pages, %.1f pages/s'%(
+			self.stats['done'], self.stats['books'], self.stats['found'],
+			self.stats['covers'], requests, requests / elapsed if elapsed else 0))
+
+
+def main(args, plugin=None):
+	'''
+	calibre-debug -r Databazeknih -- prefetch FILE [PAGES_PER_S]
+	'''
+	if plugin is None:
+		from calibre_plugins.databazeknih import databazeknih
+		plugin = databazeknih(None)
+	if hasattr(os, 'nice'):
+		os.nice(PREFETCH_NICENESS)
+	path = os.path.abspath(args[0])
+	rate = float(args[1]) if len(args) > 1 else PREFETCH_RATE
+	prefetch = Prefetch(plugin, ErrorLog(), rate)
+	try:
+		finished = prefetch.run(path, read_books(path))
+	except KeyboardInterrupt:
+		prefetch.abort.set()
+		finished = False
+	if finished:
+		print('All books prefetched')
+	else:
+		print('Interrupted after %(done)d of %(books)d books, run the prefetch'
+				' again to continue'%prefetch.stats)
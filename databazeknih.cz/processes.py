@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import sys
+from threading import Event, Lock
+from calibre_plugins.databazeknih.executor import Cancelled
+
+EXTRACT_MODULE = 'calibre_plugins.databazeknih.extract'
+# Run in every new parse process with SOURCE being the source of extract.py.
+# The plugin zip cannot be imported there, extract only needs lxml.
+BOOTSTRAP = '''
+import sys, types
+for name in ('calibre_plugins', 'calibre_plugins.databazeknih'):
+	if name not in sys.modules:
+		sys.modules[name] = types.ModuleType(name)
+		sys.modules[name].__path__ = []
+if NAME not in sys.modules:
+	module = types.ModuleType(NAME)
+	module.__file__ = 'extract.py'
+	exec(compile(SOURCE, 'extract.py', 'exec'), module.__dict__)
+	sys.modules[NAME] = module
+	sys.modules['calibre_plugins.databazeknih'].extract = module
+'''
+
+_lock = Lock()
+_pool = None
+
+
+def extract_source(plugin):
+	'''
+	Source of extract.py, from the plugin zip when the loader does not have it
+	'''
+	import calibre_plugins.databazeknih.extract as extract
+	try:
+		source = extract.__loader__.get_source(EXTRACT_MODULE)
+	except Exception:
+		source = None
+	if source is None:
+		source = plugin.load_resources(['extract.py'])['extract.py']
+	if isinstance(source, bytes):
+		source = source.decode('utf-8')
+	return source
+
+
+class ParsePool(object):
+	'''
+	Parses whole book pages in ``processes`` worker processes, which do
+	not compete for the GIL with the threads downloading the pages. A page
+	goes in as bytes, the raw values of its details come back and the
+	fields and the Metadata are made in calibre's process.
+
+	The processes are spawned, forking calibre with its threads running is
+	not safe. When they die, pages are parsed by the calling thread.
+	'''
+
+	def __init__(self, processes, source):
+		import builtins, multiprocessing
+		from concurrent.futures import ProcessPoolExecutor
+		self.processes = processes
+		# exec is a statement on Python 2, where this module is compiled too
+		self.executor = ProcessPoolExecutor(processes,
+				mp_context=multiprocessing.get_context('spawn'),
+				initializer=getattr(builtins, 'exec'), initargs=(BOOTSTRAP,
+					{'SOURCE': source, 'NAME': EXTRACT_MODULE}))
+		self.broken = False
+
+	def submit(self, data):
+		from calibre_plugins.databazeknih.extract import page_values
+		return self.executor.submit(page_values, data)
+
+	def parse(self, data, cancel=None):
+		'''
+		Raw values of the book details of the page, see page_values().
+		Raises Cancelled when the token is cancelled while waiting.
+		'''
+		from concurrent.futures import BrokenExecutor
+		from calibre_plugins.databazeknih.extract import page_values
+		if self.broken:
+			return page_values(data)
+		try:
+			future = self.submit(data)
+			if cancel is not None:
+				woken = Event()
+				future.add_done_callback(lambda f: woken.set())
+				if not cancel.register(woken.set):
+					future.cancel()
+					raise Cancelled()
+				try:
+					woken.wait()
+				finally:
+					cancel.unregister(woken.set)
+				if not future.done():
+					future.cancel()
+					cancel.check()
+			return future.result()
+		except BrokenExecutor:
+			self.broken = True
+			return page_values(data)
+
+	def close(self):
+		self.executor.shutdown(wait=False)
+
+
+def shared_parse_pool(plugin):
+	'''
+	The pool parsing book pages for all identify calls, None when pages
+	are parsed by the threads downloading them
+	'''
+	global _pool
+	with _lock:
+		if _pool is None:
+			import calibre_plugins.databazeknih.config as cfg
+			processes = cfg.get_option(cfg.KEY_PARSE_PROCESSES)
+			# initializer of ProcessPoolExecutor is new in Python 3.7
+			_pool = False
+			if processes and sys.version_info >= (3, 7):
+				_pool = ParsePool(processes, extract_source(plugin))
+		return _pool or None
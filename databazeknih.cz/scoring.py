@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import re, unicodedata
+from collections import namedtuple
+
+Candidate = namedtuple('Candidate', 'score exact url title authors')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+# Words of the author names on the search page that are not names
+NOT_NAMES = frozenset(('pseudonym',))
+
+
+def fold(text):
+	'''
+	Lower case words of the text without diacritics, "Čapek" -> ["capek"]
+	'''
+	if not text:
+		return []
+	if isinstance(text, bytes):
+		text = text.decode('utf-8')
+	text = unicodedata.normalize('NFKD', text)
+	text = ''.join(c for c in text if not unicodedata.combining(c))
+	return WORD.findall(text.lower())
+
+
+def title_score(query, title):
+	'''
+	Share of the words in either title that are in both, 1 for the same
+	title
+	'''
+	if not query or not title:
+		return 0.0
+	if query == title:
+		return 1.0
+	query, title = set(query), set(title)
+	return len(query & title) / len(query | title)
+
+
+def author_score(query, authors):
+	'''
+	0 unless the surname of one of the authors of the search result is in
+	the authors asked for, then the share of their names that are
+	'''
+	best = 0.0
+	for author in authors:
+		names = [n for n in fold(author) if n not in NOT_NAMES]
+		if names and names[-1] in query:
+			best = max(best, sum(1 for n in names if n in query) / len(names))
+	return best
+
+
+def same_authors(query, authors):
+	'''
+	True when the surname of one of the authors is in the authors asked for
+	and the other names of one are a subset of the other, "Rowling" and
+	"J. K. Rowling" are the same, "Karel Čapek" and "Josef Čapek" are not
+	'''
+	for author in authors:
+		names = [n for n in fold(author) if n not in NOT_NAMES]
+		if names and names[-1] in query and (set(names) <= query or query <= set(names)):
+			return True
+	return False
+
+
+def rank(hits, title, authors, limit):
+	'''
+	Score the search results against the title and authors asked for and
+	return at most ``limit`` best candidates, best first. Results by other
+	authors are dropped. When the best one matches exactly, it is the only
+	candidate.
+	'''
+	query_title = fold(title)
+	query_authors = set()
+	for author in authors or ():
+		query_authors.update(fold(author))
+	candidates = []
+	for hit in hits:
+		found_authors = author_score(query_authors, hit['authors']) if query_authors else None
+		if found_authors == 0:
+			continue
+		found_title = title_score(query_title, fold(hit['title']))
+		exact = bool(query_title) and found_title == 1.0 and (found_authors is None
+				or same_authors(query_authors, hit['authors']))
+		candidates.append(Candidate(found_title + (found_authors or 0), exact,
+			hit['url'], hit['title'], hit['authors']))
+	# sorted() is stable, equal scores keep the order of the search page
+	candidates = sorted(candidates, key=lambda c: (c.exact, c.score), reverse=True)
+	if candidates and candidates[0].exact:
+		return candidates[:1]
+	return candidates[:max(1, limit)]
+
+
+class Candidates(object):
+	'''
+	Ranks the search results page by page. Every page adds its best
+	candidates until ``limit`` are found or one matches exactly, after that
+	no more pages are ``wanted``.
+	'''
+
+	def __init__(self, title, authors, limit):
+		self.title, self.authors, self.limit = title, authors, max(1, limit)
+		self.found, self.exact = 0, False
+
+	@property
+	def wanted(self):
+		return not self.exact and self.found < self.limit
+
+	def add(self, hits):
+		'''
+		The candidates of the next page, best first
+		'''
+		ranked = rank(hits, self.title, self.authors, self.limit - self.found)
+		self.found += len(ranked)
+		self.exact = bool(ranked) and ranked[0].exact
+		return ranked
+
+
+def same_book(title, authors, found_title, found_authors):
+	'''
+	True when the book found has the title and authors asked for, up to case
+	and diacritics
+	'''
+	query_title, query_authors = fold(title), set()
+	for author in authors or ():
+		query_authors.update(fold(author))
+	return bool(query_title) and bool(query_authors) and \
+			query_title == fold(found_title) and \
+			same_authors(query_authors, found_authors or ())
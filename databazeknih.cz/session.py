@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import re, socket, sys, time, zlib
+from functools import partial
+from io import BytesIO
+from threading import Condition, Lock
+try:
+	from httplib import HTTPConnection, HTTPSConnection, HTTPException
+	from urllib import quote
+	from urllib2 import HTTPError
+	from urlparse import urljoin, urlsplit, urlunsplit
+except ImportError:
+	from http.client import HTTPConnection, HTTPSConnection, HTTPException
+	from urllib.error import HTTPError
+	from urllib.parse import quote, urljoin, urlsplit, urlunsplit
+from calibre_plugins.databazeknih.executor import Cancelled
+from calibre_plugins.databazeknih.throttle import OVERLOAD_STATUSES, Throttle
+
+MAX_REDIRECTS = 5
+# How many times a request is repeated when the server asks to slow down
+MAX_OVERLOAD_RETRIES = 2
+# Idle connections older than this are not reused, the server has most
+# likely closed them already
+IDLE_TIMEOUT = 15
+# Sent with every request unless the caller sets its own Accept-Encoding
+ACCEPT_ENCODING = 'gzip, deflate'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+PERCENT_ESCAPE = re.compile(r'%[0-9a-fA-F]{2}')
+
+_lock = Lock()
+_session = None
+
+
+def native_string(x):
+	if sys.version_info[0] < 3 and isinstance(x, unicode):
+		return x.encode('utf-8')
+	return x
+
+
+def quote_url(url):
+	'''
+	Percent-encode characters that cannot be sent in a request line
+	'''
+	try:
+		url.encode('ascii')
+		return url
+	except UnicodeError:
+		return quote(url.encode('utf-8'), safe=b"/%?=&;:+,@!$'()*~#")
+
+
+def canonical_url(url):
+	'''
+	One spelling of the URLs that request the same resource: percent-encoded
+	with upper case escapes, lower case scheme and host, no default port,
+	no fragment and the query parameters sorted
+	'''
+	parts = urlsplit(quote_url(url))
+	scheme = parts.scheme.lower()
+	host = parts.hostname or ''
+	if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+		host += ':%d'%parts.port
+	query = '&'.join(sorted(param for param in parts.query.split('&') if param))
+	url = urlunsplit((scheme, host, parts.path or '/', query, ''))
+	return PERCENT_ESCAPE.sub(lambda m: m.group(0).upper(), url)
+
+
+def interrupt(conn):
+	'''
+	Wake up a thread blocked on the connection, used from another thread
+	'''
+	conn.interrupted = True
+	sock = conn.sock
+	if sock is not None:
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+
+class HostSlots(object):
+	'''
+	The requests that may run against one host at the same time
+	'''
+
+	def __init__(self, limit):
+		self.limit, self.used = limit, 0
+		self.cond = Condition()
+
+	def acquire(self, timeout=None, cancel=None):
+		'''
+		Wait for a free slot. Raises socket.timeout when there is none within
+		timeout seconds, Cancelled when the cancel token is cancelled
+		meanwhile.
+		'''
+		if cancel is not None and not cancel.register(self.wake):
+			cancel.check()
+		try:
+			deadline = None if timeout is None else time.time() + timeout
+			with self.cond:
+				while True:
+					if cancel is not None:
+						cancel.check()
+					if self.used < self.limit:
+						self.used += 1
+						return
+					wait = None
+					if deadline is not None:
+						wait = deadline - time.time()
+						if wait <= 0:
+							raise socket.timeout('No free connection to databazeknih.cz')
+					self.cond.wait(wait)
+		finally:
+			if cancel is not None:
+				cancel.unregister(self.wake)
+
+	def release(self):
+		with self.cond:
+			if self.used <= 0:
+				raise ValueError('Slot released too many times')
+			self.used -= 1
+			self.cond.notify_all()
+
+	def wake(self):
+		with self.cond:
+			self.cond.notify_all()
+
+
+class Decoder(object):
+	'''
+	Decompresses a gzip or deflate body chunk by chunk. Servers send deflate
+	both with and without the zlib header, the first chunk tells which.
+	'''
+
+	def __init__(self, encoding):
+		self.encoding = encoding
+		self.zlib = None
+
+	def decode(self, data):
+		if self.zlib is None:
+			if self.encoding == 'gzip':
+				self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			else:
+				self.zlib = zlib.decompressobj(zlib.MAX_WBITS)
+				try:
+					return self.zlib.decompress(data)
+				except zlib.error:
+					self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+		return self.zlib.decompress(data)
+
+	def flush(self):
+		return self.zlib.flush() if self.zlib is not None else b''
+
+
+def decoder(resp):
+	encoding = (resp.getheader('Content-Encoding') or '').strip().lower()
+	if encoding in ('gzip', 'x-gzip'):
+		return Decoder('gzip')
+	if encoding == 'deflate':
+		return Decoder('deflate')
+	return None
+
+
+class Response(object):
+	'''
+	A response whose connection returns to the pool once the body is read.
+	Offers the subset of the mechanize response API the plugin uses.
+
+	Compressed bodies are decompressed while they are read, ``wire_bytes``
+	and ``body_bytes`` count the bytes received and the bytes after
+	decompression.
+	'''
+
+	def __init__(self, session, key, conn, resp, url, cancel=None, interrupter=None):
+		self.session, self.key, self.conn = session, key, conn
+		self.resp, self.url = resp, url
+		self.cancel, self.interrupter = cancel, interrupter
+		self.code = resp.status
+		self.decoder = decoder(resp)
+		self.pending = b''
+		self.wire_bytes = self.body_bytes = 0
+		self.done_callbacks = []
+
+	def info(self):
+		return self.resp.msg
+
+	def getcode(self):
+		return self.code
+
+	def geturl(self):
+		return self.url
+
+	def read(self, size=-1):
+		'''
+		Read at most size bytes of the decompressed body, all of it when
+		size is negative
+		'''
+		whole = size is None or size < 0
+		if self.decoder is None:
+			data = self.read_raw(size)
+			self.body_bytes += len(data)
+			self.session.count('body_bytes', len(data))
+			return data
+		while (whole or len(self.pending) < size) and self.conn is not None:
+			data = self.read_raw(size)
+			self.pending += self.decoder.decode(data)
+			if self.conn is None:
+				self.pending += self.decoder.flush()
+		if whole:
+			data, self.pending = self.pending, b''
+		else:
+			data, self.pending = self.pending[:size], self.pending[size:]
+		self.body_bytes += len(data)
+		self.session.count('body_bytes', len(data))
+		return data
+
+	def transferred(self):
+		'''
+		Size of the body read so far, for the log
+		'''
+		if self.decoder is None:
+			return '%d bytes'%self.body_bytes
+		return '%d bytes, %d compressed'%(self.body_bytes, self.wire_bytes)
+
+	def read_raw(self, size=-1):
+		if self.conn is None:
+			return b''
+		try:
+			data = self.resp.read() if size is None or size < 0 else self.resp.read(size)
+		except:
+			self.close()
+			if self.cancel is not None and self.cancel.is_set():
+				raise Cancelled()
+			raise
+		if not data and self.cancel is not None and self.cancel.is_set():
+			self.close()
+			raise Cancelled()
+		self.wire_bytes += len(data)
+		self.session.count('wire_bytes', len(data))
+		if not data or size is None or size < 0 or self.resp.isclosed():
+			self.release()
+		return data
+
+	def release(self):
+		'''
+		Give the connection back to the pool, the body was read completely
+		'''
+		if self.conn is not None:
+			conn, self.conn = self.conn, None
+			self.stop_watching()
+			self.session.checkin(self.key, conn, not self.resp.will_close)
+
+	def close(self):
+		'''
+		Stop reading. A connection with unread body cannot be reused.
+		'''
+		# Decoded data nobody read is not needed any more
+		self.pending = b''
+		if self.conn is not None:
+			conn, self.conn = self.conn, None
+			self.stop_watching()
+			self.session.checkin(self.key, conn, self.resp.isclosed() and
+					not self.resp.will_close)
+
+	def stop_watching(self):
+		if self.cancel is not None:
+			self.cancel.unregister(self.interrupter)
+		callbacks, self.done_callbacks = self.done_callbacks, []
+		for callback in callbacks:
+			callback()
+
+	def add_done_callback(self, callback):
+		'''
+		Run callback once the body is read or the response is closed
+		'''
+		if self.conn is None:
+			callback()
+		else:
+			self.done_callbacks.append(callback)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class Session(object):
+	'''
+	Keep-alive HTTP connections shared by all requests of the plugin.
+
+	At most ``max_per_host`` requests run against one host at the same time,
+	the others wait for a free connection. ``stats`` counts how often an
+	idle connection could be reused instead of opening a new one and how
+	many bytes were received before and after decompression. Every request
+	also waits for the ``throttle``, if any.
+	'''
+
+	def __init__(self, headers=None, max_per_host=4, proxies=None, throttle=None):
+		self.headers = dict(headers or {})
+		self.max_per_host = max_per_host
+		self.proxies = proxies or {}
+		self.throttle = throttle
+		self.lock = Lock()
+		self.idle, self.slots = {}, {}
+		self.stats = {'requests': 0, 'connections_opened': 0,
+				'connections_reused': 0, 'stale_retries': 0, 'overload_retries': 0,
+				'wire_bytes': 0, 'body_bytes': 0}
+
+	def count(self, name, value=1):
+		with self.lock:
+			self.stats[name] += value
+
+	def snapshot(self):
+		with self.lock:
+			return dict(self.stats)
+
+	def slot(self, key):
+		with self.lock:
+			if key not in self.slots:
+				self.slots[key] = HostSlots(self.max_per_host)
+			return self.slots[key]
+
+	def checkout(self, key, timeout, cancel=None):
+		'''
+		Wait for a free slot on the host and return an idle connection, or
+		a new one when there is none. Both waits together take at most
+		``timeout`` seconds and end when ``cancel`` is cancelled.
+		'''
+		started = time.time()
+		if self.throttle is not None:
+			self.throttle.acquire(timeout, cancel)
+		remaining = None if timeout is None else max(0, timeout - (time.time() - started))
+		try:
+			self.slot(key).acquire(remaining, cancel)
+		except:
+			if self.throttle is not None:
+				self.throttle.release()
+			raise
+		now = time.time()
+		with self.lock:
+			idle = self.idle.get(key, [])
+			while idle:
+				conn, since = idle.pop()
+				if now - since < IDLE_TIMEOUT:
+					self.stats['connections_reused'] += 1
+					if conn.sock is not None:
+						conn.sock.settimeout(timeout)
+					return conn, True
+				conn.close()
+			self.stats['connections_opened'] += 1
+		scheme, host, port, tunnel = key
+		cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+		conn = cls(native_string(host), port, timeout=timeout)
+		if tunnel and scheme == 'https':
+			conn.set_tunnel(native_string(tunnel[0]), tunnel[1])
+		return conn, False
+
+	def checkin(self, key, conn, reusable):
+		if reusable and not getattr(conn, 'interrupted', False):
+			with self.lock:
+				self.idle.setdefault(key, []).append((conn, time.time()))
+		else:
+			conn.close()
+		self.slot(key).release()
+		if self.throttle is not None:
+			self.throttle.release()
+
+	def close(self):
+		'''
+		Close the idle connections
+		'''
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for conn, since in conns:
+				conn.close()
+
+	def connection_key(self, parts):
+		default_port = 443 if parts.scheme == 'https' else 80
+		port = parts.port or default_port
+		proxy = self.proxies.get(parts.scheme)
+		if proxy:
+			proxy = proxy.partition('://')[2] or proxy
+			phost, _, pport = proxy.rpartition(':')
+			if not phost:
+				phost, pport = pport, 80
+			return (parts.scheme, phost, int(pport), (parts.hostname, port))
+		return (parts.scheme, parts.hostname, port, None)
+
+	def open(self, url, timeout=30, headers=None, cancel=None):
+		'''
+		GET the url following redirects. Returns a Response, raises HTTPError
+		for error statuses and for 304 Not Modified, like urllib2 does.
+		Requests refused with 429/503 are repeated once the throttle allows.
+
+		Cancelling the ``cancel`` token interrupts the request and reading
+		of the response, they raise Cancelled then.
+		'''
+		redirects = retries = 0
+		while True:
+			response = self.request(url, timeout, headers, cancel)
+			if response.code in (301, 302, 303, 307, 308) and redirects < MAX_REDIRECTS:
+				location = response.info().get('Location')
+				response.read()
+				if not location:
+					break
+				url = urljoin(url, location)
+				redirects += 1
+				continue
+			if response.code in OVERLOAD_STATUSES and self.throttle is not None \
+					and retries < MAX_OVERLOAD_RETRIES:
+				response.read()
+				retries += 1
+				self.count('overload_retries')
+				continue
+			break
+		if response.code >= 300:
+			body = response.read()
+			raise HTTPError(url, response.code, response.resp.reason,
+					response.info(), BytesIO(body))
+		return response
+
+	open_novisit = open
+
+	def request(self, url, timeout, headers, cancel=None):
+		url = quote_url(url)
+		parts = urlsplit(url)
+		key = self.connection_key(parts)
+		if key[3] and parts.scheme == 'http':
+			path = url
+		else:
+			path = parts.path or '/'
+			if parts.query:
+				path += '?' + parts.query
+		all_headers = {'Accept-Encoding': ACCEPT_ENCODING}
+		all_headers.update(self.headers)
+		all_headers.update(headers or {})
+		all_headers['Host'] = parts.netloc
+		all_headers = dict((native_string(k), native_string(v))
+				for k, v in all_headers.items())
+		self.count('requests')
+		while True:
+			if cancel is not None:
+				cancel.check()
+			conn, reused = self.checkout(key, timeout, cancel)
+			interrupter = None
+			if cancel is not None:
+				interrupter = partial(interrupt, conn)
+				if not cancel.register(interrupter):
+					self.checkin(key, conn, reused)
+					raise Cancelled()
+			started = time.time()
+			try:
+				conn.request(native_string('GET'), native_string(path), headers=all_headers)
+				resp = conn.getresponse()
+			except (HTTPException, socket.error) as e:
+				if cancel is not None:
+					cancel.unregister(interrupter)
+					if cancel.is_set():
+						self.checkin(key, conn, False)
+						raise Cancelled()
+				if self.throttle is not None and isinstance(e, socket.timeout):
+					self.throttle.observe(started, timed_out=True)
+				self.checkin(key, conn, False)
+				if reused and not isinstance(e, socket.timeout):
+					# The server closed the idle connection meanwhile
+					self.count('stale_retries')
+					continue
+				raise
+			except:
+				if cancel is not None:
+					cancel.unregister(interrupter)
+				self.checkin(key, conn, False)
+				raise
+			if self.throttle is not None:
+				self.throttle.observe(started, resp.status, resp.getheader('Retry-After'))
+			return Response(self, key, conn, resp, url, cancel, interrupter)
+
+
+def shared_session():
+	'''
+	The session used by every request of the plugin
+	'''
+	global _session
+	with _lock:
+		if _session is None:
+			from calibre import browser, get_proxies
+			import calibre_plugins.databazeknih.config as cfg
+			max_per_host = cfg.get_option(cfg.KEY_MAX_CONNECTIONS)
+			_session = Session(headers=browser().addheaders,
+					max_per_host=max_per_host, proxies=get_proxies(),
+					throttle=Throttle(cfg.get_option(cfg.KEY_MAX_RATE), max_per_host))
+		return _session
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+import socket, time
+from email.utils import mktime_tz, parsedate_tz
+from threading import Condition
+
+# Statuses by which the server asks to slow down
+OVERLOAD_STATUSES = (429, 503)
+# Pause after an overload status without Retry-After, seconds
+DEFAULT_PAUSE = 1.0
+# Longer Retry-After values are capped
+MAX_PAUSE = 60.0
+# A response is slow when it takes SLOW_FACTOR times longer than the usual
+# ones, but at least SLOW_LATENCY seconds
+SLOW_FACTOR = 4
+SLOW_LATENCY = 2.0
+# How fast the usual latency follows slower responses
+BASELINE_WEIGHT = 0.02
+
+
+def retry_after(value):
+	'''
+	Seconds to wait from a Retry-After header, given in seconds or as a date
+	'''
+	if not value:
+		return None
+	try:
+		seconds = float(value)
+	except ValueError:
+		parsed = parsedate_tz(value)
+		if parsed is None:
+			return None
+		seconds = mktime_tz(parsed) - time.time()
+	return min(max(seconds, 0), MAX_PAUSE)
+
+
+class Throttle(object):
+	'''
+	Limits all requests to the site. A token bucket keeps the request rate
+	below ``rate`` per second, allowing bursts of ``rate`` requests. The
+	number of requests in flight is limited by a window adjusted by AIMD:
+	it grows by one per full window of fast responses and halves on a
+	timeout, a slow response or 429/503. Retry-After pauses all requests.
+	'''
+
+	def __init__(self, rate, max_concurrency, min_concurrency=1):
+		self.rate = rate
+		self.burst = max(1.0, rate)
+		self.tokens, self.refilled = self.burst, time.time()
+		self.min_concurrency = min_concurrency
+		self.max_concurrency = max(min_concurrency, max_concurrency)
+		self.window = float(self.max_concurrency)
+		self.in_flight = 0
+		self.paused_until = self.decreased = 0
+		self.baseline = None
+		self.cond = Condition()
+		self.stats = {'waits': 0, 'waited': 0.0, 'decreases': 0, 'pauses': 0}
+		# Called whenever waiting requests may start, for waiters that do not
+		# wait on cond, like the asyncio engine
+		self.watchers = []
+
+	def watch(self, callback):
+		self.watchers.append(callback)
+
+	def notify(self):
+		'''
+		Wake the waiting requests, called with cond held
+		'''
+		self.cond.notify_all()
+		for callback in self.watchers:
+			callback()
+
+	def snapshot(self):
+		with self.cond:
+			stats = dict(self.stats)
+			stats['window'] = self.window
+			return stats
+
+	def set_rate(self, rate):
+		'''
+		Change the request rate, e.g. for a background job
+		'''
+		with self.cond:
+			self.refill(time.time())
+			self.rate = rate
+			self.burst = max(1.0, rate)
+			self.tokens = min(self.tokens, self.burst)
+			self.notify()
+
+	def refill(self, now):
+		if self.rate:
+			self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+		self.refilled = now
+
+	def acquire(self, timeout=None, cancel=None):
+		'''
+		Wait until a request may start. Raises socket.timeout when that
+		does not happen within timeout seconds, Cancelled when the cancel
+		token is cancelled meanwhile.
+		'''
+		if cancel is not None and not cancel.register(self.wake):
+			cancel.check()
+		try:
+			self.wait_for_turn(timeout, cancel)
+		finally:
+			if cancel is not None:
+				cancel.unregister(self.wake)
+
+	def wake(self):
+		with self.cond:
+			self.cond.notify_all()
+
+	def wait_for_turn(self, timeout, cancel):
+		start = time.time()
+		deadline = None if timeout is None else start + timeout
+		with self.cond:
+			while True:
+				if cancel is not None:
+					cancel.check()
+				now = time.time()
+				wait = self.turn(now, start)
+				if wait == 0:
+					return
+				if deadline is not None:
+					if self.expired(now, deadline):
+						raise socket.timeout('Too many requests to databazeknih.cz')
+					remaining = deadline - now
+					wait = remaining if wait is None else min(wait, remaining)
+				self.cond.wait(wait)
+
+	def turn(self, now, start):
+		'''
+		Start a request when it may start at ``now`` and return 0, else
+		return how long to wait, None meaning until a request finishes.
+		Called with ``cond`` held, ``start`` is when the request began to wait.
+		'''
+		self.refill(now)
+		if now < self.paused_until:
+			return self.paused_until - now
+		if self.in_flight >= int(self.window):
+			return None
+		if self.rate and self.tokens < 1:
+			return (1 - self.tokens) / self.rate
+		if self.rate:
+			self.tokens -= 1
+		self.in_flight += 1
+		if now > start:
+			self.stats['waits'] += 1
+			self.stats['waited'] += now - start
+		return 0
+
+	def expired(self, now, deadline):
+		'''
+		True when a request waiting at ``now`` cannot start before deadline
+		'''
+		return now >= deadline or (now < self.paused_until and
+				self.paused_until > deadline)
+
+	def release(self):
+		with self.cond:
+			self.in_flight -= 1
+			self.notify()
+
+	def observe(self, started, status=None, retry_after_value=None, timed_out=False):
+		'''
+		Adjust the window to how the request started at ``started`` went
+		'''
+		now = time.time()
+		latency = now - started
+		with self.cond:
+			overloaded = status in OVERLOAD_STATUSES
+			slow = self.baseline is not None and status is not None and \
+					latency > max(SLOW_LATENCY, SLOW_FACTOR * self.baseline)
+			if timed_out or overloaded or slow:
+				# Requests running during the last decrease saw the same
+				# congestion, they do not decrease the window again
+				if started >= self.decreased:
+					self.window = max(self.min_concurrency, self.window / 2)
+					self.decreased = now
+					self.stats['decreases'] += 1
+				if overloaded:
+					pause = retry_after(retry_after_value)
+					self.paused_until = max(self.paused_until,
+							now + (DEFAULT_PAUSE if pause is None else pause))
+					self.stats['pauses'] += 1
+			elif status is not None and self.in_flight >= int(self.window):
+				# Grow only while the window is used, a quiet period says
+				# nothing about how many requests the site tolerates
+				self.window = min(self.max_concurrency, self.window + 1 / self.window)
+			if status is not None and not overloaded:
+				if self.baseline is None or latency < self.baseline:
+					self.baseline = latency
+				else:
+					self.baseline += (latency - self.baseline) * BASELINE_WEIGHT
+			self.notify()
@@ -8,50 +8,141 @@ __copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
 __copyright__ = 'based od Pavel Skulil <pavelsku@gmail.com>'
 __docformat__ = 'restructuredtext cs'
 
-import socket, re
-from threading import Thread
+import socket, re, sys, time
 from calibre.ebooks.metadata.book.base import Metadata
-import lxml, sys
 import lxml.html as lh
-from calibre.utils.date import utcnow
-from datetime import datetime
-from dateutil import parser
-from calibre.ebooks.metadata import MetaInformation, check_isbn
-from calibre import browser
+from calibre.ebooks.metadata import check_isbn
+from calibre_plugins.databazeknih.cache import details_cache
+from calibre_plugins.databazeknih.executor import (CancelToken, Cancelled,
+		Future, document_limit, shared_flights)
+from calibre_plugins.databazeknih.extract import (extract_fields, parse_fields,
+		isbn_nodes, stream_fields)
+from calibre_plugins.databazeknih.instrument import Recorder
+from calibre_plugins.databazeknih.session import canonical_url
 
 
-class Worker(Thread): # Get details
+def to_metadata(fields, databazeknih_id, relevance):
+	'''
+	The Metadata of a book from its parsed (or cached) fields
+	'''
+	mi = Metadata(fields['title'], fields['authors'])
+	mi.set_identifier('databazeknih', databazeknih_id)
+	if fields.get('series'):
+		mi.series, mi.series_index = fields['series'], fields.get('series_index')
+	for field in ('comments', 'tags', 'publisher', 'pubdate', 'rating', 'isbn'):
+		if fields.get(field) is not None:
+			setattr(mi, field, fields[field])
+	mi.has_cover = bool(fields.get('cover_url'))
+	mi.source_relevance = relevance
+	return mi
+
+
+class Worker(object): # Get details
 	isbn = None
 	'''
-	Get book details from antikvarium.hu book page in a separate thread
+	Get book details from databazeknih.cz book page, run() is executed by
+	a thread of the shared pool
 	'''
 
-	def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-		Thread.__init__(self)
-		self.daemon = True
+	def __init__(self, url, result_queue, session, log, relevance, plugin, timeout=20,
+			identifiers=None, group=None, cancel=None, on_result=None, recorder=None,
+			budget=None):
 		self.url, self.result_queue = url, result_queue
 		self.log, self.timeout = log, timeout
 		self.relevance, self.plugin = relevance, plugin
-		self.browser = browser.clone_browser()
+		# The RequestPolicy, requests take their timeouts from the budget of
+		# the identify call when there is one
+		self.session, self.budget = session, budget
+		self.identifiers, self.group = identifiers or {}, group
+		# Cancelling the token stops the requests of this worker,
+		# on_result(worker, mi) is called after the book was published
+		self.cancel = cancel if cancel is not None else CancelToken()
+		self.on_result = on_result
 		self.cover_url = self.databazeknih_id = None #self.isbn = None
+		self.isbn_lookup = None
+		# Timings and counters of the identify call the worker is part of
+		self.recorder = recorder if recorder is not None else Recorder('worker')
+		import calibre_plugins.databazeknih.config as cfg
+		self.quiet = cfg.get_option(cfg.KEY_QUIET_LOG)
+
+	def phase_timeout(self, phase):
+		if self.budget is None:
+			return self.timeout
+		return self.budget.phase(phase)
+
+	def debug(self, msg, *args):
+		'''
+		Log the parsed values, formatting them only when the log is not quiet
+		'''
+		if not self.quiet:
+			self.log.info(msg%args if args else msg)
 
 	def run(self):
-		self.log.info('worker jede')
+		if self.cancel.is_set():
+			return
+		self.debug('worker jede')
 		try:
 			self.get_details()
+		except Cancelled:
+			self.log.info('Cancelled: %r'%self.url)
 		except:
 			self.log.exception('get_details failed for url: %r'%self.url)
 
 	def get_details(self):
-		
+		try:
+			self.databazeknih_id = self.parse_databazeknih_id(self.url)
+		except:
+			self.log.exception('Error parsing databazeknih id for url: %r'%self.url)
+
+		# Workers of the same page running at the same time, in this or
+		# other identify calls, share one download
+		fields = shared_flights().run(('details', canonical_url(self.url)),
+				self.fetch_details, self.cancel, self.recorder)
+		if fields is not None:
+			# Every worker adds its own ISBN to the fields
+			self.publish(dict(fields))
+
+	def fetch_details(self):
+		'''
+		The checked fields of the book page, from the details cache while
+		they are fresh. None when the page could not be read.
+		'''
+		cache = details_cache() if self.databazeknih_id else None
+		entry = cache.get(self.databazeknih_id) if cache is not None else None
+		if entry is not None and entry.fresh:
+			self.log.info('Using cached details for: %s'%self.databazeknih_id)
+			self.recorder.count('cache.details_hits')
+			return entry.fields
+		if cache is not None:
+			self.recorder.count('cache.details_misses')
+
+		headers = {}
+		if entry is not None:
+			if entry.etag:
+				headers['If-None-Match'] = entry.etag
+			if entry.last_modified:
+				headers['If-Modified-Since'] = entry.last_modified
+		started = time.time()
 		try:
 #			self.log.info('Get details:%s'%self.url)
-			raw = self.browser.open_novisit(self.url, timeout=self.timeout)#.read().strip()
+			raw = self.session.open(self.url, timeout=self.phase_timeout('detail'),
+					headers=headers, cancel=self.cancel, recorder=self.recorder)
+		except Cancelled:
+			raise
 		except Exception as e:
+			self.recorder.add_span('detail.fetch', time.time() - started)
+			if entry is not None and callable(getattr(e, 'getcode', None)) and \
+					e.getcode() == 304:
+				self.log.info('Cached details still valid for: %s'%self.databazeknih_id)
+				self.recorder.count('cache.details_revalidated')
+				cache.refresh(self.databazeknih_id)
+				return entry.fields
+			self.recorder.count('errors')
+			self.recorder.count('detail.fetch.errors')
 			if callable(getattr(e, 'getcode', None)) and \
 					e.getcode() == 404:
 				self.log.error('URL malformed: %r'%self.url)
-				return
+				return None
 			attr = getattr(e, 'args', [None])
 			attr = attr if attr else [None]
 			if isinstance(attr[0], socket.timeout):
@@ -60,114 +151,181 @@ class Worker(Thread): # Get details
 			else:
 				msg = 'Failed to make details query: %r'%self.url
 				self.log.exception(msg)
-			return
+			return None
 
-		root = lh.parse(raw)
-		self.parse_details(root)
+		self.recorder.add_span('detail.fetch', time.time() - started)
+		info = raw.info()
+		import calibre_plugins.databazeknih.config as cfg
+		from calibre_plugins.databazeknih.processes import shared_parse_pool
+		pool = shared_parse_pool(self.plugin)
+		# The tree and the unread rest of the response are released before
+		# the book is published, only the extracted fields are kept
+		try:
+			with document_limit().slot(self.cancel, self.recorder):
+				if pool is not None:
+					fields = self.parse_in_process(pool, raw)
+				elif cfg.get_option(cfg.KEY_STREAMING_PARSE):
+					fields = self.parse_stream(raw)
+				else:
+					with self.recorder.span('detail.parse'):
+						root = lh.parse(raw)
+					self.log.info('Read %s of the page'%raw.transferred())
+					fields = self.parse_details(root)
+					del root
+		finally:
+			raw.close()
+			self.recorder.add_response(raw)
+		if fields is not None:
+			fields = self.check(fields)
+		if fields is not None and cache is not None:
+			cache.put(self.databazeknih_id, fields, info.get('ETag'),
+					info.get('Last-Modified'))
+		return fields
 
 	def parse_details(self, root):
-		search_data = ''
-		isbn = None
-		
+		self.log.info('Parse details:%s'%self.url)
 		try:
-			self.log.info('Parse details:%s'%self.url)
-			databazeknih_id = self.parse_databazeknih_id(self.url)
-			self.log.info('Parsed DK identifier:%s'%databazeknih_id)
+			with self.recorder.span('detail.extract'):
+				fields = extract_fields(root, self.plugin.BASE_URL, self.recorder)
 		except:
-			self.log.exception('Error parsing databazeknih id for url: %r'%self.url)
-			databazeknih_id = None
+			self.log.exception('Error parsing details for url: %r'%self.url)
+			return None
+		return fields
 
-#		self.log.info('11')
+	def parse_in_process(self, pool, raw):
+		'''
+		Download the whole page and have it parsed by the parse processes
+		'''
+		self.log.info('Parse details in a process:%s'%self.url)
+		with self.recorder.span('detail.read'):
+			data = raw.read()
+		self.log.info('Read %s of the page'%raw.transferred())
 		try:
-			title = self.parse_title(root)
-			self.log.info('Parsed title:%s'%title)
+			with self.recorder.span('detail.parse'):
+				values = pool.parse(data, self.cancel)
+			if values is None:
+				self.log.error('Empty book page: %r'%self.url)
+				return None
+			with self.recorder.span('detail.extract'):
+				return parse_fields(values, self.plugin.BASE_URL, self.recorder)
+		except Cancelled:
+			raise
 		except:
-			self.log.exception('Error parsing title for url: %r'%self.url)
-			title = None
-		
+			self.log.exception('Error parsing details for url: %r'%self.url)
+			return None
+
+	def parse_stream(self, raw):
+		'''
+		Parse the page while it downloads, the rest of it is not read
+		'''
+		self.log.info('Parse details while downloading:%s'%self.url)
 		try:
-			authors = self.parse_authors(root)
-			self.log.info('Parsed authors:%s'%authors)
+			with self.recorder.span('detail.parse'):
+				fields, size = stream_fields(raw, self.plugin.BASE_URL,
+						self.field_found, self.recorder)
+			self.log.info('Read %s of the page'%raw.transferred())
+		except Cancelled:
+			raise
 		except:
-			self.log.exception('Error parsing authors for url: %r'%self.url)
-			authors = []
+			self.log.exception('Error parsing details for url: %r'%self.url)
+			return None
+		return fields
 
-		if not title or not authors or not databazeknih_id:
-			self.log.error('Could not find title/authors/databazeknih id for %r'%self.url)
-			self.log.error('DK id: %r Title: %r Authors: %r'%(databazeknih_id, title, authors))
-			return
+	def field_found(self, name, collector):
+		if name == 'bid':
+			# The ISBN request can run while the rest of the page downloads
+			self.start_isbn_lookup(collector.raw['bid'])
 
-		mi = Metadata(title, authors)
-		self.log.info('dbki:%s'%databazeknih_id)
-		mi.set_identifier('databazeknih', databazeknih_id)
-		self.databazeknih_id = databazeknih_id
+	def check(self, fields):
+		'''
+		The parsed fields, None when the title, the authors or the id are
+		missing
+		'''
+		databazeknih_id = self.databazeknih_id
+		self.debug('Parsed DK identifier:%s', databazeknih_id)
+		self.debug('Parsed details:%s', fields)
 
-		try:
-			(mi.series, mi.series_index) = self.parse_series(root)
-			self.log.info('Parsed series:%s'%mi.series)
-			self.log.info('Parsed series index:%s'%mi.series_index)
-		except :
-			self.log.exception('Error parsing series for url: %r'%self.url)
-			series = None
-			
-		try:
-			mi.comments = self.parse_comments(root)
-			self.log.info('Parsed comments:%s'%mi.comments)
-		except:
-			self.log.exception('Error parsing comments for url: %r'%self.url)
+		if not fields['title'] or not fields['authors'] or not databazeknih_id:
+			self.log.error('Could not find title/authors/databazeknih id for %r'%self.url)
+			self.log.error('DK id: %r Title: %r Authors: %r'%(databazeknih_id,
+				fields['title'], fields['authors']))
+			return None
+		return fields
 
-		try:
-			self.cover_url = self.parse_cover(root)
-			self.log.info('Parsed URL for cover:%r'%self.cover_url)
+	def publish(self, fields):
+		'''
+		Build the Metadata from parsed (or cached) fields and hand it to calibre
+		'''
+		mi = to_metadata(fields, self.databazeknih_id, self.relevance)
+		self.debug('dbki:%s', self.databazeknih_id)
+
+		self.cover_url = fields.get('cover_url')
+		if self.cover_url:
 			self.plugin.cache_identifier_to_cover_url(self.databazeknih_id, self.cover_url)
-		except:
-			self.log.exception('Error parsing cover for url: %r'%self.url)
-		mi.has_cover = bool(self.cover_url)
 
-		try:
-			mi.tags = self.parse_tags(root)
-			self.log.info('Parsed tags:%s'%mi.tags)
-		except:
-			self.log.exception('Error parsing tags for url: %r'%self.url)
-			
-		try:
-			mi.publisher = self.parse_publisher(root)
-			self.log.info('Parsed publisher:%s'%mi.publisher)
-		except:
-			self.log.exception('Error parsing publisher for url: %r'%self.url)
+		if fields.get('isbn'):
+			self.isbn = fields['isbn']
+			self.plugin.cache_isbn_to_identifier(self.isbn, self.databazeknih_id)
+		else:
+			self.start_isbn_lookup(fields.get('bid'))
+			if self.isbn:
+				mi.isbn = fields['isbn'] = self.isbn
 			
-		try:
-			mi.pubdate = self.parse_pubdate(root)
-			self.log.info('Parsed pubdate:%s'%mi.pubdate)
-		except:
-			self.log.exception('Error parsing pubdate for url: %r'%self.url)
+#		self.plugin.clean_downloaded_metadata(mi)
+#		mi.isbn = check_isbn(mi.isbn)
+		self.debug(mi)
+		self.result_queue.put(mi)
+		if self.on_result is not None:
+			self.on_result(self, mi)
 
-			
-		try:
-			mi.rating = self.parse_rating(root)
-			self.log.info('Parsed rating:%s'%mi.rating)
-		except:
-			self.log.exception('Error parsing rating for url: %r'%self.url)
+		if self.isbn_lookup is not None:
+			# Runs right away when the ISBN is known already, otherwise once
+			# it arrives. identify waits for the lookup before returning.
+			self.isbn_lookup.add_done_callback(lambda f: self.isbn_found(mi, fields, f))
 
-		mi.source_relevance = self.relevance
+	def start_isbn_lookup(self, bid):
+		'''
+		Start the request for the ISBN in the background, unless the ISBN
+		is not needed or known already
+		'''
+		import calibre_plugins.databazeknih.config as cfg
+		if self.isbn_lookup is not None or self.isbn or not bid:
+			return
+		if not cfg.get_option(cfg.KEY_ISBN_LOOKUP) or \
+				check_isbn(self.identifiers.get('isbn', None)):
+			return
+		isbn = self.plugin.cached_bid_to_isbn(bid)
+		if isbn:
+			self.recorder.count('cache.isbn_hits')
+			self.isbn = isbn
+			return
+		self.bid = bid
+		if self.group is not None:
+			self.isbn_lookup = self.group.submit(self.parse_isbn, bid)
+		else:
+			self.isbn_lookup = Future()
+			try:
+				self.isbn_lookup.set_result(self.parse_isbn(bid))
+			except:
+				self.isbn_lookup.set_exception(sys.exc_info())
 
-#		if series:
-#			mi.series = series
-		
+	def isbn_found(self, mi, fields, lookup):
+		if lookup.cancelled():
+			return
 		try:
-			isbn = self.parse_isbn(root)
-			if isbn:
-				self.isbn = mi.isbn = isbn
+			isbn = lookup.result()
+		except Cancelled:
+			return
 		except:
 			self.log.exception('Error parsing ISBN for url: %r'%self.url)
-
-		if self.databazeknih_id:
-			self.plugin.cache_isbn_to_identifier(self.isbn, self.databazeknih_id)
-			
-#		self.plugin.clean_downloaded_metadata(mi)
-#		mi.isbn = check_isbn(mi.isbn)
-		self.log.info(mi)
-		self.result_queue.put(mi)
+			return
+		if isbn:
+			self.isbn = mi.isbn = fields['isbn'] = isbn
+			self.plugin.cache_bid_to_isbn(self.bid, isbn)
+			self.plugin.cache_isbn_to_identifier(isbn, self.databazeknih_id)
+			cache = details_cache()
+			if cache is not None:
+				cache.update(self.databazeknih_id, {'isbn': isbn})
 
 	def parse_databazeknih_id(self, url):
 		databazeknih_id_node = re.search('/knihy/(.*)', url).groups(0)[0]
@@ -175,148 +333,29 @@ class Worker(Thread): # Get details
 			return databazeknih_id_node
 		else: return None
 		
-	def parse_first(self, root, xpath, loginfo, convert=lambda x: x[0].strip()):
-		try:
-			nodes = root.xpath(xpath)
-			self.log.info('Found %s: %s' % (loginfo,nodes))
-			return convert(nodes) if nodes else None
-		except Exception as e:
-			self.log.exception('Error parsing for %s with xpath: %s' % (loginfo, xpath))
-
-	def parse_title(self, root):
-		title_node = self.parse_first(root,'//h1[@itemprop="name"]/text()','title',lambda x: x[0].replace('&nbsp;','').strip())
-		if title_node:
-			return title_node
-		else: return None
-			
-	def parse_series(self, root):
-#		series_node = root.xpath('//div[@id="main"]//div[@id="content"]/div/div[4]/h3/a/text()')
-#		series_node = root.xpath('//a[@class="strong"]/text()')
-        series_node = root.xpath('//h3/a/text()')
-		if series_node:
-			self.log.info('series_node: %s'%series_node)
-            series_index = root.xpath('//h3/em[@class="info"]/text()')
-            if series_index:
-				self.log.info('index_text: %s'%series_index)
-				index = re.search('\((\d*)\.\)', series_index[0]).groups(0)[0]
-				self.log.info('index: %s'%index)
-				try:
-					index = float(index)
-				except:
-					index = None
-				self.log.info('index: %s'%index)
-				return (series_node[0], index)
-		else: return (None, None)
-		
-	def parse_authors(self, root):
-		author_nodes = root.xpath('//h2[@class="jmenaautoru"]/a/text()')
-		if author_nodes:
-			authors = []
-			self.log.info('eee %s'%author_nodes[0])
-			acko = u''.join(author_nodes[0])
-			authors.append(acko)
-			return authors
-		else: return None
-
-	def parse_tags(self, root):
-		ret_nodes = root.xpath('//h5[@itemprop="category"]/a/text()')
-		if ret_nodes:
-			tags = []
-			self.log.info('ttt %s'%ret_nodes[0])
-			for node in ret_nodes: 
-				tcko = u''.join(node)
-				tags.append(tcko)
-			return tags
-		else: return None
-
-	def parse_pubdate(self, root):
-		txt_more = root.xpath('//span[@itemprop="datePublished"]/text()')
-		if txt_more:
-			year = int(txt_more[0])
-			month = 1
-			day = 1
-			from calibre.utils.date import utc_tz
-			pubdate = datetime(year, month, day, tzinfo=utc_tz)
-			return pubdate
-		else: return None
-		
-	def parse_comments(self, root):
-		description_node = root.xpath('//p[@id="biall"]/text()')
-		self.log.info('comm_node: %s'%description_node)
-		if description_node:
-			return ''.join(description_node)
-		else:
-#			description_node = root.xpath('//p[@class="justify odtop_ten oddown"]/text()')
-			description_node = root.xpath('//p[@itemprop="description"]/text()')
-			self.log.info('comm_node: %s'%description_node)
-			if description_node:
-				return ''.join(description_node)
-			else: return None
+	def parse_isbn(self, bid):
+		if not bid:
+			return None
+		urlISBN = self.plugin.BASE_URL + 'helpful/ajax/more_binfo.php?bid=' + bid
+		# Books of the same bid looked up at the same time share the request
+		return shared_flights().run(('isbn', canonical_url(urlISBN)),
+				lambda: self.fetch_isbn(urlISBN), self.cancel, self.recorder)
 
-	
-	def parse_isbn(self, root):
-#		return '00'
-#		txt_node = root.xpath('//span[@itemprop="identifier"]/text()')
-        try:
-		    txt_node = root.xpath('//a[@id="bukinfo"]/@bid')
-            urlISBN = 'http://www.databazeknih.cz/helpful/ajax/more_binfo.php?bid=' + str(txt_node[0])
-		except:
-            return None
+	def fetch_isbn(self, urlISBN):
 		self.log.info('More info: %s'%urlISBN)
-		raw = self.browser.open_novisit(urlISBN, timeout=self.timeout)#.read().strip()
-		root = lh.parse(raw)
-        txt_more = root.xpath('//span[@itemprop="isbn"]/text()')
+		with self.recorder.span('isbn.fetch'):
+			raw = self.session.open(urlISBN, timeout=self.phase_timeout('isbn'),
+					cancel=self.cancel, recorder=self.recorder)
+			try:
+				with document_limit().slot(self.cancel, self.recorder):
+					root = lh.parse(raw)
+					self.log.info('Read %s of more info'%raw.transferred())
+					txt_more = isbn_nodes(root)
+					del root
+			finally:
+				raw.close()
+				self.recorder.add_response(raw)
 		if txt_more:
 			self.log.info('ISBN : %s'%txt_more[0])
-			ret_node = txt_more[0]
-			if ret_node:
-				return ret_node
-			else: return txt_node[0]
-		else: return txt_node[0]
-
-	def parse_publisher(self, root):
-        publisher_nodes = root.xpath('//span[@itemprop="publisher"]/a/text()')
-        self.log.info('Publisher %s'%publisher_nodes[0])
-        if publisher_nodes:
-            self.log.info('Publisher %s'%publisher_nodes[0])
-            return publisher_nodes[0]
-        else: return None
-		
-	def parse_rating(self, root):
-		rating_node = root.xpath('//a[@class="bpoints"]/text()')
-		self.log.info('Rating_node: %s'%rating_node)
-#		self.log.info('LEN Rating_node: %s'%len(rating_node))
-		if len(rating_node) > 0:
-			rating_node = rating_node[0].strip("%")
-		else: rating_node = '0'
-		rating_node = float(rating_node)
-#		rating_node = round(rating_node * 0.05)
-		self.log.info('Rating_num: %s'%rating_node)
-		if rating_node:
-			if rating_node >= 90:
-				out_rating = 5
-			elif rating_node >= 70:
-				out_rating = 4
-			elif rating_node >= 50:
-				out_rating = 3
-			elif rating_node >= 30:
-				out_rating = 2
-			elif rating_node >= 10:
-				out_rating = 1
-			else:
-				out_rating = 0
-			return out_rating
-		else: return None
-	
-	def parse_cover(self, root):
-		book_cover = root.xpath('//img[@class="kniha_img"]/@src')
-		imgcol_node = book_cover
-		self.log.info('Cover: %s'%imgcol_node)
-		if imgcol_node:
-			adr_img = imgcol_node[0]
-            imgcol_node_big=imgcol_node[0].replace("mid_","big_",1);
-			if adr_img[:7] != 'http://':
-				imgcol_node_big = 'http://www.databazeknih.cz/'+imgcol_node_big
-			return imgcol_node_big
-		else: return None
-
+			return txt_more[0].strip() or None
+		return None
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2017, Frantisek Lorenc <franta.lorenc@gmail.com>'
+__docformat__ = 'restructuredtext cs'
+
+'''
+An abort from calibre interrupts identify while its search request is
+still waiting for the server. Uses the stand-in server of the benchmarks,
+needs calibre:
+
+	calibre-debug -e tests/test_abort.py
+'''
+
+import os, sys, threading, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__))), 'benchmarks'))
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+try:
+	import calibre
+except ImportError:
+	calibre = None
+
+# The server answers every request this late, the abort comes long before
+SEARCH_LATENCY = 3.0
+ABORT_AFTER = 0.5
+# How long identify may take to return after the abort
+ABORT_GRACE = 0.5
+
+
+@unittest.skipIf(calibre is None, 'needs calibre, run it with calibre-debug')
+class AbortDuringSearch(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		from harness import load_plugin
+		from server import StandInServer
+		load_plugin()
+		from calibre_plugins.databazeknih import databazeknih
+		cls.server = StandInServer(latency=SEARCH_LATENCY).start()
+		databazeknih.BASE_URL = cls.server.base_url
+		cls.plugin = databazeknih(None)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.stop()
+
+	def identify(self, asyncio_engine):
+		from harness import QuietLog, override_options
+		override_options(cacheTtlDays=0, searchCacheTtlHours=0, coverCacheMb=0,
+				quietLog=True, maxRequestsPerSecond=0, asyncioEngine=asyncio_engine)
+		abort = threading.Event()
+		timer = threading.Timer(ABORT_AFTER, abort.set)
+		timer.start()
+		started = time.time()
+		try:
+			self.plugin.identify(QuietLog(), Queue(), abort, 'Saturnin',
+					['Zdeněk Jirotka'], {}, timeout=30)
+		finally:
+			timer.cancel()
+		return time.time() - started
+
+	def test_threads(self):
+		self.assertLess(self.identify(False), ABORT_AFTER + ABORT_GRACE)
+
+	@unittest.skipIf(sys.version_info < (3, 7), 'the asyncio engine needs Python 3.7')
+	def test_asyncio(self):
+		self.assertLess(self.identify(True), ABORT_AFTER + ABORT_GRACE)
+
+
+if __name__ == '__main__':
+	unittest.main()